@@ -0,0 +1,198 @@
+#!/usr/bin/python
+
+# Load test for the base counter server, using synthetic runs (FakeRun).
+#
+# Fills a Database with fake runs of mixed instrument types, runs the web server in
+# this process and opens a number of /status SSE clients. The updater loop is driven
+# at a fixed interval, and the following is reported:
+#  - update loop latency: duration of Database.update
+#  - fan-out delay: time from the basecount event is published, until each client
+#    has received it
+#  - CPU time and memory use of the process (server and clients)
+#
+# The run storages are not scanned, and the base counts are stored in a temporary
+# database, so it can be run on the production server without affecting it.
+#
+# Example: python load-test.py --runs 400 --clients 200 --duration 300
+
+import argparse
+import logging
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+import server
+
+
+# Number of cycles for fake runs, by instrument type
+RUN_CYCLES = {
+    "novaseqx": 318,
+    "novaseq": 318,
+    "nextseq": 168,
+    "miseq": 618,
+    "miseqi100": 318,
+}
+
+
+class FastFakeRun(server.FakeRun):
+    """Fake run that runs faster than the real instrument, so the runs get new cycles
+    in each update."""
+
+    speedup = 1
+
+    def get_cycle(self):
+        speed = self.speedup * server.instrument_rate(self.machine_id) / self.get_clusters()
+        return int(min(self.start_cycle + (time.time() - self.start_time) * speed, self.total_cycles))
+
+
+class FanoutRecorder(object):
+    """Records the time of each published basecount event, and the delays until the
+    clients receive it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_publish_time = None
+        self.delays = []
+
+    def published(self, sender, data):
+        with self.lock:
+            self.last_publish_time = time.time()
+
+    def received(self):
+        now = time.time()
+        with self.lock:
+            if self.last_publish_time is not None:
+                self.delays.append(now - self.last_publish_time)
+
+
+def sse_client(url, recorder, stop, errors):
+    try:
+        with requests.get(url, stream=True, timeout=60) as response:
+            # chunk_size=None: process the data as soon as it arrives
+            for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                if line == "event: basecount":
+                    recorder.received()
+                if stop.is_set():
+                    break
+    except requests.RequestException as e:
+        errors.append(e)
+
+
+def create_fake_runs(db, num_runs):
+    machines = [(m_id, m_type) for m_id, (m_type, _) in server.SEQUENCER_LIST if m_type in RUN_CYCLES]
+    for i in range(num_runs):
+        m_id, m_type = machines[i % len(machines)]
+        cycles = RUN_CYCLES[m_type]
+        run = FastFakeRun(m_id, cycles, random.randrange(cycles))
+        while run.run_id in db.status: # The run ID is based on the time
+            run = FastFakeRun(m_id, cycles, random.randrange(cycles))
+        db.add_run(run)
+
+
+def get_rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024.0
+    return 0
+
+
+def summary(values):
+    if not values:
+        return "no data"
+    values = sorted(values)
+    return "mean {:.3f}s, median {:.3f}s, p95 {:.3f}s, max {:.3f}s (n={})".format(
+            sum(values) / len(values),
+            values[len(values) // 2],
+            values[int(len(values) * 0.95)],
+            values[-1],
+            len(values)
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the base counter server.")
+    parser.add_argument("--runs", type=int, default=300, help="Number of fake runs.")
+    parser.add_argument("--clients", type=int, default=100, help="Number of concurrent /status clients.")
+    parser.add_argument("--duration", type=float, default=120, help="Test duration (seconds).")
+    parser.add_argument("--interval", type=float, default=5, help="Interval between updates (seconds).")
+    parser.add_argument("--speedup", type=float, default=1000, help="Speed of the fake runs, relative to the real instruments.")
+    parser.add_argument("--port", type=int, default=5099, help="Port for the test server.")
+    args = parser.parse_args()
+
+    # Set up a database that doesn't scan the storages, with a temporary base count store
+    server.RUN_STORAGES = []
+    tmpdir = tempfile.mkdtemp()
+    server.BaseCountStore.COUNT_FILE = os.path.join(tmpdir, "count.txt")
+    server.BaseCountStore.BOOKED_RUNS_FILE = os.path.join(tmpdir, "booked.txt")
+    server.BaseCountStore.CANCELLED_RUNS_FILE = os.path.join(tmpdir, "cancelled.txt")
+    server.db = db = server.Database(os.path.join(tmpdir, "base-counter.db"),
+            index=server.run_index.RunIndex(path=None, storages=[]))
+    server.broadcaster = server.Broadcaster([
+            (db.basecount_signal, "basecount"),
+            (db.run_status_signal, "run_status"),
+            (db.machine_list_signal, "machine_list")
+        ])
+    recorder = FanoutRecorder()
+    db.basecount_signal.connect(recorder.published)
+
+    FastFakeRun.speedup = args.speedup
+    create_fake_runs(db, args.runs)
+    db.update(rescan=True)
+    print("Created {} fake runs.".format(len(db.status)))
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    http_server = make_server("127.0.0.1", args.port, server.app, threaded=True)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    stop = threading.Event()
+    errors = []
+    url = "http://127.0.0.1:{}/status".format(args.port)
+    clients = [
+            threading.Thread(target=sse_client, args=(url, recorder, stop, errors), daemon=True)
+            for _ in range(args.clients)
+            ]
+    for client in clients:
+        client.start()
+    time.sleep(2) # Let the clients connect and receive the initial status
+    with recorder.lock:
+        recorder.delays = []
+
+    print("Running for {} seconds with {} clients.".format(args.duration, args.clients))
+    update_times = []
+    rss = []
+    start_time = time.time()
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    while time.time() - start_time < args.duration:
+        t0 = time.time()
+        db.update(rescan=False)
+        update_times.append(time.time() - t0)
+        rss.append(get_rss_mb())
+        time.sleep(max(0, args.interval - (time.time() - t0)))
+    wall_time = time.time() - start_time
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    stop.set()
+    http_server.shutdown()
+
+    cpu_time = (end_usage.ru_utime - start_usage.ru_utime) + (end_usage.ru_stime - start_usage.ru_stime)
+    print()
+    print("Runs:              {}".format(len(db.status)))
+    print("Clients:           {} ({} errors)".format(args.clients, len(errors)))
+    print("Update latency:    {}".format(summary(update_times)))
+    print("Fan-out delay:     {}".format(summary(recorder.delays)))
+    print("Events received:   {:.1f} per update per client".format(
+            len(recorder.delays) / max(len(update_times), 1) / max(args.clients, 1)))
+    print("CPU:               {:.1f}% of one core".format(100.0 * cpu_time / wall_time))
+    print("Memory (RSS):      {:.1f} MB mean, {:.1f} MB max, {:.1f} MB peak".format(
+            sum(rss) / len(rss), max(rss), end_usage.ru_maxrss / 1024.0))
+
+
+if __name__ == "__main__":
+    main()
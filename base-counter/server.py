@@ -5,15 +5,13 @@ import datetime
 import time
 import os
 import threading
-import glob
 import re
 import yaml
 import math
 import blinker
-import queue
-import weakref
 import bitstring
-import subprocess
+import sqlite3
+import bisect
 
 import _strptime # Prevent import in thread
 
@@ -22,6 +20,12 @@ from operator import itemgetter
 from collections import defaultdict
 
 import illuminate
+from lib import run_cycles, run_index
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None # Fall back to polling the run storages
+from interop import py_interop_run_metrics, py_interop_run, py_interop_summary
 from flask import Flask, url_for, redirect, jsonify, Response, request
 
 # Storage for run folders: (path, type of run)
@@ -34,81 +38,237 @@ SEQUENCER_LIST = [(seq['id'], (seq['type'], seq['name']))
 SEQUENCERS = dict(SEQUENCER_LIST)
 # Mark as cancelled if waiting for N times the measured cycle time
 CANCELLED_TIME_N_CYCLES = 3
+# The cluster count is only re-read when one of these InterOp files changes
+TILE_METRICS_FILES = ["TileMetricsOut.bin", "ExtendedTileMetricsOut.bin"]
 
 app = Flask(__name__)
-db = None # Set on bottom of script
+db = None # Set by start(), on bottom of script
+
+# The run storages are scanned at this interval (seconds) when the watcher is active, as a safety
+# net for missed events. On network file systems, inotify only reports changes made on this host.
+RESCAN_INTERVAL = 600
+# The files of a watched run are still checked on every update, unless there was an event for
+# the run in this time (seconds). Runs on network file systems thus keep being polled.
+WATCH_EVENT_MAX_AGE = 600
+# Interval between updates of the run status, if no events are received
+UPDATE_INTERVAL = 61
+# Wait for more events after the first one, so changes are processed in batches
+EVENT_BATCH_DELAY = 2
 
 def updater():
     """Updater background thread"""
 
+    last_rescan = 0
     while True:
-        db.update()
-        time.sleep(61)
+        requested = db.watcher is not None and db.pop_rescan_request()
+        rescan = db.watcher is None or requested or time.time() - last_rescan > RESCAN_INTERVAL
+        if rescan:
+            last_rescan = time.time()
+        db.update(rescan=rescan, scan_storages=requested)
+        if db.wakeup.wait(UPDATE_INTERVAL):
+            time.sleep(EVENT_BATCH_DELAY)
+        db.wakeup.clear()
 
-MAX_ACTIVE_STREAMS = 19
-active_streams = []
 KEEPALIVE_INTERVAL = 60 # Times sleep interval 61
+# Seconds between keepalive comments on idle event streams. Also used to detect closed connections.
+STREAM_KEEPALIVE_SECONDS = 30
 
 def machine_id(run_id):
     return re.match(r"\d{6,8}_([A-Z0-9]+)_.*", run_id).group(1)
 
-class Database(object):
-    """Persistent storage for some run data."""
 
+class BaseCountStore(object):
+    """SQLite database for the total base count, the booked and cancelled runs and the
+    history of the total count and rate.
+
+    The database is in WAL mode, so the history can be read by the request threads while
+    the updater thread writes. The history is recorded at most once every HISTORY_INTERVAL
+    seconds. The old text files are imported when the database is created."""
+
+    DB_FILE = "/var/db/nsc-status/base-counter.db"
+    HISTORY_INTERVAL = 600
+
+    # Files used by earlier versions
     COUNT_FILE = "/var/db/nsc-status/count.txt"
     BOOKED_RUNS_FILE = "/var/db/nsc-status/booked.txt"
     CANCELLED_RUNS_FILE = "/var/db/nsc-status/cancelled.txt"
 
-    def __init__(self):
-        self.completed = set()
-        self.status = {}
-        self.basecount_signal = blinker.Signal()
-        self.run_status_signal = blinker.Signal()
-        self.machine_list_signal = blinker.Signal()
-        self.keepalive_counter = 0
+    def __init__(self, path=DB_FILE):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.last_history_time = 0
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), count INTEGER NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS booked_run (run_id TEXT PRIMARY KEY)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS cancelled_run (run_id TEXT PRIMARY KEY)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS history (time INTEGER PRIMARY KEY, count REAL NOT NULL, rate REAL NOT NULL)")
+            if self.db.execute("SELECT count FROM total").fetchone() is None:
+                self.import_text_files()
+        row = self.db.execute("SELECT MAX(time) FROM history").fetchone()
+        self.last_history_time = row[0] or 0
+
+    def import_text_files(self):
         try:
             with open(self.COUNT_FILE) as f:
-                self.count = int(f.read())
+                count = int(f.read())
         except IOError:
-            self.count = 0
+            count = 0
         try:
             with open(self.BOOKED_RUNS_FILE) as f:
-                self.booked_runs = set(r.strip() for r in f.readlines())
+                booked_runs = set(r.strip() for r in f.readlines() if r.strip())
         except IOError:
-            self.booked_runs = set()
+            booked_runs = set()
         try:
             with open(self.CANCELLED_RUNS_FILE) as f:
-                self.cancelled_runs = set(r.strip() for r in f.readlines())
+                cancelled_runs = set(r.strip() for r in f.readlines() if r.strip())
         except IOError:
-            self.cancelled_runs = set()
+            cancelled_runs = set()
+        self.write(count, booked_runs, cancelled_runs)
+
+    def load_count(self):
+        with self.lock:
+            return self.db.execute("SELECT count FROM total").fetchone()[0]
+
+    def load_runs(self):
+        with self.lock:
+            booked_runs = set(row[0] for row in self.db.execute("SELECT run_id FROM booked_run"))
+            cancelled_runs = set(row[0] for row in self.db.execute("SELECT run_id FROM cancelled_run"))
+        return booked_runs, cancelled_runs
+
+    def write(self, count, booked_runs, cancelled_runs):
+        """Save the count and the runs in a single transaction."""
+
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO total (id, count) VALUES (0, ?)", (count,))
+            self.db.execute("DELETE FROM booked_run")
+            self.db.executemany("INSERT INTO booked_run (run_id) VALUES (?)", ((r,) for r in booked_runs))
+            self.db.execute("DELETE FROM cancelled_run")
+            self.db.executemany("INSERT INTO cancelled_run (run_id) VALUES (?)", ((r,) for r in cancelled_runs))
+
+    def record_history(self, count, rate):
+        now = int(time.time())
+        if now - self.last_history_time < self.HISTORY_INTERVAL:
+            return
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO history (time, count, rate) VALUES (?, ?, ?)", (now, count, rate))
+        self.last_history_time = now
 
-    def update(self):
-        with open(self.COUNT_FILE) as f:
-            self.count = int(f.read())
+    def get_history(self, start, end, resolution):
+        """Get the history between the unix times start and end, as a list of
+        [time, count, mean rate], with one point per resolution seconds."""
 
-        run_dirs_and_ids = [
-                (rpath, os.path.basename(os.path.dirname(rpath)), run_type)
-                for (run_storage, run_type) in RUN_STORAGES
-                for rpath in glob.glob(os.path.join(run_storage, "*_*_*", "*"))
-            ]
-        runs_on_storage = {
-            run_id: (os.path.dirname(rpath), run_type)
-            for (rpath, run_id, run_type) in run_dirs_and_ids
-            if re.match(r"[0-9]{6,8}_[A-Z0-9]+_[_A-Z0-9-]+$", run_id)
+        resolution = max(int(resolution), self.HISTORY_INTERVAL)
+        with self.lock:
+            rows = self.db.execute("""SELECT (time / ?) * ? AS t, MAX(count), AVG(rate) FROM history
+                    WHERE time >= ? AND time <= ? GROUP BY t ORDER BY t""",
+                    (resolution, resolution, start, end)).fetchall()
+        return [list(row) for row in rows]
+
+
+class Database(object):
+    """Persistent storage for some run data."""
+
+    def __init__(self, store_path=BaseCountStore.DB_FILE, index=None):
+        self.completed = set()
+        self.status = {}
+        # Sorted list of run IDs for each machine. Use add_run and remove_run to keep it in sync with status.
+        self.machine_runs = defaultdict(list)
+        self.basecount_signal = blinker.Signal()
+        self.run_status_signal = blinker.Signal()
+        self.machine_list_signal = blinker.Signal()
+        self.keepalive_counter = 0
+        # Run folder watching: the watcher thread records changes and sets wakeup
+        self.watcher = None
+        self.wakeup = threading.Event()
+        self.changes_lock = threading.Lock()
+        self.changed_run_ids = set()
+        self.last_event_times = {} # Run ID => time of the last event from the watcher
+        self.rescan_requested = False
+        self.runs_on_storage = {}
+        # The shared run index, unless another is given (e.g. by the load test)
+        self.run_index = index if index is not None else run_index.get_run_index()
+        self.store = BaseCountStore(store_path)
+        self.count = self.store.load_count()
+        self.booked_runs, self.cancelled_runs = self.store.load_runs()
+
+    def notify_run_changed(self, run_id):
+        """Called by the watcher when files in a run folder are created or modified."""
+
+        with self.changes_lock:
+            self.changed_run_ids.add(run_id)
+            self.last_event_times[run_id] = time.time()
+        self.wakeup.set()
+
+    def request_rescan(self):
+        """Called by the watcher when run folders are created or removed."""
+
+        with self.changes_lock:
+            self.rescan_requested = True
+        self.wakeup.set()
+
+    def pop_rescan_request(self):
+        with self.changes_lock:
+            rescan, self.rescan_requested = self.rescan_requested, False
+        return rescan
+
+    def pop_changed_run_ids(self):
+        with self.changes_lock:
+            changed, self.changed_run_ids = self.changed_run_ids, set()
+        return changed
+
+    def has_recent_events(self, run_id):
+        """Check if the watcher reports changes for this run, i.e. if it's not only polled."""
+
+        with self.changes_lock:
+            return time.time() - self.last_event_times.get(run_id, 0) < WATCH_EVENT_MAX_AGE
+
+    def scan_run_storages(self, scan=False):
+        """Get the run folders from the run index. The index is kept up to date by the run-index
+        service, but the storages are scanned here if scan is True (e.g. the watcher saw a new
+        run folder), or if the index is too old."""
+
+        run_types = dict(RUN_STORAGES)
+        if scan:
+            self.run_index.scan()
+        return {
+            entry.run_id: (entry.path, run_types[entry.storage])
+            for entry in self.run_index.get_runs(list(run_types))
+            if re.match(r"[0-9]{6,8}_[A-Z0-9]+_[_A-Z0-9-]+$", entry.run_id)
             }
 
+    def update(self, rescan=True, scan_storages=False):
+        """Update the status of all runs. The run index is only read for new and removed runs
+        if rescan is True, and the storages are scanned if scan_storages is True. The files of
+        runs that are watched by the watcher, and that have had recent events, are only checked
+        if there were events for the run, or on rescan. Other runs are checked on every update."""
+
+        self.count = self.store.load_count()
+
+        if rescan:
+            self.runs_on_storage = self.scan_run_storages(scan_storages)
+        runs_on_storage = self.runs_on_storage
+        changed_run_ids = self.pop_changed_run_ids()
+
         new = set(runs_on_storage) - set(self.status.keys())
 
         for r_id in new:
             if machine_id(r_id) in SEQUENCERS:
                 new_run = RunStatus(r_id, *runs_on_storage[r_id], start_cancelled=r_id in self.cancelled_runs)
-                self.status[r_id] = new_run
+                self.add_run(new_run)
 
         modified = False
         updated = []
         for r in self.status.values():
-            if r.update():
+            if self.watcher and not r.finished and not r.is_fake and not r.watched:
+                # Retried on each update, because the directories are created during the run
+                r.watched = self.watcher.watch_run(r.run_dir)
+            polled = not (r.watched and self.has_recent_events(r.run_id))
+            if r.update(check_files=rescan or polled or r.run_id in changed_run_ids):
                 updated.append(r)
+            if r.finished and r.watched:
+                self.watcher.unwatch_run(r.run_dir)
+                r.watched = False
             if r.finished and not r.committed:
                 try:
                     if not r.run_id in self.booked_runs:
@@ -121,7 +281,11 @@ class Database(object):
         missing = set(self.status.keys()) - set(runs_on_storage)
         for r_id in missing:
             if not self.status[r_id].is_fake:
-                del self.status[r_id]
+                if self.status[r_id].watched:
+                    self.watcher.unwatch_run(self.status[r_id].run_dir)
+                with self.changes_lock:
+                    self.last_event_times.pop(r_id, None)
+                self.remove_run(r_id)
                 self.booked_runs.discard(r_id)
 
         self.booked_runs &= set(self.status.keys())
@@ -135,30 +299,40 @@ class Database(object):
 
         # Limit the number of NIPT runs shown per instrument
         per_instrument_counts = defaultdict(int)
+        newly_hidden = False
         for run_id in sorted(self.status, reverse=True):
             run = self.status[run_id]
-            if run.finished and run.run_type == "nipt":
+            if run.finished and run.run_type == "nipt" and not run.hidden:
                 run.hidden = True
+                newly_hidden = True
 
-        if new or missing:
+        if new or missing or newly_hidden:
             self.machine_list_signal.send(self, data=self.machine_list)
 
+        base_count = self.global_base_count
+        self.store.record_history(base_count['count'], base_count['rate'])
+
         if updated or self.keepalive_counter > KEEPALIVE_INTERVAL:
             self.keepalive_counter = 0
             self.basecount_signal.send(self, data=self.global_base_count)
             for r in updated:
                 self.run_status_signal.send(self, data=r.data_package)
 
+    def add_run(self, run):
+        if run.run_id not in self.status:
+            bisect.insort(self.machine_runs[run.machine_id], run.run_id)
+        self.status[run.run_id] = run
+
+    def remove_run(self, run_id):
+        run = self.status.pop(run_id)
+        run_ids = self.machine_runs[run.machine_id]
+        del run_ids[bisect.bisect_left(run_ids, run_id)]
+
     def increment(self, bases):
         self.count += bases
 
     def save(self):
-        with open(self.COUNT_FILE, 'w') as f:
-            f.write(str(int(self.count)))
-        with open(self.BOOKED_RUNS_FILE, 'w') as f:
-            f.writelines("\n".join(self.booked_runs))
-        with open(self.CANCELLED_RUNS_FILE, 'w') as f:
-            f.writelines("\n".join(self.cancelled_runs))
+        self.store.write(int(self.count), self.booked_runs, self.cancelled_runs)
 
     @property
     def global_base_count(self):
@@ -171,8 +345,8 @@ class Database(object):
         machines = {}
         for m_id, (m_type, m_name) in SEQUENCER_LIST:
             run_ids = [
-                run_id for run_id in sorted(self.status.keys())[::-1]
-                if re.match("\\d{6,8}_%s_.*" % (m_id), run_id) and not self.status[run_id].hidden
+                run_id for run_id in reversed(self.machine_runs[m_id])
+                if not self.status[run_id].hidden
                 ]
             machines[m_id] = {
                 'id': m_id,
@@ -188,6 +362,41 @@ class Database(object):
 
 
 
+def get_tile_metrics_signature(run_dir):
+    """Sizes and modification times of the tile metrics files, used to detect when
+    the cluster count has to be re-read."""
+
+    signature = []
+    for name in TILE_METRICS_FILES:
+        try:
+            st = os.stat(os.path.join(run_dir, "InterOp", name))
+        except OSError:
+            continue
+        signature.append((name, st.st_size, st.st_mtime))
+    return tuple(signature)
+
+
+def read_clusters_pf_interop(run_dir):
+    """Get the number of clusters PF using the Illumina InterOp library. Only the tile
+    metrics are loaded. Returns None if there are no metrics yet."""
+
+    valid_to_load = py_interop_run.uchar_vector(py_interop_run.MetricCount, 0)
+    valid_to_load[py_interop_run.Tile] = 1
+    valid_to_load[py_interop_run.ExtendedTile] = 1
+    run_metrics = py_interop_run_metrics.run_metrics()
+    try:
+        run_metrics.read(run_dir, valid_to_load)
+        summary = py_interop_summary.run_summary()
+        py_interop_summary.summarize_run_metrics(run_metrics, summary)
+    except Exception:
+        return None # Files missing, or being written to
+    if summary.size() == 0:
+        return None
+    read_data = summary.at(0)
+    clusters = sum(read_data.at(lane).reads_pf() for lane in range(summary.lane_count()))
+    return None if math.isnan(clusters) else clusters
+
+
 def instrument_rate(m_id):
     instrument = SEQUENCERS[m_id][0]
     if instrument == "hiseqx":
@@ -221,6 +430,9 @@ class RunStatus(object):
         self.current_cycle = 0
         self.total_cycles = 0
         self.clusters = 0
+        self.watched = False # Changes to the files are reported by the RunFolderWatcher
+        self.tile_metrics_signature = None # Cluster count is cached until the tile metrics change
+        self.tile_metrics_clusters = None
 
         self.last_update = time.time()
         self.booked = 0
@@ -246,34 +458,24 @@ class RunStatus(object):
         return self.total_cycles != 0
 
     def get_cycle(self):
-        for cycle in range(self.current_cycle, self.total_cycles):
-            test_paths = [
-                    os.path.join(
-                        self.run_dir, "Data", "Intensities", "BaseCalls", "L001",
-                        "C{0}.1".format(cycle+1)
-                        ),
-                    os.path.join(
-                        self.run_dir, "Data", "Intensities", "BaseCalls", "L001",
-                        "{0:04d}.bcl.bgzf".format(cycle+1)
-                        )
-                    ]
-            if not any(os.path.exists(test_path) for test_path in test_paths):
-                return cycle
-        return self.total_cycles
+        return run_cycles.get_cycle(self.run_dir, self.total_cycles, self.current_cycle)
 
     def get_clusters(self):
+        signature = get_tile_metrics_signature(self.run_dir)
+        if not signature:
+            return None
+        if signature != self.tile_metrics_signature:
+            clusters = self.read_clusters()
+            if clusters is None:
+                return None # Try again next time
+            self.tile_metrics_signature = signature
+            self.tile_metrics_clusters = clusters
+        return self.tile_metrics_clusters
+
+    def read_clusters(self):
         instrument = SEQUENCERS[self.machine_id][0]
         if instrument in ["novaseq", "novaseqx", "miseqi100"]:
-            process = subprocess.Popen(['nsc-python27', 
-                            '/opt/gls/clarity/customextensions/lims/base-counter/clusters-helper.py',
-                             self.run_dir],
-                        stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
-            try:
-                out, _ = process.communicate()
-                val = float(out)
-                return None if math.isnan(val) else val
-            except (subprocess.CalledProcessError, ValueError):
-                return None
+            return read_clusters_pf_interop(self.run_dir)
         try:
             ds = illuminate.InteropDataset(self.run_dir)
             all_df = ds.TileMetrics().df
@@ -304,7 +506,10 @@ class RunStatus(object):
                 return cancelled
         return False
 
-    def update(self):
+    def update(self, check_files=True):
+        """Update the run status. If check_files is False, the run folder is not checked for
+        new cycles and completion, only the time-based status is updated."""
+
         if self.finished:
             return
         now = time.time()
@@ -316,7 +521,7 @@ class RunStatus(object):
             initial_update = updated
             # If no metadata, the run hasn't really started yet.
             self.start_time = now
-        if self.read_config:
+        if self.read_config and check_files:
             self.current_cycle = self.get_cycle()
             if self.cycle_arrival.setdefault(self.current_cycle, now) == now: # Add if not exists
                 updated = True
@@ -326,7 +531,7 @@ class RunStatus(object):
                 self.booked = self.current_cycle * self.clusters
             else:
                 self.booked = 0
-        if self.check_finished():
+        if check_files and self.check_finished():
             self.finished = True
             updated = True
         new_cancelled = self.check_cancelled()
@@ -411,7 +616,8 @@ class FakeRun(RunStatus):
         self.read_config = True # See if we can get away with it
         self.total_cycles = self.num_cycles
         # Build look-up table for number of cycles -> number of data cycles
-        self.data_cycles_lut = [(i, i) for i in xrange(self.num_cycles+1)]
+        self.data_cycles_lut = [(i, i) for i in range(self.num_cycles+1)]
+        self.cycle_first_in_read_flag = [True] + [False] * self.num_cycles
         return True
 
     def get_clusters(self):
@@ -422,13 +628,13 @@ class FakeRun(RunStatus):
             return 2.6e9
         elif m_t in ["hiseq4k", "hiseq3k"]:
             return 2.1e9
-        elif "nextseq":
+        elif m_t == "nextseq":
             return 400e6
-        elif "miseq":
+        elif m_t == "miseq":
             return 25e6
-        elif "miseqi100":
+        elif m_t == "miseqi100":
             return 1e7
-        elif "novaseq":
+        else: # novaseq, novaseqx
             return 3.3e9 # 3.3 billion reads, spec S2 flow cell
 
     def get_cycle(self):
@@ -443,61 +649,145 @@ class FakeRun(RunStatus):
         return True
 
 
-class EventQueuer(object):
-    """Helper class encapsulates a single type of signal, conversion
-    to queue data."""
+class RunFolderWatcher(threading.Thread):
+    """Watches the run storages and the active run folders using inotify, and reports
+    the events to the Database.
+
+    The run storage roots are watched for new and removed run folders. For each active
+    run, the run folder (RTAComplete.txt), the InterOp directory and the lane 1 BaseCalls
+    directory (new cycles) are watched."""
+
+    STORAGE_MASK = 0
+    RUN_MASK = 0
+    if inotify_simple:
+        STORAGE_MASK = (inotify_simple.flags.CREATE | inotify_simple.flags.MOVED_TO |
+                inotify_simple.flags.DELETE | inotify_simple.flags.MOVED_FROM | inotify_simple.flags.ONLYDIR)
+        RUN_MASK = (inotify_simple.flags.CREATE | inotify_simple.flags.MOVED_TO |
+                inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.ONLYDIR)
+
+    def __init__(self, db):
+        super(RunFolderWatcher, self).__init__(name="watcher")
+        self.daemon = True
+        self.db = db
+        self.inotify = inotify_simple.INotify()
+        self.lock = threading.Lock()
+        self.watches = {} # Watch descriptor => (run ID or None for storages, path)
+        for run_storage, _ in RUN_STORAGES:
+            self.add_watch(run_storage, None, self.STORAGE_MASK)
+
+    def add_watch(self, path, run_id, mask):
+        try:
+            wd = self.inotify.add_watch(path, mask)
+        except OSError:
+            return False # Doesn't exist (yet), or the watch limit is reached
+        with self.lock:
+            self.watches[wd] = (run_id, path)
+        return True
+
+    def run_paths(self, run_dir):
+        return [
+                run_dir,
+                os.path.join(run_dir, "InterOp"),
+                os.path.join(run_dir, "Data", "Intensities", "BaseCalls", "L001")
+                ]
+
+    def watch_run(self, run_dir):
+        """Watch the run folder. Returns True if all the directories are watched."""
 
-    def __init__(self, queue, ident):
-        self.queue = queue
-        self.ident = ident
+        run_id = os.path.basename(run_dir)
+        return all([self.add_watch(path, run_id, self.RUN_MASK) for path in self.run_paths(run_dir)])
 
-    def __call__(self, sender, data):
-        self.queue.put((self.ident, data))
+    def unwatch_run(self, run_dir):
+        paths = set(self.run_paths(run_dir))
+        with self.lock:
+            wds = [wd for wd, (_, path) in self.watches.items() if path in paths]
+            for wd in wds:
+                del self.watches[wd]
+        for wd in wds:
+            try:
+                self.inotify.rm_watch(wd)
+            except OSError:
+                pass # Already removed, e.g. if the directory was deleted
+
+    def run(self):
+        while True:
+            for event in self.inotify.read():
+                if event.mask & inotify_simple.flags.IGNORED:
+                    with self.lock:
+                        self.watches.pop(event.wd, None)
+                    continue
+                with self.lock:
+                    run_id, _ = self.watches.get(event.wd, (None, None))
+                if run_id is None:
+                    self.db.request_rescan()
+                else:
+                    self.db.notify_run_changed(run_id)
 
-class SseStream(object):
-    """Usees a Queue to translate between a signal (method call
-    interface) and a generator protocol.
 
-    This new version of SSE Stream can multiplex multiple signals
-    onto the event stream, setting the id of each event as appropriate.
-    The constructor argument is a list of event type sepecifications,
-    encoded as tuples:
-        (SIGNAL, ID)
-    Every time a signal is received, the data of the event is JSON
-    encoded and returned to the stream as a SSE, with the specified
-    ID ("event:" line).
+class Broadcaster(object):
+    """Fans out the events to all the SSE streams.
 
-    The ID can be None, in which case no ID is sent.
+    The broadcaster connects to a list of signals, specified as tuples (SIGNAL, ID), like
+    (db.basecount_signal, "basecount"). Each event is JSON encoded once, and only the
+    latest event of each type is kept (per run, for run_status), with a version number.
+    Each stream only remembers the last version it has sent, and sends all the newer
+    events when it wakes up. A slow client thus skips intermediate updates of the same
+    run, and the memory used does not depend on the number of clients.
     """
 
-    TERMINATE = object()
+    # Order of the events within a batch. The machine list must be sent before the
+    # status of its runs.
+    EVENT_ORDER = {"machine_list": 0, "basecount": 1, "run_status": 2}
 
     def __init__(self, event_specs):
-        self.queue = queue.Queue()
-        self.helpers = []
+        self.condition = threading.Condition()
+        self.version = 0
+        self.events = {} # Key => (version, ID, encoded event)
         for signal, ident in event_specs:
-            qr = EventQueuer(self.queue, ident)
-            signal.connect(qr)
-            self.helpers.append(qr)
+            signal.connect(partial(self.receive, ident), weak=False)
 
-    def __iter__(self):
-        return self
+    def receive(self, ident, sender, data):
+        self.publish(ident, data)
 
-    def __next__(self):
-        ident, data = self.queue.get(block=True)
-        if ident is self.TERMINATE:
-            raise StopIteration()
-        event_str = ""
-        if ident is not None:
-            event_str = "event: " + ident + "\n"
-        event_str += 'data: ' + json.dumps(data) + '\n\n'
-        return event_str
-
-    def update(self, ident, sender=None, data=None):
-        self.queue.put((ident, data))
-
-    def terminate(self):
-        self.queue.put((self.TERMINATE, None))
+    def publish(self, ident, data):
+        event_str = "event: " + ident + "\n" + 'data: ' + json.dumps(data) + '\n\n'
+        if ident == "run_status":
+            key = (ident, data['run_id'])
+        else:
+            key = (ident,)
+        with self.condition:
+            self.version += 1
+            self.events[key] = (self.version, ident, event_str)
+            if ident == "machine_list":
+                # Forget the runs that are not shown any more
+                run_ids = set(run_id for machine in data for run_id in machine['run_ids'])
+                for old_key in list(self.events):
+                    if old_key[0] == "run_status" and old_key[1] not in run_ids:
+                        del self.events[old_key]
+            self.condition.notify_all()
+
+    def get_events(self, since_version, timeout):
+        """Wait for events newer than since_version. Returns the new version and a
+        list of encoded events, which is empty if there were no events before the timeout."""
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.version > since_version, timeout)
+            pending = [event for event in self.events.values() if event[0] > since_version]
+            version = self.version
+        pending.sort(key=lambda event: (self.EVENT_ORDER[event[1]], event[0]))
+        return version, [event_str for _, _, event_str in pending]
+
+    def stream(self):
+        """Generator of the SSE stream for one client. A new client first gets the latest
+        event of each type, i.e. the full status."""
+
+        version = 0
+        while True:
+            version, events = self.get_events(version, STREAM_KEEPALIVE_SECONDS)
+            if events:
+                yield "".join(events)
+            else:
+                yield ": keepalive\n\n"
 
 
 @app.route("/")
@@ -507,24 +797,25 @@ def get_main():
 
 @app.route("/status")
 def status():
-    global active_streams
-    active_streams = [stream for stream in active_streams if stream() is not None]
-    while len(active_streams) >= MAX_ACTIVE_STREAMS:
-        (active_streams.pop(0))().terminate()
-    events = [
-        (db.basecount_signal, "basecount"),
-        (db.run_status_signal, "run_status"),
-        (db.machine_list_signal, "machine_list")
-    ]
-    stream = SseStream(events)
-    # Send initial status
-    stream.update("basecount", data=db.global_base_count)
-    stream.update("machine_list", data=db.machine_list)
-    for r in db.status.values():
-        if not r.hidden:
-            stream.update("run_status", data=r.data_package)
-    active_streams.append(weakref.ref(stream))
-    return Response(stream, mimetype="text/event-stream")
+    return Response(broadcaster.stream(), mimetype="text/event-stream")
+
+@app.route("/history")
+def history():
+    """History of the total base count and rate. Parameters: start and end as unix
+    times (default: the last 7 days), and resolution in seconds (default: one hour)."""
+
+    try:
+        end = float(request.args.get('end', time.time()))
+        start = float(request.args.get('start', end - 7*24*3600))
+        resolution = float(request.args.get('resolution', 3600))
+    except ValueError:
+        return Response("start, end and resolution must be numbers", status=400, mimetype="text/plain")
+    if not all(math.isfinite(value) for value in (start, end, resolution)) or resolution <= 0 or start > end:
+        return Response("Invalid time range or resolution", status=400, mimetype="text/plain")
+    return jsonify(
+            fields=['time', 'count', 'rate'],
+            history=db.store.get_history(start, end, resolution)
+            )
 
 @app.route("/machines")
 def machines():
@@ -534,7 +825,7 @@ def machines():
 def fake():
     params = request.json
     run = FakeRun(params['machine'], int(params['cycles']), int(params['start_cycle']))
-    db.status[run.run_id] = run
+    db.add_run(run)
     db.update()
     return "OK"
 
@@ -545,14 +836,34 @@ def fakes():
 @app.route("/delete", methods=['POST'])
 def delete():
     params = request.json
-    del db.status[params['id']]
+    db.remove_run(params['id'])
     return "OK"
 
-db = Database()
-updater_thread = threading.Thread(target=updater, name="updater")
-updater_thread.daemon = True
-updater_thread.start()
+broadcaster = None # Set by start
+
+def start():
+    """Create the database and start the background threads. Called when the server is
+    loaded (base_counter.wsgi). The load test (load-test.py) sets up its own database."""
+
+    global db
+    global broadcaster
+    db = Database()
+    broadcaster = Broadcaster([
+            (db.basecount_signal, "basecount"),
+            (db.run_status_signal, "run_status"),
+            (db.machine_list_signal, "machine_list")
+        ])
+    if inotify_simple:
+        try:
+            db.watcher = RunFolderWatcher(db)
+            db.watcher.start()
+        except OSError:
+            db.watcher = None # Unable to use inotify, the run storages are polled
+    updater_thread = threading.Thread(target=updater, name="updater")
+    updater_thread.daemon = True
+    updater_thread.start()
 
 if __name__ == "__main__":
+    start()
     app.debug = True
     app.run(host="0.0.0.0", port=5001, threaded=True)
@@ -1,17 +1,219 @@
 # Function for getting the demultiplexing of artifacts
+import hashlib
+import json
 import logging
+import os
+import sqlite3
+import time
 from genologics.lims import *
 
-def get_demux_artifact(lims, lane_artifact):
+# Persistent cache of demux results, shared by the scripts that run on the same server. Set
+# the file name to None to disable the cache.
+DEMUX_CACHE_FILE = "/var/db/lims/demux-cache.db"
+# Maximum number of lanes / pools to keep in the cache. The least recently used entries are evicted.
+DEMUX_CACHE_MAX_ENTRIES = 5000
+
+
+class DemuxCache(object):
+    """SQLite-backed cache of the parsed demux endpoint of lane artifacts.
+
+    Entries are keyed by the lane artifact URI, and store a stamp computed from the lane
+    artifact's samples and reagent labels, and the URIs of the demultiplexed artifacts. If the
+    lane is changed, the stamp no longer matches and the demux endpoint is queried again. The
+    demultiplexed artifacts themselves are checked by is_demux_current. Only URIs and reagent
+    label names are stored."""
+
+    def __init__(self, path, max_entries=DEMUX_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path, timeout=30)
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS demux (
+                    lane_uri TEXT PRIMARY KEY,
+                    stamp TEXT NOT NULL,
+                    demux TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                    )""")
+
+    def get(self, lims, lane_artifact):
+        """Get the cached demux list for the lane artifact, or None if not cached or out of date."""
+
+        lane_uri = lane_artifact.stateless.uri
+        row = self.db.execute("SELECT stamp, demux FROM demux WHERE lane_uri = ?", (lane_uri,)).fetchone()
+        if row is None:
+            return None
+        demux_entries = json.loads(row[1])
+        if row[0] != get_demux_stamp(lane_artifact, [artifact_uri for _, artifact_uri, _ in demux_entries]):
+            return None
+        with self.db:
+            self.db.execute("UPDATE demux SET last_used = ? WHERE lane_uri = ?", (time.time(), lane_uri))
+        return [
+            (Sample(lims, uri=sample_uri), Artifact(lims, uri=artifact_uri), reagent_label)
+            for sample_uri, artifact_uri, reagent_label in demux_entries
+        ]
+
+    def put(self, lane_artifact, demux_list):
+        """Store the demux list for the lane artifact, and evict old entries if the cache is full."""
+
+        demux_json = json.dumps([
+            (sample.uri, artifact.uri, reagent_label)
+            for sample, artifact, reagent_label in demux_list
+        ])
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO demux (lane_uri, stamp, demux, last_used) VALUES (?, ?, ?, ?)",
+                    (lane_artifact.stateless.uri, get_demux_stamp(lane_artifact, [artifact.uri for _, artifact, _ in demux_list]),
+                    demux_json, time.time()))
+            self.db.execute("""DELETE FROM demux WHERE lane_uri NOT IN
+                    (SELECT lane_uri FROM demux ORDER BY last_used DESC LIMIT ?)""", (self.max_entries,))
+
+
+def get_demux_stamp(lane_artifact, demux_artifact_uris):
+    """Compute a version stamp for the demultiplexing of a lane artifact.
+
+    The API doesn't provide a modification date for artifacts. Instead we use the samples and
+    reagent labels of the lane, which are included in the artifact XML, and the URIs of the
+    demultiplexed artifacts from the demux endpoint."""
+
+    stamp_data = json.dumps([
+        sorted(sample.uri for sample in lane_artifact.samples),
+        sorted(lane_artifact.reagent_labels),
+        sorted(demux_artifact_uris)
+    ])
+    return hashlib.sha1(stamp_data.encode()).hexdigest()
+
+
+def is_demux_current(demux_list):
+    """Check that the demultiplexed artifacts still have the samples and reagent labels in the
+    demux list. The demux ancestors of a lane can change while the lane's samples and reagent
+    labels stay the same, so this is checked for cached results. The artifacts should be
+    fetched first, see prefetch_demux_entities."""
+
+    for sample, artifact, reagent_label in demux_list:
+        if sample.uri not in [artifact_sample.uri for artifact_sample in artifact.samples]:
+            return False
+        if reagent_label is not None and reagent_label not in artifact.reagent_labels:
+            return False
+    return True
+
+
+_demux_cache = None
+
+def get_demux_cache():
+    """Open the persistent demux cache on first use. Returns None if the cache is disabled or
+    can't be opened, in which case the scripts continue without it."""
+
+    global _demux_cache
+    if _demux_cache is None and DEMUX_CACHE_FILE:
+        try:
+            os.makedirs(os.path.dirname(DEMUX_CACHE_FILE), exist_ok=True)
+            _demux_cache = DemuxCache(DEMUX_CACHE_FILE)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f"Unable to open demux cache {DEMUX_CACHE_FILE}, continuing without cache: {e}")
+            _demux_cache = False
+    return _demux_cache or None
+
+
+def get_demux_artifact(lims, lane_artifact, use_cache=True, check_cached=True):
     """Get the demultiplexed sample information from a pool artifact, from the demux API endpoint.
 
+    The result is looked up in the persistent demux cache first, unless use_cache is False.
+    A cached result is only used if the demultiplexed artifacts are unchanged, unless
+    check_cached is False (then the caller must check it with is_demux_current).
+
     Returns a list of tuples with the demultiplexed components of the pool/lane artifact.
     [(sample, artifact, reagent_label), ...]
     """
 
+    cache = get_demux_cache() if use_cache else None
+    if cache:
+        try:
+            cached = cache.get(lims, lane_artifact)
+            if cached is not None and check_cached:
+                prefetch_demux_entities(lims, cached)
+                if not is_demux_current(cached):
+                    logging.info(f"Cached demux for artifact {lane_artifact.name} is out of date.")
+                    cached = None
+            if cached is not None:
+                logging.info(f"Using cached demux for artifact {lane_artifact.name} well {lane_artifact.location[1]}.")
+                return cached
+        except sqlite3.Error as e:
+            logging.warning(f"Error reading demux cache: {e}")
+
     demux_uri = lane_artifact.stateless.uri + "/demux"
     logging.info(f"Fetching demux endpoint {demux_uri} for artifact {lane_artifact.name} well {lane_artifact.location[1]}.")
     demux = lims.get(demux_uri)
+    result_list = parse_demux(lims, lane_artifact, demux)
+
+    if cache:
+        try:
+            cache.put(lane_artifact, result_list)
+        except sqlite3.Error as e:
+            logging.warning(f"Error writing demux cache: {e}")
+    return result_list
+
+
+def get_demux_artifacts(lims, lane_artifacts, use_cache=True):
+    """Get the demultiplexed sample information for multiple lanes / pools.
+
+    The demux endpoint is queried once for each lane, unless the lane is found in the persistent
+    demux cache. Then all the referenced artifacts, samples
+    and projects are fetched up front, using batch requests where the API supports it, so that
+    accessing .name, .reagent_labels, .project, etc. on the results doesn't cost any more requests.
+
+    Returns a dict keyed by lane artifact ID, with values in the same format as get_demux_artifact.
+    {lane_artifact_id: [(sample, artifact, reagent_label), ...], ...}
+    """
+
+    # Fetch the lane artifacts themselves, they are needed to parse unpooled lanes
+    lane_artifacts = list(lane_artifacts)
+    if lane_artifacts:
+        lims.get_batch(unique_entities(lane_artifacts))
+    result = {
+        lane_artifact.id: get_demux_artifact(lims, lane_artifact, use_cache, check_cached=False)
+        for lane_artifact in lane_artifacts
+    }
+    prefetch_demux_entities(lims, [demux for demux_list in result.values() for demux in demux_list])
+    # Check the cached results, now that all the artifacts are fetched
+    outdated = [lane_artifact for lane_artifact in lane_artifacts if not is_demux_current(result[lane_artifact.id])]
+    if outdated:
+        logging.info(f"Cached demux is out of date for {len(outdated)} lanes, querying the demux endpoint.")
+        for lane_artifact in outdated:
+            result[lane_artifact.id] = get_demux_artifact(lims, lane_artifact, use_cache=False)
+        prefetch_demux_entities(lims, [demux for lane_artifact in outdated for demux in result[lane_artifact.id]])
+    return result
+
+
+def prefetch_demux_entities(lims, demux_list):
+    """Fill the artifacts, samples and projects referenced in a list of demux tuples using a
+    small number of requests. Projects don't have a batch endpoint, so each unique project is
+    fetched once."""
+
+    artifacts = unique_entities(artifact for _, artifact, _ in demux_list)
+    samples = unique_entities(sample for sample, _, _ in demux_list)
+    logging.info(f"Fetching {len(artifacts)} demultiplexed artifacts and {len(samples)} samples in batch.")
+    if artifacts:
+        lims.get_batch(artifacts)
+    if samples:
+        lims.get_batch(samples)
+    projects = unique_entities(sample.project for sample in samples if sample.project)
+    logging.info(f"Fetching {len(projects)} projects.")
+    for project in projects:
+        project.get()
+
+
+def unique_entities(entities):
+    """Remove duplicate entities, based on URI, preserving the order. The batch endpoints don't
+    accept duplicate links."""
+
+    unique = {}
+    for entity in entities:
+        unique.setdefault(entity.uri, entity)
+    return list(unique.values())
+
+
+def parse_demux(lims, lane_artifact, demux):
+    """Convert the XML tree of the demux endpoint for lane_artifact into a list of demux tuples.
+    See get_demux_artifact."""
+
     # Get all artifacts that are under a <demux> element (.// matches all children at any level). These may be partially
     # demultiplexed artifacts that have their own <demux> inside them. In that case, we will skip them and process only
     # fully demultiplexed, leaf-node artifacts.
@@ -48,7 +250,7 @@ def get_demux_artifact(lims, lane_artifact):
         sample_elements = artifact.findall("samples/sample")
         if len(sample_elements) != 1:
             raise RuntimeError(f"Unexpected demux entry for lane {lane_artifact.name}: expected a single sample for "
-                    f"artifact {demux_artifact_name} but found {len(sample_elements)}. Demux URI: {demux_uri}")
+                    f"artifact {demux_artifact_name} but found {len(sample_elements)}. Demux URI: {lane_artifact.stateless.uri}/demux")
         sample = Sample(lims, uri=sample_elements[0].attrib['uri'])
         # Get the index name
         reagent_label_elements = artifact.findall("reagent-labels/reagent-label")
@@ -59,6 +261,7 @@ def get_demux_artifact(lims, lane_artifact):
         else:
             raise RuntimeError(f"There are multiple reagent labels in {demux_artifact_name}, in pool {lane_artifact.name}.")
 
-        logging.info(f"Found artifact {demux_artifact_name}, sample {sample.name}, reagent label {reagent_label}.")
+        # Log the sample ID, not the name, to avoid fetching each sample individually
+        logging.info(f"Found artifact {demux_artifact_name}, sample {sample.id}, reagent label {reagent_label}.")
         result_list.append((sample, demux_artifact, reagent_label))
     return result_list
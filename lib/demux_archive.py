@@ -0,0 +1,181 @@
+# Archive of demultiplexing metrics per lane and sample, for trend reports across runs
+import argparse
+import datetime
+import glob
+import logging
+import os
+
+import pandas as pd
+
+# The archive is a directory of Parquet files (requires pyarrow), partitioned by the year of
+# the run: {ARCHIVE_DIR}/year=YYYY/{run_id}_{analysis_id}.parquet. The file of an analysis is
+# replaced if it's imported again.
+ARCHIVE_DIR = "/var/db/lims/demux-archive"
+
+# Columns of the archive, in order
+COLUMNS = [
+    'run_id', 'analysis_id', 'run_date', 'instrument', 'flowcell', 'process_id',
+    'lane', 'sample_id', 'artifact_id', 'lims_sample_id', 'project', 'index',
+    'reads', 'perfect_index_reads', 'one_mismatch_index_reads', 'percent_of_lane',
+    'yield_bases', 'yield_q30_bases', 'mean_quality_score', 'read_passes',
+    'workflow', 'ora_compression', 'imported',
+    ]
+
+
+def parse_run_id(run_id):
+    """Get the run date, instrument and flow cell ID from the run folder name."""
+
+    parts = run_id.split("_")
+    date_str = parts[0]
+    run_date = datetime.datetime.strptime(date_str, "%Y%m%d" if len(date_str) == 8 else "%y%m%d")
+    flowcell = parts[-1][1:] if len(parts) >= 4 else None # Strip the A/B flow cell position
+    return run_date, parts[1], flowcell
+
+
+def build_records(run_id, analysis_id, process_id, demultiplex_stats, quality_metrics,
+                  detailed_summary, lims_ids):
+    """Normalise the parsed demultiplexing reports to one record per lane and sample ID.
+
+    demultiplex_stats and quality_metrics are the tables from Demultiplex_Stats.csv and
+    Quality_Metrics.csv (quality_metrics and detailed_summary may be None). lims_ids is a
+    DataFrame with the columns Lane, SampleID, artifact_id, lims_sample_id and project.
+    The Undetermined rows are included, without LIMS IDs. Returns a DataFrame with COLUMNS.
+    """
+
+    records = demultiplex_stats.groupby(['Lane', 'SampleID'], as_index=False).agg(
+            index=('Index', 'first'),
+            reads=('# Reads', 'sum'),
+            perfect_index_reads=('# Perfect Index Reads', 'sum'),
+            one_mismatch_index_reads=('# One Mismatch Index Reads', 'sum'),
+            )
+    lane_reads = records.groupby('Lane')['reads'].transform('sum')
+    records['percent_of_lane'] = records['reads'] * 100.0 / lane_reads.where(lane_reads > 0)
+
+    if quality_metrics is not None:
+        quality = quality_metrics.groupby(['Lane', 'SampleID'], as_index=False).agg(
+                yield_bases=('Yield', 'sum'),
+                yield_q30_bases=('YieldQ30', 'sum'),
+                mean_quality_score=('Mean Quality Score (PF)', 'mean'),
+                read_passes=('ReadNumber', 'nunique'),
+                )
+        records = records.merge(quality, on=['Lane', 'SampleID'], how='left')
+
+    if detailed_summary is not None:
+        workflows = pd.DataFrame(
+                [
+                    (sample['sample_id'], workflow['workflow_name'], sample['ora_compression'] == "completed")
+                    for workflow in detailed_summary['workflows']
+                    for sample in workflow['samples']
+                ],
+                columns=['SampleID', 'workflow', 'ora_compression'])
+        # Only use the workflow info if it's unique for the sample, as for the LIMS UDFs
+        workflows = workflows.drop_duplicates('SampleID', keep=False)
+        records = records.merge(workflows, on='SampleID', how='left')
+
+    records = records.merge(lims_ids.drop_duplicates(['Lane', 'SampleID']), on=['Lane', 'SampleID'], how='left')
+    records = records.rename(columns={'Lane': 'lane', 'SampleID': 'sample_id'})
+
+    run_date, instrument, flowcell = parse_run_id(run_id)
+    records['run_id'] = run_id
+    records['analysis_id'] = analysis_id
+    records['run_date'] = run_date
+    records['instrument'] = instrument
+    records['flowcell'] = flowcell
+    records['process_id'] = process_id
+    records['imported'] = datetime.datetime.now()
+    # Fill in the columns that aren't available, e.g. without Quality_Metrics.csv, so
+    # that all the files have the same schema
+    for column in COLUMNS:
+        if column not in records:
+            records[column] = None
+    return records[COLUMNS].astype({
+            'analysis_id': str, 'lane': 'int64', 'reads': 'int64', 'perfect_index_reads': 'int64',
+            'one_mismatch_index_reads': 'int64', 'percent_of_lane': 'float64', 'yield_bases': 'float64',
+            'yield_q30_bases': 'float64', 'mean_quality_score': 'float64', 'read_passes': 'float64',
+            'ora_compression': 'boolean',
+            })
+
+
+def get_partition_path(run_id, analysis_id, archive_dir=ARCHIVE_DIR):
+    run_date = parse_run_id(run_id)[0]
+    return os.path.join(archive_dir, "year={0}".format(run_date.year), "{0}_{1}.parquet".format(run_id, analysis_id))
+
+
+def append(records, archive_dir=ARCHIVE_DIR):
+    """Store the records of one analysis (from build_records) in the archive.
+
+    The archive is not required for the LIMS import, so errors are logged as warnings."""
+
+    if records.empty:
+        return
+    run_id, analysis_id = records['run_id'].iloc[0], records['analysis_id'].iloc[0]
+    path = get_partition_path(run_id, analysis_id, archive_dir)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Replace the file atomically, as reports may read the archive at the same time
+        tmp_path = os.path.join(os.path.dirname(path), ".{0}.tmp{1}".format(os.path.basename(path), os.getpid()))
+        records.to_parquet(tmp_path, index=False)
+        os.rename(tmp_path, path)
+        logging.info(f"Archived {len(records)} demultiplexing records in {path}.")
+    except (ImportError, OSError, ValueError) as e:
+        logging.warning(f"Unable to write the demultiplexing metrics archive {path}: {e}")
+
+
+def load(start=None, end=None, columns=None, archive_dir=ARCHIVE_DIR):
+    """Load the records of the runs started between the dates start and end (inclusive, either
+    may be None). Only the files of the years in the range are read, and only the given
+    columns, if specified. Returns a DataFrame."""
+
+    paths = []
+    for year_dir in sorted(glob.glob(os.path.join(archive_dir, "year=*"))):
+        year = int(os.path.basename(year_dir).split("=")[1])
+        if (start is None or year >= start.year) and (end is None or year <= end.year):
+            paths += sorted(glob.glob(os.path.join(year_dir, "*.parquet")))
+    read_columns = None if columns is None else list(dict.fromkeys(['run_date'] + list(columns)))
+    if not paths:
+        # Empty, but with a datetime run_date, so the same operations work on the result
+        return pd.DataFrame({
+                column: pd.Series(dtype='datetime64[ns]' if column == 'run_date' else object)
+                for column in (columns if columns is not None else COLUMNS)
+                })
+    records = pd.concat([pd.read_parquet(path, columns=read_columns) for path in paths], ignore_index=True)
+    if start is not None:
+        records = records[records['run_date'] >= pd.Timestamp(start)]
+    if end is not None:
+        records = records[records['run_date'] < pd.Timestamp(end) + pd.Timedelta(days=1)]
+    return records[list(columns)] if columns is not None else records
+
+
+def trend(start=None, end=None, freq="M", by=('instrument',), archive_dir=ARCHIVE_DIR):
+    """Summarise the archive per period (pandas frequency string, e.g. "W" or "M") and the
+    columns in by. Returns a DataFrame with the number of runs, reads, yield (Gb) and the
+    yield-weighted %Q30. Undetermined reads are excluded."""
+
+    by = list(by)
+    records = load(start, end, columns=by + ['run_id', 'run_date', 'sample_id', 'reads', 'yield_bases', 'yield_q30_bases'],
+                archive_dir=archive_dir)
+    records = records[records['sample_id'] != "Undetermined"]
+    if records.empty:
+        return pd.DataFrame(columns=['runs', 'reads', 'yield_gb', 'percent_q30'])
+    records = records.assign(period=records['run_date'].dt.to_period(freq))
+    summary = records.groupby(['period'] + by).agg(
+            runs=('run_id', 'nunique'),
+            reads=('reads', 'sum'),
+            yield_bases=('yield_bases', 'sum'),
+            yield_q30_bases=('yield_q30_bases', 'sum'),
+            )
+    summary['yield_gb'] = summary['yield_bases'] / 1e9
+    summary['percent_q30'] = summary['yield_q30_bases'] * 100 / summary['yield_bases'].where(summary['yield_bases'] > 0)
+    return summary[['runs', 'reads', 'yield_gb', 'percent_q30']]
+
+
+if __name__ == "__main__":
+    # Print a trend report from the command line
+    parser = argparse.ArgumentParser(description="Summarise the demultiplexing metrics archive.")
+    parser.add_argument("--start", type=datetime.date.fromisoformat, help="First run date (YYYY-MM-DD).")
+    parser.add_argument("--end", type=datetime.date.fromisoformat, help="Last run date (YYYY-MM-DD).")
+    parser.add_argument("--freq", default="M", help="Period length, pandas frequency string (default M).")
+    parser.add_argument("--by", nargs="*", default=["instrument"], help="Columns to group by (default instrument).")
+    args = parser.parse_args()
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(trend(args.start, args.end, args.freq, args.by))
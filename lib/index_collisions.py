@@ -0,0 +1,110 @@
+# Functions for checking that index sequences are sufficiently different
+import numpy as np
+
+# Bases are packed into a 64-bit integer, using two bits per base, with the first base
+# in the lowest bits.
+BASE_CODES = {"A": 0, "C": 1, "G": 2, "T": 3}
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+MAX_INDEX_LENGTH = 32
+
+# The low bit of each two-bit base
+LOW_BITS = np.uint64(0x5555555555555555)
+# Mask selecting the first k bases, indexed by k
+PREFIX_MASKS = np.array(
+    [LOW_BITS & np.uint64((1 << (2 * k)) - 1) for k in range(MAX_INDEX_LENGTH + 1)],
+    dtype=np.uint64,
+)
+# Number of set bits in each byte value, used if numpy doesn't have bitwise_count
+BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Number of rows of the mismatch matrix to compute at a time, to limit memory use
+CHUNK_SIZE = 1024
+
+
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def encode_indexes(sequences, reverse_complement_sequences=False):
+    """Pack the index sequences into 2-bit encoded integers.
+
+    Returns a tuple of numpy arrays (packed_sequences, lengths). Empty strings are
+    allowed, and are used for samples without an index."""
+
+    packed = np.zeros(len(sequences), dtype=np.uint64)
+    lengths = np.zeros(len(sequences), dtype=np.intp)
+    for i, sequence in enumerate(sequences):
+        sequence = sequence.upper()
+        if reverse_complement_sequences:
+            sequence = reverse_complement(sequence)
+        if len(sequence) > MAX_INDEX_LENGTH:
+            raise ValueError(
+                f"Index sequence {sequence} is longer than the maximum supported length {MAX_INDEX_LENGTH}."
+            )
+        value = 0
+        for position, base in enumerate(sequence):
+            try:
+                value |= BASE_CODES[base] << (2 * position)
+            except KeyError:
+                raise ValueError(f"Index sequence {sequence} contains invalid character '{base}'.")
+        packed[i] = value
+        lengths[i] = len(sequence)
+    return packed, lengths
+
+
+def popcount(values):
+    """Count the set bits in each element of an array of uint64."""
+
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values).astype(np.uint8)
+    as_bytes = values.view(np.uint8).reshape(values.shape + (8,))
+    return BYTE_POPCOUNT[as_bytes].sum(axis=-1, dtype=np.uint8)
+
+
+def mismatch_matrix(sequences, reverse_complement_sequences=False):
+    """Compute the number of mismatches between all pairs of index sequences.
+
+    When two indexes have different lengths, only the length of the shortest index is
+    compared, like BCL Convert does. An empty index has zero mismatches to all others.
+
+    Returns an n x n numpy array of mismatch counts."""
+
+    packed, lengths = encode_indexes(sequences, reverse_complement_sequences)
+    result = np.zeros((len(packed), len(packed)), dtype=np.uint8)
+    for start in range(0, len(packed), CHUNK_SIZE):
+        rows = slice(start, start + CHUNK_SIZE)
+        difference = packed[rows, None] ^ packed[None, :]
+        # Collapse each two-bit base to a single bit, which is set if the bases differ
+        difference = (difference | (difference >> np.uint64(1))) & LOW_BITS
+        difference &= PREFIX_MASKS[np.minimum(lengths[rows, None], lengths[None, :])]
+        result[rows] = popcount(difference)
+    return result
+
+
+def find_collisions(index_pairs, min_mismatches, reads=(1, 2), reverse_complement_index2=False):
+    """Find pairs of samples that can't be distinguished by their indexes.
+
+    index_pairs is a list of tuples (index1, index2) of sequences, using empty strings for
+    missing indexes. A pair of samples collides if the mismatch count is less than
+    min_mismatches in all of the index reads listed in reads. The index2 sequences
+    are optionally reverse complemented before comparison.
+
+    Returns a list of tuples (i, j, mismatches) with i < j the positions of the colliding
+    samples in index_pairs, and mismatches a tuple of the mismatch counts for each index
+    read in reads.
+    """
+
+    matrices = [
+        mismatch_matrix(
+            [index_pair[index_read - 1] for index_pair in index_pairs],
+            reverse_complement_index2 and index_read == 2,
+        )
+        for index_read in reads
+    ]
+    colliding = np.ones((len(index_pairs), len(index_pairs)), dtype=bool)
+    for matrix in matrices:
+        colliding &= matrix < min_mismatches
+    return [
+        (int(i), int(j), tuple(int(matrix[i, j]) for matrix in matrices))
+        for i, j in zip(*np.nonzero(np.triu(colliding, k=1)))
+    ]
@@ -0,0 +1,123 @@
+# Lane-level summary of the InterOp metrics of a run, cached in the run folder
+import json
+import logging
+import os
+
+from interop import py_interop_run_metrics, py_interop_run, py_interop_summary
+
+# The summary is stored in this file in the run folder, with the signature of the InterOp
+# files it was computed from.
+SUMMARY_CACHE_FILE_NAME = "InterOpSummary_NSC.json"
+
+# Metrics that are stored for each read and lane: name => function of the lane summary
+METRICS = [
+    ('yield_g',                 lambda lane: lane.yield_g()),
+    ('percent_gt_q30',          lambda lane: lane.percent_gt_q30()),
+    ('density',                 lambda lane: lane.density().mean()),
+    ('reads_pf',                lambda lane: lane.reads_pf()),
+    ('percent_pf',              lambda lane: lane.percent_pf().mean()),
+    ('first_cycle_intensity',   lambda lane: lane.first_cycle_intensity().mean()),
+    ('error_rate',              lambda lane: lane.error_rate().mean()),
+    ('phasing',                 lambda lane: lane.phasing().mean()),
+    ('prephasing',              lambda lane: lane.prephasing().mean()),
+    ('percent_aligned',         lambda lane: lane.percent_aligned().mean()),
+    ('percent_occupied',        lambda lane: lane.percent_occupied().mean()),
+    ('percent_occupied_median', lambda lane: lane.percent_occupied().median()),
+]
+
+# Summaries loaded in this process, by run folder
+_summaries = {}
+
+
+class RunSummary(object):
+    """Summary of a run. reads is a list of dicts with the keys number and is_index, and
+    metrics maps each metric name to a list (per read) of lists (per lane) of values."""
+
+    def __init__(self, reads, lane_count, metrics):
+        self.reads = reads
+        self.lane_count = lane_count
+        self.metrics = metrics
+
+    def lane(self, read_index, lane_index):
+        """Get the metrics for one read and lane, as a dict of metric name => value."""
+
+        return dict((name, values[read_index][lane_index]) for name, values in self.metrics.items())
+
+    def to_json(self):
+        return {'reads': self.reads, 'lane_count': self.lane_count, 'metrics': self.metrics}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['reads'], data['lane_count'], data['metrics'])
+
+
+def get_interop_signature(run_dir):
+    """Get the names, sizes and modification times of the files in the InterOp directory,
+    and of RunInfo.xml. The summary is computed again if this changes."""
+
+    signature = []
+    interop_dir = os.path.join(run_dir, "InterOp")
+    for name in sorted(os.listdir(interop_dir)):
+        st = os.stat(os.path.join(interop_dir, name))
+        signature.append([name, st.st_size, st.st_mtime])
+    st = os.stat(os.path.join(run_dir, "RunInfo.xml"))
+    signature.append(["RunInfo.xml", st.st_size, st.st_mtime])
+    return signature
+
+
+def summarize_run(run_dir):
+    """Compute the summary using the Illumina InterOp library."""
+
+    valid_to_load = py_interop_run.uchar_vector(py_interop_run.MetricCount, 0)
+    py_interop_run_metrics.list_summary_metrics_to_load(valid_to_load)
+    valid_to_load[py_interop_run.ExtendedTile] = 1
+    run_metrics = py_interop_run_metrics.run_metrics()
+    run_metrics.read(run_dir, valid_to_load)
+    summary = py_interop_summary.run_summary()
+    py_interop_summary.summarize_run_metrics(run_metrics, summary)
+
+    reads = []
+    metrics = dict((name, []) for name, _ in METRICS)
+    for read in range(summary.size()):
+        read_data = summary.at(read)
+        reads.append({'number': read_data.read().number(), 'is_index': bool(read_data.read().is_index())})
+        lanes = [read_data.at(lane) for lane in range(summary.lane_count())]
+        for name, function in METRICS:
+            metrics[name].append([function(lane) for lane in lanes])
+    return RunSummary(reads, summary.lane_count(), metrics)
+
+
+def get_run_summary(run_dir):
+    """Get the summary of a run, from the cache file if the InterOp files haven't changed.
+
+    The summary is computed and the cache file is written if it's missing or outdated. If the
+    cache file can't be written, a warning is logged, and the summary is still returned.
+    Errors from the InterOp library are raised."""
+
+    signature = get_interop_signature(run_dir)
+    cached = _summaries.get(run_dir)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    cache_path = os.path.join(run_dir, SUMMARY_CACHE_FILE_NAME)
+    try:
+        with open(cache_path) as f:
+            data = json.load(f)
+        if data['signature'] == signature:
+            summary = RunSummary.from_json(data['summary'])
+            _summaries[run_dir] = (signature, summary)
+            return summary
+    except (IOError, ValueError, KeyError):
+        pass # Missing or invalid cache file
+
+    summary = summarize_run(run_dir)
+    try:
+        # Replace the file atomically, as other scripts may read it at the same time
+        tmp_path = cache_path + ".tmp{0}".format(os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({'signature': signature, 'summary': summary.to_json()}, f)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as e:
+        logging.warning("Unable to write the InterOp summary cache {0}: {1}".format(cache_path, e))
+    _summaries[run_dir] = (signature, summary)
+    return summary
@@ -0,0 +1,168 @@
+# Local catalogue of reagent types (indexes), with their sequences and categories
+# This module is also used by python 2 scripts (set-reagent-labels/indexes.py).
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+from genologics.lims import *
+
+# The catalogue is stored in an SQLite database, shared by the scripts that run on the same
+# server. Set the file name to None to keep the catalogue in memory only.
+REAGENT_CATALOGUE_FILE = "/var/db/lims/reagent-catalogue.db"
+# Minimum time between the refreshes done by all() (seconds)
+MIN_REFRESH_INTERVAL = 300
+
+ReagentInfo = collections.namedtuple("ReagentInfo", ["name", "sequence", "category", "uri"])
+
+
+class ReagentCatalogue(object):
+    """Catalogue of all reagent types in LIMS, mapping name => ReagentInfo.
+
+    The catalogue is built by a full refresh, which lists the reagenttypes resource and fetches
+    each reagent type. This is only done from the command line (python -m lib.reagent_catalogue
+    --full), e.g. daily from cron, to pick up changes to the sequence or category of existing
+    reagent types. The lookups only do incremental refreshes, which list the resource again, but
+    only fetch the reagent types that weren't seen before. Reagent types that are deleted in LIMS
+    are removed from the catalogue.
+
+    The database may be shared by multiple LIMS servers, the entries are separated by the
+    base URI.
+    """
+
+    def __init__(self, lims, path=REAGENT_CATALOGUE_FILE):
+        self.lims = lims
+        self.lock = threading.Lock()
+        self.reagent_types = {}
+        self.last_refresh = 0
+        self.last_full_refresh = 0
+        self.db = None
+        if path:
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+                with self.db:
+                    self.db.execute("""CREATE TABLE IF NOT EXISTS reagent_type (
+                            uri TEXT PRIMARY KEY,
+                            name TEXT NOT NULL,
+                            sequence TEXT,
+                            category TEXT
+                            )""")
+                    self.db.execute("""CREATE TABLE IF NOT EXISTS refresh (
+                            baseuri TEXT PRIMARY KEY,
+                            last_refresh REAL NOT NULL
+                            )""")
+                    columns = [row[1] for row in self.db.execute("PRAGMA table_info(refresh)")]
+                    if 'last_full_refresh' not in columns: # Added after the first version
+                        self.db.execute("ALTER TABLE refresh ADD COLUMN last_full_refresh REAL NOT NULL DEFAULT 0")
+                self.load()
+            except (OSError, sqlite3.Error) as e:
+                logging.warning("Unable to open reagent catalogue {0}, continuing without persistence: {1}".format(path, e))
+                self.db = None
+
+    def load(self):
+        rows = self.db.execute("SELECT name, sequence, category, uri FROM reagent_type WHERE uri LIKE ?",
+                (self.lims.baseuri + "%",)).fetchall()
+        self.reagent_types = dict((row[0], ReagentInfo(*row)) for row in rows)
+        refresh_row = self.db.execute("SELECT last_refresh, last_full_refresh FROM refresh WHERE baseuri = ?",
+                (self.lims.baseuri,)).fetchone()
+        self.last_refresh, self.last_full_refresh = refresh_row if refresh_row else (0, 0)
+        logging.info("Loaded {0} reagent types from the catalogue.".format(len(self.reagent_types)))
+
+    def list_reagent_types(self):
+        """Get the name and URI of all reagent types from the API resource, without fetching
+        the full representations. Returns a dict {uri: name}."""
+
+        # Using a loop similar to Lims._get_instances()
+        names = {}
+        root = self.lims.get(self.lims.get_uri("reagenttypes"))
+        while root:
+            for node in root.findall("reagent-type"):
+                names[node.attrib['uri']] = node.attrib['name']
+            node = root.find('next-page')
+            root = None
+            if not node is None:
+                root = self.lims.get(node.attrib['uri'])
+        return names
+
+    def refresh(self, full=False):
+        """Update the catalogue from LIMS. Only new reagent types are fetched, unless full is True."""
+
+        listed = self.list_reagent_types()
+        known = dict((info.uri, info) for info in self.reagent_types.values())
+        reagent_types = {}
+        num_fetched = 0
+        for uri, name in listed.items():
+            info = known.get(uri)
+            if full or info is None:
+                reagent_type = ReagentType(self.lims, uri=uri)
+                info = ReagentInfo(name, reagent_type.sequence, reagent_type.category, uri)
+                num_fetched += 1
+            elif info.name != name:
+                info = info._replace(name=name)
+            reagent_types[name] = info
+        self.reagent_types = reagent_types
+        self.last_refresh = time.time()
+        if full:
+            self.last_full_refresh = self.last_refresh
+        logging.info("Refreshed reagent catalogue: {0} reagent types, fetched {1}.".format(len(reagent_types), num_fetched))
+        if self.db:
+            try:
+                with self.db:
+                    self.db.execute("DELETE FROM reagent_type WHERE uri LIKE ?", (self.lims.baseuri + "%",))
+                    self.db.executemany("INSERT OR REPLACE INTO reagent_type (name, sequence, category, uri) VALUES (?, ?, ?, ?)",
+                            self.reagent_types.values())
+                    self.db.execute("INSERT OR REPLACE INTO refresh (baseuri, last_refresh, last_full_refresh) VALUES (?, ?, ?)",
+                            (self.lims.baseuri, self.last_refresh, self.last_full_refresh))
+            except sqlite3.Error as e:
+                logging.warning("Unable to save the reagent catalogue: {0}".format(e))
+
+    def refresh_if_older_than(self, max_age):
+        """Do an incremental refresh if the last refresh is older than max_age. Raises an error
+        if the catalogue has never been built, instead of fetching all the reagent types."""
+
+        with self.lock:
+            if not self.reagent_types and not self.last_full_refresh:
+                raise RuntimeError("The reagent catalogue has not been built. Build it with "
+                        "'python -m lib.reagent_catalogue --full' (database: {0}).".format(REAGENT_CATALOGUE_FILE))
+            if time.time() - self.last_refresh > max_age:
+                self.refresh()
+
+    def get(self, name):
+        """Look up a reagent type by name. Returns a ReagentInfo, or None if there is no
+        reagent type with this name. Unknown names always trigger an incremental refresh, so
+        reagent types that were just created in LIMS are found."""
+
+        if name not in self.reagent_types:
+            self.refresh_if_older_than(0)
+        return self.reagent_types.get(name)
+
+    def all(self):
+        """Get all reagent types in the catalogue, refreshing it if it hasn't been refreshed in
+        the last MIN_REFRESH_INTERVAL seconds."""
+
+        self.refresh_if_older_than(MIN_REFRESH_INTERVAL)
+        return list(self.reagent_types.values())
+
+
+_reagent_catalogues = {}
+
+def get_reagent_catalogue(lims):
+    """Get the shared catalogue for this process, loading it on first use."""
+
+    if lims.baseuri not in _reagent_catalogues:
+        _reagent_catalogues[lims.baseuri] = ReagentCatalogue(lims)
+    return _reagent_catalogues[lims.baseuri]
+
+
+if __name__ == "__main__":
+    # Build or update the catalogue from the command line, before first use and daily from cron
+    import argparse
+    from genologics import config
+    parser = argparse.ArgumentParser(description="Update the local reagent type catalogue.")
+    parser.add_argument("--full", action="store_true", help="Fetch all reagent types, not just new ones.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    ReagentCatalogue(Lims(config.BASEURI, config.USERNAME, config.PASSWORD)).refresh(full=args.full)
@@ -0,0 +1,49 @@
+# Detection of the sequencing progress (current cycle) from the files in a run folder
+# This module is also used by python 2 scripts (update-runs.py).
+import os
+import re
+
+# The lane 1 BaseCalls directory has a C{n}.1 directory (most instruments) or a
+# {n:04d}.bcl.bgzf file (NextSeq) for each completed cycle n.
+CYCLE_PATTERN = re.compile(r"C(\d+)\.1$|(\d{4})\.bcl\.bgzf$")
+
+# Highest completed cycle seen for each run folder, in this process
+_high_water_marks = {}
+
+
+def get_completed_cycles(run_dir):
+    """Get the set of cycle numbers that have files in the lane 1 BaseCalls directory. The
+    directory is read once, instead of checking for the files of each cycle."""
+
+    basecalls_dir = os.path.join(run_dir, "Data", "Intensities", "BaseCalls", "L001")
+    try:
+        names = os.listdir(basecalls_dir)
+    except OSError:
+        return set()
+    cycles = set()
+    for name in names:
+        match = CYCLE_PATTERN.match(name)
+        if match:
+            cycles.add(int(match.group(1) or match.group(2)))
+    return cycles
+
+
+def get_cycle(run_dir, total_cycles, lower_bound_cycle=0):
+    """Get the number of completed cycles of a run.
+
+    The cycles up to lower_bound_cycle, or up to the highest cycle found in an earlier call
+    for the same run folder, are assumed to be complete. Counting continues from there, and
+    stops at the first cycle without files. The run folder is not read if all the cycles are
+    known to be complete.
+
+    Returns the current cycle, between 0 and total_cycles.
+    """
+
+    cycle = max(0, lower_bound_cycle, _high_water_marks.get(run_dir, 0))
+    if cycle < total_cycles:
+        completed_cycles = get_completed_cycles(run_dir)
+        while cycle < total_cycles and (cycle + 1) in completed_cycles:
+            cycle += 1
+    cycle = min(cycle, total_cycles)
+    _high_water_marks[run_dir] = cycle
+    return cycle
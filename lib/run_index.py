@@ -0,0 +1,372 @@
+# Index of the run folders on the run storages, with the metadata from RunInfo.xml and
+# RunParameters.xml, completion markers and analysis directories.
+# This module is also used by python 2 scripts (update-runs.py).
+import collections
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from xml.etree.ElementTree import ElementTree
+
+# All run storages that are indexed. Consumers select the storages they need.
+RUN_STORAGES = [
+    "/data/runScratch.boston",
+    "/data/runScratch.boston/MiSeqi100",
+    "/data/runScratch.boston/NovaSeqX",
+    "/boston/diag/runs",
+    "/boston/diag/runs/veriseq",
+    ]
+
+# The index is stored in an SQLite database, shared by the scripts and services on the same
+# server. It is kept up to date by the run-index service, see run-index/main.py.
+RUN_INDEX_FILE = "/var/db/lims/run-index.db"
+# Scan the storages when reading from the index, if it hasn't been updated in this time (seconds).
+# The scan is normally done by the service, this is a fallback if the service isn't running.
+MAX_INDEX_AGE = 180
+
+RUN_FOLDER_PATTERN = re.compile(r"\d{6,8}_[^_]+_.+$")
+COMPLETION_MARKERS = ["RTAComplete.txt", "CopyComplete.txt", "SequenceComplete.txt", "RunCompletionStatus.xml"]
+RUN_PARAMETERS_FILES = ["RunParameters.xml", "runParameters.xml"]
+
+RunEntry = collections.namedtuple("RunEntry", [
+    "run_id", "path", "storage", "instrument", "flowcell", "reads", "library_tube_strip_id",
+    "markers", "analyses", "updated"
+    ])
+
+
+class LazyRunEntry(RunEntry):
+    """RunEntry that reads RunInfo.xml and RunParameters.xml when the fields flowcell, reads
+    or library_tube_strip_id are first used. It's used if the index can't be stored, so a
+    scan only lists the run folders, instead of parsing the files of all the runs in each
+    invocation of the scripts."""
+
+    @property
+    def flowcell(self):
+        return self.read_run_info()[0]
+
+    @property
+    def reads(self):
+        return self.read_run_info()[1]
+
+    @property
+    def library_tube_strip_id(self):
+        if not hasattr(self, "_library_tube_strip_id"):
+            self._library_tube_strip_id = None
+            for name in RUN_PARAMETERS_FILES:
+                path = os.path.join(self.path, name)
+                if os.path.exists(path):
+                    try:
+                        self._library_tube_strip_id = read_library_tube_strip_id(path)
+                    except Exception as e:
+                        logging.warning("Unable to read {0} for {1}: {2}".format(name, self.run_id, e))
+                    break
+        return self._library_tube_strip_id
+
+    def read_run_info(self):
+        if not hasattr(self, "_run_info"):
+            try:
+                self._run_info = read_run_info(self.path)
+            except Exception as e:
+                logging.warning("Unable to read RunInfo.xml for {0}: {1}".format(self.run_id, e))
+                return None, [] # Retried on the next access
+        return self._run_info
+
+    def _asdict(self):
+        return collections.OrderedDict((field, getattr(self, field)) for field in self._fields)
+
+
+def read_run_info(run_dir):
+    """Get the flow cell ID and the read configuration from RunInfo.xml. The reads are
+    dicts with the keys number, cycles and is_index."""
+
+    tree = ElementTree()
+    tree.parse(os.path.join(run_dir, "RunInfo.xml"))
+    flowcell_node = tree.find("Run/Flowcell")
+    reads = [
+            {
+                'number': int(read.attrib['Number']),
+                'cycles': int(read.attrib['NumCycles']),
+                'is_index': read.attrib.get('IsIndexedRead') == "Y"
+            }
+            for read in tree.findall("Run/Reads/Read")
+            ]
+    return (flowcell_node.text if flowcell_node is not None else None), reads
+
+
+def read_library_tube_strip_id(run_parameters_path):
+    """Get the library tube strip ID (NovaSeq X) from RunParameters.xml, or None."""
+
+    tree = ElementTree()
+    tree.parse(run_parameters_path)
+    for consumable_info in tree.findall("ConsumableInfo/ConsumableInfo"):
+        try:
+            if consumable_info.find("Type").text == "SampleTube":
+                return consumable_info.find("SerialNumber").text
+        except AttributeError:
+            pass
+    return None
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class RunIndex(object):
+    """Index of run folders, mapping run ID => RunEntry.
+
+    scan() lists the storage directories, and only reads the run folders that are new or
+    whose modification time has changed. The run folder is modified when files are added at the
+    top level, e.g. completion markers. The Analysis directory and each analysis directory are
+    also checked, for new analyses and their CopyComplete.txt. RunInfo.xml and RunParameters.xml
+    are only parsed again if they are modified.
+
+    If the database can't be opened, the index starts empty in each process. Then the XML files
+    are not parsed by the scan, but when they are used (LazyRunEntry).
+    """
+
+    def __init__(self, path=RUN_INDEX_FILE, storages=RUN_STORAGES):
+        self.storages = storages
+        self.lock = threading.Lock()
+        self.runs = {}
+        self.signatures = {}
+        self.last_scan = 0
+        self.db = None
+        self.lazy = False
+        if path:
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+                with self.db:
+                    self.db.execute("PRAGMA journal_mode=WAL")
+                    self.db.execute("""CREATE TABLE IF NOT EXISTS run (
+                            run_id TEXT PRIMARY KEY,
+                            data TEXT NOT NULL,
+                            signature TEXT NOT NULL
+                            )""")
+                    self.db.execute("""CREATE TABLE IF NOT EXISTS scan (
+                            id INTEGER PRIMARY KEY,
+                            last_scan REAL NOT NULL
+                            )""")
+            except (OSError, sqlite3.Error) as e:
+                logging.warning("Unable to open run index {0}, continuing without persistence. The run "
+                        "folders are listed, and the XML files are only read when used: {1}".format(path, e))
+                self.db = None
+                self.lazy = True
+
+    def load(self):
+        """Load the index from the database, if it has been updated by another process."""
+
+        if not self.db:
+            return
+        row = self.db.execute("SELECT last_scan FROM scan WHERE id = 0").fetchone()
+        last_scan = row[0] if row else 0
+        if last_scan > self.last_scan:
+            runs = {}
+            signatures = {}
+            for run_id, data, signature in self.db.execute("SELECT run_id, data, signature FROM run"):
+                runs[run_id] = RunEntry(**json.loads(data))
+                signatures[run_id] = json.loads(signature)
+            self.runs, self.signatures, self.last_scan = runs, signatures, last_scan
+
+    def get_dir_mtimes(self, run_dir, entry):
+        """Modification times of the directories that are checked for changes."""
+
+        mtimes = [get_mtime(run_dir), get_mtime(os.path.join(run_dir, "Analysis"))]
+        if entry:
+            mtimes += [get_mtime(analysis['path']) for analysis in entry.analyses]
+        return mtimes
+
+    def read_run(self, run_id, run_dir, storage, old_entry, old_signature):
+        """Create the RunEntry for a new or modified run folder. Returns the entry, the
+        modification times of the XML files that were read, and a flag that is True if an
+        XML file couldn't be read."""
+
+        names = set(os.listdir(run_dir))
+        if self.lazy:
+            return LazyRunEntry(
+                    run_id=run_id,
+                    path=run_dir,
+                    storage=storage,
+                    instrument=run_id.split("_")[1],
+                    flowcell=None,
+                    reads=None,
+                    library_tube_strip_id=None,
+                    markers=[marker for marker in COMPLETION_MARKERS if marker in names],
+                    analyses=self.read_analyses(run_dir, names),
+                    updated=time.time()
+                    ), {}, False
+        xml_mtimes = old_signature['xml'] if old_signature else {}
+        new_xml_mtimes = {}
+        failed = False
+
+        flowcell, reads = (old_entry.flowcell, old_entry.reads) if old_entry else (None, [])
+        if "RunInfo.xml" in names:
+            mtime = get_mtime(os.path.join(run_dir, "RunInfo.xml"))
+            if mtime != xml_mtimes.get("RunInfo.xml"):
+                try:
+                    flowcell, reads = read_run_info(run_dir)
+                    new_xml_mtimes["RunInfo.xml"] = mtime
+                except Exception as e: # May be incomplete, retry on next scan
+                    logging.warning("Unable to read RunInfo.xml for {0}: {1}".format(run_id, e))
+                    failed = True
+            else:
+                new_xml_mtimes["RunInfo.xml"] = mtime
+
+        library_tube_strip_id = old_entry.library_tube_strip_id if old_entry else None
+        for name in RUN_PARAMETERS_FILES:
+            if name in names:
+                path = os.path.join(run_dir, name)
+                mtime = get_mtime(path)
+                if mtime != xml_mtimes.get(name):
+                    try:
+                        library_tube_strip_id = read_library_tube_strip_id(path)
+                        new_xml_mtimes[name] = mtime
+                    except Exception as e:
+                        logging.warning("Unable to read {0} for {1}: {2}".format(name, run_id, e))
+                        failed = True
+                else:
+                    new_xml_mtimes[name] = mtime
+                break
+
+        entry = RunEntry(
+                run_id=run_id,
+                path=run_dir,
+                storage=storage,
+                instrument=run_id.split("_")[1],
+                flowcell=flowcell,
+                reads=reads,
+                library_tube_strip_id=library_tube_strip_id,
+                markers=[marker for marker in COMPLETION_MARKERS if marker in names],
+                analyses=self.read_analyses(run_dir, names),
+                updated=time.time()
+                )
+        return entry, new_xml_mtimes, failed
+
+    def read_analyses(self, run_dir, names):
+        analyses = []
+        if "Analysis" in names:
+            analysis_base = os.path.join(run_dir, "Analysis")
+            for analysis_id in sorted(os.listdir(analysis_base)):
+                analysis_dir = os.path.join(analysis_base, analysis_id)
+                if os.path.isdir(analysis_dir):
+                    analyses.append({
+                        'id': analysis_id,
+                        'path': analysis_dir,
+                        'copy_complete': os.path.exists(os.path.join(analysis_dir, "CopyComplete.txt"))
+                        })
+        return analyses
+
+    def scan(self, full=False):
+        """Update the index from the run storages. All run folders are read if full is True.
+        Returns the number of new or modified runs."""
+
+        with self.lock:
+            self.load()
+            runs = {}
+            signatures = {}
+            changed = []
+            for storage in self.storages:
+                try:
+                    names = os.listdir(storage)
+                except OSError as e:
+                    logging.warning("Unable to list run storage {0}: {1}".format(storage, e))
+                    # Keep the runs as they are, instead of removing them
+                    for run_id, entry in self.runs.items():
+                        if entry.storage == storage:
+                            runs[run_id] = entry
+                            signatures[run_id] = self.signatures[run_id]
+                    continue
+                for run_id in names:
+                    run_dir = os.path.join(storage, run_id)
+                    if not RUN_FOLDER_PATTERN.match(run_id) or run_id in runs or not os.path.isdir(run_dir):
+                        continue
+                    entry = self.runs.get(run_id)
+                    old_signature = self.signatures.get(run_id)
+                    if entry and entry.path != run_dir:
+                        entry, old_signature = None, None
+                    dir_mtimes = self.get_dir_mtimes(run_dir, entry)
+                    if dir_mtimes[0] is None:
+                        continue # Removed
+                    if full or not old_signature or old_signature['dirs'] != dir_mtimes:
+                        try:
+                            entry, xml_mtimes, failed = self.read_run(run_id, run_dir, storage, entry, old_signature)
+                        except OSError as e:
+                            logging.warning("Unable to read run folder {0}: {1}".format(run_dir, e))
+                            continue
+                        # The times from before the folder was read are stored, so files created
+                        # while reading it are found on the next scan. If there are new analysis
+                        # directories, the times don't match and the run is read once more. If
+                        # reading failed, no times are stored, so it's read again on the next scan.
+                        signature = {'dirs': [] if failed else dir_mtimes, 'xml': xml_mtimes}
+                        changed.append(run_id)
+                    else:
+                        signature = old_signature
+                    runs[run_id] = entry
+                    signatures[run_id] = signature
+
+            removed = set(self.runs) - set(runs)
+            self.runs, self.signatures = runs, signatures
+            self.last_scan = time.time()
+            if changed or removed:
+                logging.info("Scanned run storages: {0} runs, {1} new or modified, {2} removed.".format(
+                    len(runs), len(changed), len(removed)))
+            if self.db:
+                try:
+                    with self.db:
+                        self.db.executemany("DELETE FROM run WHERE run_id = ?", [(r,) for r in removed])
+                        self.db.executemany("INSERT OR REPLACE INTO run (run_id, data, signature) VALUES (?, ?, ?)",
+                                [(r, json.dumps(runs[r]._asdict()), json.dumps(signatures[r])) for r in changed])
+                        self.db.execute("INSERT OR REPLACE INTO scan (id, last_scan) VALUES (0, ?)", (self.last_scan,))
+                except sqlite3.Error as e:
+                    logging.warning("Unable to save the run index: {0}".format(e))
+            return len(changed)
+
+    def refresh_if_older_than(self, max_age):
+        with self.lock:
+            self.load()
+            up_to_date = time.time() - self.last_scan <= max_age
+        if not up_to_date:
+            self.scan()
+
+    def get(self, run_id, max_age=MAX_INDEX_AGE):
+        """Look up a run by run ID. Returns a RunEntry, or None if the run isn't found."""
+
+        self.refresh_if_older_than(max_age)
+        return self.runs.get(run_id)
+
+    def get_runs(self, storages=None, max_age=MAX_INDEX_AGE):
+        """Get the runs on the given storages (all storages if None), sorted by run ID."""
+
+        self.refresh_if_older_than(max_age)
+        return sorted(
+                (entry for entry in self.runs.values() if storages is None or entry.storage in storages),
+                key=lambda entry: entry.run_id
+                )
+
+
+_run_index = None
+
+def get_run_index():
+    """Get the shared index for this process."""
+
+    global _run_index
+    if _run_index is None:
+        _run_index = RunIndex()
+    return _run_index
+
+
+if __name__ == "__main__":
+    # Update the index from the command line
+    import argparse
+    parser = argparse.ArgumentParser(description="Update the run folder index.")
+    parser.add_argument("--full", action="store_true", help="Read all run folders, not just new or modified ones.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    get_run_index().scan(full=args.full)
@@ -0,0 +1,78 @@
+# Waiting for changes in run folders, for scripts that run as daemons instead of from cron.
+import logging
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None # Fall back to polling at the daemon interval
+
+# Wait for more events after the first one, so changes are processed in batches (seconds)
+EVENT_BATCH_DELAY = 2
+
+
+class RunFolderWatcher(object):
+    """Watches a set of directories using inotify, and reports when files or directories
+    with given names are created in them.
+
+    The directories to watch are given to update() as a dict of path => set of names, or
+    None to report any new entry (e.g. new run folders in the run storages). The watches
+    are added and removed to match the dict. On network file systems, inotify only reports
+    changes made on this host, so the daemons still poll at a regular interval.
+    """
+
+    MASK = 0
+    if inotify_simple:
+        MASK = (inotify_simple.flags.CREATE | inotify_simple.flags.MOVED_TO |
+                inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.ONLYDIR)
+
+    def __init__(self):
+        self.inotify = inotify_simple.INotify() if inotify_simple else None
+        self.watches = {} # Watch descriptor => (path, names)
+        if not self.inotify:
+            logging.info("inotify_simple is not available, only polling the run folders.")
+
+    def update(self, paths):
+        if not self.inotify:
+            return
+        watched = dict((path, wd) for wd, (path, _) in self.watches.items())
+        for path, wd in watched.items():
+            if path not in paths:
+                del self.watches[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass # Already removed, e.g. if the directory was deleted
+        for path, names in paths.items():
+            if path not in watched or self.watches[watched[path]][1] != names:
+                try:
+                    wd = self.inotify.add_watch(path, self.MASK)
+                except OSError:
+                    continue # Doesn't exist (yet), or the watch limit is reached
+                self.watches[wd] = (path, names)
+
+    def is_relevant(self, event):
+        if event.mask & inotify_simple.flags.IGNORED:
+            self.watches.pop(event.wd, None)
+            return False
+        path, names = self.watches.get(event.wd, (None, ()))
+        return path is not None and (names is None or event.name in names)
+
+    def wait(self, timeout):
+        """Wait until a relevant file is created, or the timeout (seconds). Returns True if
+        there were relevant events."""
+
+        if not self.inotify:
+            time.sleep(timeout)
+            return False
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            events = self.inotify.read(timeout=int(remaining * 1000))
+            if any([self.is_relevant(event) for event in events]):
+                time.sleep(EVENT_BATCH_DELAY)
+                for event in self.inotify.read(timeout=0):
+                    self.is_relevant(event) # Removes watches of deleted directories
+                return True
@@ -4,7 +4,6 @@
 
 # This script is designed to add the metrics to all previous runs(!)
 
-from interop import py_interop_run_metrics, py_interop_run, py_interop_summary
 import sys
 import re
 import os
@@ -12,6 +11,7 @@ import traceback
 import math
 from genologics.lims import *
 from genologics import config
+from lib import interop_summary
 
 import glob
 lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
@@ -55,18 +55,11 @@ for seq_process in processes:
         run_dir = run_dir_all[0]
         try: # Ignore parsing error, to not disturb the sequencer integrations
 
-            # Parse InterOp data
-            valid_to_load = py_interop_run.uchar_vector(py_interop_run.MetricCount, 0)
-            py_interop_run_metrics.list_summary_metrics_to_load(valid_to_load)
-            valid_to_load[py_interop_run.ExtendedTile] = 1
-            run_metrics = py_interop_run_metrics.run_metrics()
-            run_metrics.read(run_dir, valid_to_load)
-            summary = py_interop_summary.run_summary()
-            py_interop_summary.summarize_run_metrics(run_metrics, summary)
-            extended_tile_metrics = run_metrics.extended_tile_metric_set()
+            # Parse InterOp data, or get the cached summary
+            summary = interop_summary.get_run_summary(run_dir)
 
-            read_count = summary.size()
-            lane_count = summary.lane_count()
+            read_count = len(summary.reads)
+            lane_count = summary.lane_count
 
             if lane_count != len(lane_artifacts):
                 raise RuntimeError("Error: Number of lanes in InterOp data: {}, does not match the number "
@@ -78,21 +71,20 @@ for seq_process in processes:
                 lane_index = lane_number - 1
                 nonindex_read_count = 0
                 for read in range(read_count):
-                    read_data = summary.at(read)
-                    if not read_data.read().is_index():
+                    if not summary.reads[read]['is_index']:
                         read_label = str(nonindex_read_count + 1)
-                        lane_summary = read_data.at(lane_index)
-                        artifact.udf['Yield PF (Gb) R{}'.format(read_label)] = lane_summary.yield_g()
-                        artifact.udf['% Bases >=Q30 R{}'.format(read_label)] = lane_summary.percent_gt_q30()
-                        artifact.udf['Cluster Density (K/mm^2) R{}'.format(read_label)] = lane_summary.density().mean()
-                        artifact.udf['Reads PF (M) R{}'.format(read_label)] = lane_summary.reads_pf() / 1.0e6
-                        artifact.udf['%PF R{}'.format(read_label)] = lane_summary.percent_pf().mean()
-                        artifact.udf['Intensity Cycle 1 R{}'.format(read_label)] = lane_summary.first_cycle_intensity().mean()
-                        artifact.udf['% Error Rate R{}'.format(read_label)] = nan_to_zero(lane_summary.error_rate().mean())
-                        artifact.udf['% Phasing R{}'.format(read_label)] = nan_to_zero(lane_summary.phasing().mean())
-                        artifact.udf['% Prephasing R{}'.format(read_label)] = nan_to_zero(lane_summary.prephasing().mean())
-                        artifact.udf['% Aligned R{}'.format(read_label)] = nan_to_zero(lane_summary.percent_aligned().mean())
-                        artifact.udf['% Occupied Wells'] = nan_to_zero(lane_summary.percent_occupied().mean())
+                        lane_summary = summary.lane(read, lane_index)
+                        artifact.udf['Yield PF (Gb) R{}'.format(read_label)] = lane_summary['yield_g']
+                        artifact.udf['% Bases >=Q30 R{}'.format(read_label)] = lane_summary['percent_gt_q30']
+                        artifact.udf['Cluster Density (K/mm^2) R{}'.format(read_label)] = lane_summary['density']
+                        artifact.udf['Reads PF (M) R{}'.format(read_label)] = lane_summary['reads_pf'] / 1.0e6
+                        artifact.udf['%PF R{}'.format(read_label)] = lane_summary['percent_pf']
+                        artifact.udf['Intensity Cycle 1 R{}'.format(read_label)] = lane_summary['first_cycle_intensity']
+                        artifact.udf['% Error Rate R{}'.format(read_label)] = nan_to_zero(lane_summary['error_rate'])
+                        artifact.udf['% Phasing R{}'.format(read_label)] = nan_to_zero(lane_summary['phasing'])
+                        artifact.udf['% Prephasing R{}'.format(read_label)] = nan_to_zero(lane_summary['prephasing'])
+                        artifact.udf['% Aligned R{}'.format(read_label)] = nan_to_zero(lane_summary['percent_aligned'])
+                        artifact.udf['% Occupied Wells'] = nan_to_zero(lane_summary['percent_occupied'])
                         nonindex_read_count += 1
 
             lims.put_batch(lane_artifacts.values())
@@ -12,8 +12,15 @@ import threading
 import jinja2
 import json
 import time
-from functools import partial, lru_cache
-from collections import defaultdict
+import concurrent.futures
+import contextlib
+import hashlib
+import logging
+import queue
+import sqlite3
+import weakref
+from functools import partial, lru_cache, wraps
+from collections import defaultdict, deque
 
 # Dependencies:
 # mod_wsgi yum package
@@ -33,6 +40,23 @@ from collections import defaultdict
 app = Flask(__name__)
 
 page = None
+# JSON snapshot of the page data, and its ETag (see prepare_snapshot)
+snapshot = None
+snapshot_etag = None
+# Jinja environment, created by run_init
+env = None
+
+# Server-sent event streams, for pushing changes to the open pages. Each stream holds a server
+# thread, so the limit must be below the number of threads in sequencing-overview.conf.
+MAX_ACTIVE_STREAMS = 80
+STREAM_QUEUE_SIZE = 10 # Pending events per stream, a stream that falls behind gets a new snapshot
+KEEPALIVE_INTERVAL = 50 # Seconds between keepalive comments in the event streams
+active_streams = []
+active_streams_lock = threading.Lock()
+
+# Instrumentation of the refresh cycles, see /metrics
+METRICS_HISTORY_LENGTH = 60
+metrics_history = deque(maxlen=METRICS_HISTORY_LENGTH)
 
 # Process type for project eval.
 PROJECT_EVALUATION = "Project Evaluation Step 1.1"
@@ -46,7 +70,30 @@ JOB_STATUS_UDF = "Job status"
 JOB_STATE_CODE_UDF = "Job state code"
 CURRENT_JOB_UDF = "Current job"
 
-recent_run_cache = {}
+# Cache of recently completed runs, shared by all the processes that run the monitor. Set to
+# None to only cache in memory.
+RECENT_RUN_CACHE_FILE = "/var/db/lims/monitor-recent-runs.db"
+# Runs are shown for this many days after processing is completed (see PROCESSED_DATE_UDF)
+RECENT_RUN_DAYS = 30
+recent_run_cache = None
+
+# Incremental refresh: Only processes modified since the last poll are fetched, but all
+# processes are refreshed at this interval (seconds), in case some changes are missed.
+FULL_REFRESH_INTERVAL = 600
+# Overlap between the polls, to account for differences between the clocks (seconds)
+POLL_MARGIN = 120
+
+# The servers are updated in parallel, and the LIMS requests for each server are run on a
+# shared pool of worker threads.
+MAX_WORKERS = 8
+# Default time to wait for a server in each update (seconds). Can be set per server with
+# TIMEOUT in the config file. If the server doesn't respond in time, the results from the
+# last successful update are shown, marked as stale.
+DEFAULT_SERVER_TIMEOUT = 40
+
+query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+server_executor = None
+
 sequencing_process_type = []
 eval_url_base = ""
 template_loc = ""
@@ -64,18 +111,84 @@ class LimsServer(object):
         self.SEQ_FLOWCELL_TYPES = settings['SEQ_FLOWCELL_TYPES']
         self.SEQUENCING = settings['SEQUENCING']
         self.DATA_PROCESSING = settings['DATA_PROCESSING']
+        self.TIMEOUT = settings.get('TIMEOUT', DEFAULT_SERVER_TIMEOUT)
         if settings['CREDENTIALS_FILE']:
             credentials_path = os.path.expanduser(settings['CREDENTIALS_FILE'])
             BASEURI, USERNAME, PASSWORD, VERSION, MAIN_LOG = config.load_config(credentials_path)
             self.lims = Lims(BASEURI, USERNAME, PASSWORD)
         else:
             self.lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
+        # State for incremental refresh, see update_monitored_processes
+        self.monitored_processes = {}   # Process ID => MonitoredProcess
+        self.last_poll = {}             # Process type name => UTC datetime of last query
+        self.last_full_refresh = 0
+        # State for concurrent updates, see update_servers
+        self.update_future = None
+        self.recently_completed = [list() for _ in self.SEQUENCING]
+        self.last_update = None
+        # Instrumentation: Timings and LIMS request counts per phase, for the running update
+        self.phase_stack = []
+        self.phase_metrics = defaultdict(new_phase_metrics)
+        self.metrics_lock = threading.Lock()
+        for method in ['get', 'put', 'post']:
+            setattr(self.lims, method, self.counted_request(getattr(self.lims, method)))
+
+    def counted_request(self, method):
+        """Wrap a Lims request method, to count the requests in the current phase."""
+
+        @wraps(method)
+        def counted(*args, **kwargs):
+            with self.metrics_lock:
+                phase = self.phase_stack[-1] if self.phase_stack else "other"
+                self.phase_metrics[phase]['requests'] += 1
+            return method(*args, **kwargs)
+        return counted
+
+def new_phase_metrics():
+    return {'calls': 0, 'time': 0.0, 'requests': 0}
+
+
+@contextlib.contextmanager
+def phase(server, name):
+    """Record the time spent in a phase of the server update. The LIMS requests made
+    in the phase are counted by LimsServer.counted_request. Phases can be nested, the
+    requests are counted in the innermost phase."""
+
+    with server.metrics_lock:
+        server.phase_stack.append(name)
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        with server.metrics_lock:
+            server.phase_stack.pop()
+            metrics = server.phase_metrics[name]
+            metrics['calls'] += 1
+            metrics['time'] += time.time() - start_time
+
+
+def timed_phase(name):
+    """Decorator for functions taking the server as the first argument, which records
+    the calls as a phase. Used below lru_cache, so that only cache misses are recorded."""
+
+    def decorator(function):
+        @wraps(function)
+        def timed(server, *args, **kwargs):
+            with phase(server, name):
+                return function(server, *args, **kwargs)
+        return timed
+    return decorator
+
 
 servers = []
 # Load dynamic configuration settings from JSON file. This is called at the module level 
 # in the very bottom of this file.
 def run_init(site):
     global servers
+    global server_executor
+    global recent_run_cache
+    global template_loc
+    global env
     configpath = os.path.join(
             os.path.dirname(__file__),
             "config",
@@ -84,6 +197,11 @@ def run_init(site):
     with open(configpath) as f:
         data = json.load(f)
         servers = [LimsServer(i, server) for i, server in enumerate(data['SERVERS'])]
+    server_executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(servers))
+    recent_run_cache = RecentRunCache()
+    # The templates are compiled once, and kept in the environment's cache
+    template_loc = os.path.join(app.root_path, app.template_folder)
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_loc), auto_reload=False)
 
 def get_run_id(process):
     try:
@@ -92,6 +210,7 @@ def get_run_id(process):
         return process.udf.get('RunID', '')
 
 @lru_cache(maxsize=30) # Relevant for monitored processes (open runs)
+@timed_phase("get_sequencing_process")
 def get_sequencing_process(server, process):
     """Gets the sequencing process from a process object corresponing to a process
     which is run after sequencing, such as demultiplexing. This function looks up
@@ -157,14 +276,181 @@ class DataAnalysisInfo(object):
         self.finished = finished
 
 
+class MonitoredProcess(object):
+    """Cached state of a process with the Monitor flag, so the page can be updated
+    incrementally. The fragment is the rendered box for this process, and columns is
+    a list of the instrument columns (on its server) where it is shown."""
+
+    def __init__(self, server, process):
+        self.server = server
+        self.process = process
+        self.step = Step(process.lims, id=process.id)
+        self.is_sequencing = any(process.type_name in ptypes for ptypes in server.SEQUENCING)
+        self.columns = []
+        self.info = None
+        self.fragment = None
+
+    def update(self, boxes):
+        """Read the process and render the box. The process and step should be refreshed
+        before calling update."""
+
+        server = self.server
+        process = self.process
+        if self.is_sequencing:
+            self.columns = [get_instrument_index_for_processtype(server, process.type_name)]
+            self.info = read_sequencing(server, process)
+            self.fragment = boxes.sequencing_box(self.info)
+        else:
+            # lookup sequencing process
+            try:
+                sequencing_process = get_sequencing_process(server, process)
+            except ValueError:
+                sequencing_process = None
+            # Adding post-sequencing processes to the correct column:
+            # One workflow for each sequencer type - loops over all sequencing process type lists, one for each
+            # sequencer type.
+            self.columns = []
+            for seq_id, seq_process_types in enumerate(server.SEQUENCING):
+                # Process this sequencer type, like "MiSeq"
+                if sequencing_process is not None and sequencing_process.type_name in seq_process_types:
+                    self.columns.append(seq_id)
+                elif process.all_inputs()[0].location[0].type.name in server.SEQ_FLOWCELL_TYPES[seq_id]:
+                    self.columns.append(seq_id)
+            self.info = read_post_sequencing_process(server, process, sequencing_process)
+            self.fragment = boxes.post_sequencing_box(self.info)
+
+
 class CompletedRunInfo(object):
-    def __init__(self, url, demultiplexing_url, runid, projects, date, instrument_index):
+    def __init__(self, url, demultiplexing_url, runid, projects, date, instrument_index, flowcell_id):
         self.url = url
         self.demultiplexing_url = demultiplexing_url
         self.runid = runid
         self.projects = projects
         self.date = date
         self.instrument_index = instrument_index
+        self.flowcell_id = flowcell_id
+
+
+class RecentRunCache(object):
+    """Cache of CompletedRunInfo objects, keyed by (server, flowcell ID).
+
+    get_recent_run needs a lot of requests, so the results are stored in an SQLite
+    database, which is shared by all the worker processes and survives restarts. The
+    servers are identified by their base URI. If the database can't be used, the cache
+    is kept in memory."""
+
+    def __init__(self, path=RECENT_RUN_CACHE_FILE):
+        self.lock = threading.Lock()
+        self.memory = {}
+        self.db = None
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+                self.db.execute("PRAGMA journal_mode=WAL")
+                with self.db:
+                    self.db.execute("""CREATE TABLE IF NOT EXISTS recent_run (
+                            baseuri TEXT NOT NULL,
+                            flowcell_id TEXT NOT NULL,
+                            date TEXT NOT NULL,
+                            run_info TEXT NOT NULL,
+                            PRIMARY KEY (baseuri, flowcell_id)
+                            )""")
+            except (OSError, sqlite3.Error) as e:
+                logging.warning("Unable to open recent run cache {}, caching in memory only: {}".format(path, e))
+                self.db = None
+
+    def get(self, server, flowcell_id):
+        key = (server.lims.baseuri, flowcell_id)
+        with self.lock:
+            run_info = self.memory.get(key)
+            if run_info is None and self.db:
+                try:
+                    row = self.db.execute("SELECT run_info FROM recent_run WHERE baseuri = ? AND flowcell_id = ?",
+                            key).fetchone()
+                except sqlite3.Error as e:
+                    logging.warning("Error reading recent run cache: {}".format(e))
+                    row = None
+                if row:
+                    run_info = completed_run_info_from_json(row[0], flowcell_id)
+                    self.memory[key] = run_info
+        return run_info
+
+    def put(self, server, flowcell_id, run_info):
+        key = (server.lims.baseuri, flowcell_id)
+        with self.lock:
+            self.memory[key] = run_info
+            if self.db:
+                try:
+                    with self.db:
+                        self.db.execute("INSERT OR REPLACE INTO recent_run (baseuri, flowcell_id, date, run_info) "
+                                "VALUES (?, ?, ?, ?)", key + (str(run_info.date), completed_run_info_to_json(run_info)))
+                except sqlite3.Error as e:
+                    logging.warning("Error writing recent run cache: {}".format(e))
+
+    def delete(self, server, flowcell_id):
+        key = (server.lims.baseuri, flowcell_id)
+        with self.lock:
+            self.memory.pop(key, None)
+            if self.db:
+                try:
+                    with self.db:
+                        self.db.execute("DELETE FROM recent_run WHERE baseuri = ? AND flowcell_id = ?", key)
+                except sqlite3.Error as e:
+                    logging.warning("Error writing recent run cache: {}".format(e))
+
+    def retain(self, server, flowcell_ids):
+        """Remove the runs of server whose flowcell ID is not in flowcell_ids, i.e. the
+        flowcells that no longer have the Recently completed flag."""
+
+        flowcell_ids = set(flowcell_ids)
+        with self.lock:
+            for key in list(self.memory):
+                if key[0] == server.lims.baseuri and key[1] not in flowcell_ids:
+                    del self.memory[key]
+            if self.db:
+                try:
+                    rows = self.db.execute("SELECT flowcell_id FROM recent_run WHERE baseuri = ?",
+                            (server.lims.baseuri,)).fetchall()
+                    with self.db:
+                        self.db.executemany("DELETE FROM recent_run WHERE baseuri = ? AND flowcell_id = ?",
+                                [(server.lims.baseuri, row[0]) for row in rows if row[0] not in flowcell_ids])
+                except sqlite3.Error as e:
+                    logging.warning("Error writing recent run cache: {}".format(e))
+
+    def expire(self, cutoff_date):
+        """Remove all runs completed on or before cutoff_date."""
+
+        with self.lock:
+            for key, run_info in list(self.memory.items()):
+                if run_info.date <= cutoff_date:
+                    del self.memory[key]
+            if self.db:
+                try:
+                    with self.db:
+                        self.db.execute("DELETE FROM recent_run WHERE date <= ?", (str(cutoff_date),))
+                except sqlite3.Error as e:
+                    logging.warning("Error writing recent run cache: {}".format(e))
+
+
+def completed_run_info_to_json(run_info):
+    data = dict(vars(run_info))
+    data['projects'] = [vars(project) for project in run_info.projects]
+    data['date'] = str(run_info.date)
+    return json.dumps(data)
+
+
+def completed_run_info_from_json(run_info_json, flowcell_id):
+    data = json.loads(run_info_json)
+    return CompletedRunInfo(
+            data['url'],
+            data['demultiplexing_url'],
+            data['runid'],
+            [Project(**project) for project in data['projects']],
+            datetime.datetime.strptime(data['date'], "%Y-%m-%d").date(),
+            data['instrument_index'],
+            flowcell_id
+            )
 
 
 def clear_monitor(completed):
@@ -230,6 +516,7 @@ def read_project(server, lims_project):
     return Project(url, lims_project.name, eval_url, tag)
 
 @lru_cache(maxsize=30*4) # Relevant for all processes x lanes, but "recently completed" is already cached
+@timed_phase("get_projects_for_artifacts")
 def get_projects_for_artifacts(server, artifacts):
     return set(
         sample.project
@@ -239,6 +526,7 @@ def get_projects_for_artifacts(server, artifacts):
         )
 
 @lru_cache(maxsize=15) # Cache project lists, because it's prone to getting invalid results
+@timed_phase("get_projects")
 def get_projects(server, process):
     lims_projects = []
     for attempt in range(3): 
@@ -470,160 +758,410 @@ def get_recent_run(server, fc):
             runid,
             list(projects),
             fc.udf[PROCESSED_DATE_UDF],
-            instrument_index
+            instrument_index,
+            fc.id
             )
     
 
 
-def get_recently_completed_runs(servers):
-    all_results = []
-    for server in servers:
-        # Look for any flowcells which have a value for this udf
-        flowcells = server.lims.get_containers(
-                udf={RECENTLY_COMPLETED_UDF: True},
-                type=[fctype for seq_fcs in server.SEQ_FLOWCELL_TYPES for fctype in seq_fcs]
-                )
+def get_recently_completed_runs(server):
+    # Look for any flowcells which have a value for this udf
+    flowcells = server.lims.get_containers(
+            udf={RECENTLY_COMPLETED_UDF: True},
+            type=[fctype for seq_fcs in server.SEQ_FLOWCELL_TYPES for fctype in seq_fcs]
+            )
 
-        cutoff_date = datetime.date.today() - datetime.timedelta(days=30)
-        server_results = [list() for i in range(len(server.SEQUENCING))]
-        for fc in reversed(flowcells):
+    cutoff_date = datetime.date.today() - datetime.timedelta(days=RECENT_RUN_DAYS)
+    cache = recent_run_cache
+    cache.expire(cutoff_date)
+    cache.retain(server, [fc.id for fc in flowcells])
+    server_results = [list() for i in range(len(server.SEQUENCING))]
+    for fc in reversed(flowcells):
+        try:
+            date = fc.udf[PROCESSED_DATE_UDF]
+        except KeyError:
+            fc.get(force=True)
             try:
                 date = fc.udf[PROCESSED_DATE_UDF]
             except KeyError:
-                fc.get(force=True)
-                try:
-                    date = fc.udf[PROCESSED_DATE_UDF]
-                except KeyError:
-                    # Set a date (Necessary for SeqLab, can't hook into the Sequence process)
-                    fc.udf[PROCESSED_DATE_UDF] = datetime.date.today()
-                    fc.put()
-
-            if date <= cutoff_date:
-                try:
-                    del recent_run_cache[(server, fc.id)]
-                except KeyError:
-                    pass
-                fc.get(force=True)
-                fc.udf[RECENTLY_COMPLETED_UDF] = False
+                # Set a date (Necessary for SeqLab, can't hook into the Sequence process)
+                fc.udf[PROCESSED_DATE_UDF] = datetime.date.today()
                 fc.put()
-            else:
-                run_info = recent_run_cache.get((server, fc.id))
-                if not run_info:
-                    run_info = get_recent_run(server, fc)
-                    recent_run_cache[(server, fc.id)] = run_info
 
-                server_results[run_info.instrument_index].append(run_info)
+        if date <= cutoff_date:
+            cache.delete(server, fc.id)
+            fc.get(force=True)
+            fc.udf[RECENTLY_COMPLETED_UDF] = False
+            fc.put()
+        else:
+            run_info = cache.get(server, fc.id)
+            if not run_info:
+                run_info = get_recent_run(server, fc)
+                cache.put(server, fc.id, run_info)
+
+            server_results[run_info.instrument_index].append(run_info)
 
-        all_results += server_results
-        
-    return all_results
+    return server_results
 
 
 def refresh(instances):
     """Refresh all instances.
     
-    This could be replaced by a few batch calls if that becomes available for Process / Step."""
-    for instance in instances:
-        instance.get(force=True)
+    This could be replaced by a few batch calls if that becomes available for Process / Step.
+    The requests are run in parallel on the query_executor pool."""
+    instances = list(instances)
+    for _ in query_executor.map(lambda instance: instance.get(force=True), instances):
+        pass
     return instances
 
 
+def get_monitored_processes(server, ptype, since):
+    """Get the processes of a type which have the Monitor flag set.
+
+    Returns the list of all monitored processes, and the set of IDs of processes which were
+    modified after since (UTC datetime). If since is None, the set is None, meaning that all
+    processes should be considered modified."""
+
+    processes = server.lims.get_processes(udf={'Monitor': True}, type=ptype)
+    if since is None:
+        modified_ids = None
+    else:
+        modified = server.lims.get_processes(
+                udf={'Monitor': True},
+                type=ptype,
+                last_modified=(since - datetime.timedelta(seconds=POLL_MARGIN)).strftime("%Y-%m-%dT%H:%M:%SZ")
+                )
+        modified_ids = set(p.id for p in modified)
+    return processes, modified_ids
+
+
+def update_monitored_processes(server, boxes):
+    """Update the cached state of the monitored processes on a server.
+
+    The list of monitored processes is queried on each update, but only new processes and
+    processes modified since the last update are fetched and re-rendered. Each
+    FULL_REFRESH_INTERVAL, all processes are fetched."""
+
+    full_refresh = time.time() - server.last_full_refresh > FULL_REFRESH_INTERVAL
+    poll_start_time = datetime.datetime.utcnow()
+    poll_times = {}
+
+    # The process types are queried in parallel
+    ptypes = sum(server.SEQUENCING, []) + server.DATA_PROCESSING
+    with phase(server, "get_processes"):
+        results = list(query_executor.map(
+                lambda ptype: get_monitored_processes(server, ptype, None if full_refresh else server.last_poll.get(ptype)),
+                ptypes
+                ))
+
+    monitored = {}
+    changed = []
+    for ptype, (processes, modified_ids) in zip(ptypes, results):
+        poll_times[ptype] = poll_start_time
+        for process in processes:
+            entry = server.monitored_processes.get(process.id)
+            if entry is None:
+                entry = MonitoredProcess(server, process)
+                changed.append(entry)
+            elif modified_ids is None or process.id in modified_ids:
+                changed.append(entry)
+            monitored[process.id] = entry
+
+    # Refresh data for the changed processes, and the Steps to see if COMPLETED
+    with phase(server, "refresh(processes)"):
+        refresh(entry.process for entry in changed)
+    with phase(server, "refresh(steps)"):
+        refresh(entry.step for entry in changed)
+
+    completed = [entry for entry in changed if is_step_completed(entry.step)]
+    with phase(server, "clear_monitor"):
+        clear_monitor(entry.process for entry in completed)
+    for entry in completed:
+        del monitored[entry.process.id]
+
+    with phase(server, "read_processes"):
+        for entry in changed:
+            if entry.process.id in monitored:
+                entry.update(boxes)
+
+    # Only save the new state after all the processes are updated successfully
+    server.monitored_processes = monitored
+    server.last_poll.update(poll_times)
+    if full_refresh:
+        server.last_full_refresh = time.time()
+
+
+def update_server(server, boxes):
+    """Update all the data shown for one server. This is run in a background thread, and the
+    state of the server is only updated when the data has been fetched successfully."""
+
+    with server.metrics_lock:
+        server.phase_metrics = defaultdict(new_phase_metrics)
+    with phase(server, "total"):
+        update_monitored_processes(server, boxes)
+        with phase(server, "get_recently_completed_runs"):
+            server.recently_completed = get_recently_completed_runs(server)
+    server.last_update = datetime.datetime.now()
+
+
+def update_servers(boxes):
+    """Update all servers in parallel, waiting at most TIMEOUT seconds for each server.
+
+    If a server isn't finished in time, its update continues in the background, and a
+    new update isn't started until it finishes. The page then shows the last data from
+    this server, which is marked as stale. Returns a list of the stale servers."""
+
+    start_time = time.time()
+    for server in servers:
+        if server.update_future is None or server.update_future.done():
+            server.update_future = server_executor.submit(update_server, server, boxes)
+
+    stale = []
+    for server in servers:
+        try:
+            server.update_future.result(timeout=max(0, start_time + server.TIMEOUT - time.time()))
+        except concurrent.futures.TimeoutError:
+            stale.append(server)
+        except Exception:
+            # Show the error if there is no old data to fall back to
+            if server.last_update is None:
+                raise
+            stale.append(server)
+    return stale
+
+
+def get_last_update_text(server):
+    if server.last_update:
+        return server.last_update.strftime("%Y-%m-%d %H:%M:%S")
+    else:
+        return "never"
+
+
+def get_cache_stats():
+    """Get the hit counts of the lru_caches, cumulative since the start of the process."""
+
+    stats = {}
+    for function in [get_projects, get_projects_for_artifacts, get_sequencing_process]:
+        info = function.cache_info()
+        lookups = info.hits + info.misses
+        stats[function.__name__] = {
+                'hits': info.hits,
+                'misses': info.misses,
+                'hit_rate': info.hits / lookups if lookups else None,
+                'size': info.currsize,
+                'maxsize': info.maxsize
+                }
+    return stats
+
+
+def record_cycle_metrics(start_time, stale_servers, render_time, error=None):
+    """Add an entry for the last refresh cycle to the metrics history. The cache hits
+    and misses are given for this cycle, by subtracting the previous cumulative counts."""
+
+    cache_stats = get_cache_stats()
+    previous_stats = metrics_history[-1]['caches'] if metrics_history else {}
+    for name, stats in cache_stats.items():
+        previous = previous_stats.get(name, {'total_hits': 0, 'total_misses': 0})
+        stats['total_hits'], stats['total_misses'] = stats['hits'], stats['misses']
+        stats['hits'] -= previous['total_hits']
+        stats['misses'] -= previous['total_misses']
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else None
+
+    server_metrics = []
+    for server in servers:
+        with server.metrics_lock:
+            phases = {name: dict(metrics) for name, metrics in server.phase_metrics.items()}
+        server_metrics.append({
+                'index': server.index,
+                'baseuri': server.lims.baseuri,
+                'stale': server in stale_servers,
+                # For stale servers, the phases are from the running update
+                'phases': phases,
+                'requests': sum(metrics['requests'] for metrics in phases.values())
+                })
+    metrics_history.append({
+            'start': datetime.datetime.fromtimestamp(start_time).strftime("%Y-%m-%d %H:%M:%S"),
+            'duration': time.time() - start_time,
+            'render_time': render_time,
+            'error': error,
+            'servers': server_metrics,
+            'caches': cache_stats
+            })
+
+
+def get_rows(server, boxes, column_offset):
+    """Get the boxes shown for a server as a list of rows for the snapshot. Each row is a
+    dict with a unique ID, the section and the (global) columns where it is shown, the data
+    and the rendered box. A post-sequencing process may be shown in multiple columns."""
+
+    rows = []
+    for entry in server.monitored_processes.values():
+        rows.append({
+            'id': "{}-{}".format(server.index, entry.process.id),
+            'section': 'sequencing' if entry.is_sequencing else 'post_sequencing',
+            'columns': [column_offset + column for column in entry.columns],
+            'data': entry.info,
+            'html': str(entry.fragment)
+            })
+    for column, runs in enumerate(server.recently_completed):
+        for run_info in runs:
+            rows.append({
+                # The run ID may be empty if it's not found, so use the flowcell (container) ID
+                'id': "{}-{}".format(server.index, run_info.flowcell_id),
+                'section': 'recently_completed',
+                'columns': [column_offset + column],
+                'data': run_info,
+                'html': str(boxes.completed_box(run_info))
+                })
+    return rows
+
+
+def to_json_value(value):
+    """Convert the info objects and dates in the snapshot for json.dumps."""
+
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return str(value)
+    return vars(value)
+
+
+def prepare_snapshot(boxes, stale_servers):
+    """Build a JSON-compatible snapshot of the data on the page. The ETag only depends on
+    the content, not the update time, so it changes only when something on the page
+    changes."""
+
+    rows = []
+    stale = []
+    column_offset = 0
+    for server in servers:
+        rows += get_rows(server, boxes, column_offset)
+        column_offset += len(server.INSTRUMENTS)
+        stale += [get_last_update_text(server) if server in stale_servers else None] * len(server.INSTRUMENTS)
+
+    # Round trip through JSON, to get plain dicts and lists
+    content = json.loads(json.dumps({
+            'instruments': sum((server.INSTRUMENTS for server in servers), []),
+            'stale': stale,
+            'rows': rows
+            }, default=to_json_value))
+    etag = hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+    content['updated'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    content['etag'] = etag
+    return content, etag
+
+
+def get_columns(snapshot, section):
+    """Get the rows of a section, with one list of rows per instrument column."""
+
+    columns = [list() for _ in snapshot['instruments']]
+    for row in snapshot['rows']:
+        if row['section'] == section:
+            for column in row['columns']:
+                columns[column].append(row)
+    return columns
+
+
+def get_changes(old_snapshot, new_snapshot):
+    """Get the changes between two snapshots, for pushing to the open pages. Contains the
+    new and changed rows, and the IDs of removed rows."""
+
+    old_rows = {row['id']: row for row in old_snapshot['rows']} if old_snapshot else {}
+    new_ids = set(row['id'] for row in new_snapshot['rows'])
+    return {
+            'updated': new_snapshot['updated'],
+            'etag': new_snapshot['etag'],
+            'stale': new_snapshot['stale'],
+            'changed': [row for row in new_snapshot['rows'] if old_rows.get(row['id']) != row],
+            'removed': [row_id for row_id in old_rows if row_id not in new_ids]
+            }
+
+
 def prepare_page():
     global page
+    global snapshot
+    global snapshot_etag
 
+    start_time = time.time()
+    stale_servers = []
+    render_start_time = None
     try:
-        servers_seq_process_types = [
-            (server, proctypes) for server in servers for proctypes in server.SEQUENCING]
-
-        servers_data_process_types = [
-            (server, [proctype]) for server in servers for proctype in server.DATA_PROCESSING]
-
-        all_servers_process_types = servers_seq_process_types + servers_data_process_types
-
-        # Get a list of all processes 
-        # Of course it can't be this efficient :( Multiple process types not supported
-        #monitored_process_list = lims.get_processes(udf={'Monitor': True}, type=all_process_types)
-        monitored_process_list = []
-        for server, ptypes in all_servers_process_types:
-            monitored_process_list += [ (server, proc)
-                            for ptype in ptypes
-                            for proc in server.lims.get_processes(udf={'Monitor': True}, type=ptype)
-                            ]
-
-        # Refresh data for all processes (need this for almost all monitored procs, so
-        # doing a batch request)
-        refresh(proc for server, proc in monitored_process_list)
-
-        # Need Steps to see if COMPLETED, this loads them into cache
-        steps = [Step(s.lims, id=p.id) for s, p in monitored_process_list]
-        refresh(steps)
-
-        seq_processes = defaultdict(list)
-        post_processes = []
-        completed = []
-        for (server, p), step in zip(monitored_process_list, steps):
-            if any(p.type_name in ptypes for ptypes in server.SEQUENCING):
-                if is_step_completed(step):
-                    completed.append(p)
-                else:
-                    seq_processes[p.type_name].append(p)
-
-            else:
-                if is_step_completed(step):
-                    completed.append(p)
-                else:
-                    post_processes.append((server,p))
-
-        clear_monitor(completed)
-
-        # List of one element per (server, machine type)
-        sequencing = [
-            [read_sequencing(server, proc) 
-                for sp in sptypes
-                for proc in seq_processes[sp] ]
-                for (server, sptypes) in servers_seq_process_types
-            ]
-
-
-        # This list contains one item for each sequencer type, and each item is a list of processses
-        # These are the Demultiplexing and QC processes.
-        post_sequencing = [list() for _ in servers_seq_process_types] # all processes for a type of sequencing machine
-
-        # Adding post-sequencing processes to the correct column:
-        # One workflow for each sequencer type - loops over all sequencing process type lists, one for each
-        # sequencer type and for each server (if applicable).
-        for (server, process) in post_processes:
-            # lookup sequencing process
-            try:
-                sequencing_process = get_sequencing_process(server, process)
-            except ValueError:
-                sequencing_process = None
-            for seq_id, (seqtype_server, seq_process_types) in enumerate(servers_seq_process_types):
-                # Process this sequencer type, like "MiSeq"
-                if sequencing_process is not None and sequencing_process.type_name in seq_process_types:
-                    post_sequencing[seq_id].append(read_post_sequencing_process(server, process, sequencing_process))
-                elif process.all_inputs()[0].location[0].type.name in server.SEQ_FLOWCELL_TYPES[seq_id]:
-                    post_sequencing[seq_id].append(read_post_sequencing_process(server, process, None))
+        boxes = env.get_template('boxes.xhtml').module
 
-        recently_completed = get_recently_completed_runs(servers)
+        stale_servers = update_servers(boxes)
 
+        render_start_time = time.time()
+        new_snapshot, new_etag = prepare_snapshot(boxes, stale_servers)
 
         variables = {
                 'updated': datetime.datetime.now(),
                 'static': 'STATIC_URL_PLACEHOLDER!',
-                'sequencing': sequencing,
-                'post_sequencing': post_sequencing,
-                'recently_completed': recently_completed,
-                'instruments': sum((server.INSTRUMENTS for server in servers), [])
+                # List of one element per (server, machine type)
+                'sequencing': get_columns(new_snapshot, 'sequencing'),
+                # This list contains one item for each sequencer type, and each item is a list of processses
+                # These are the Demultiplexing and QC processes.
+                'post_sequencing': get_columns(new_snapshot, 'post_sequencing'),
+                'recently_completed': get_columns(new_snapshot, 'recently_completed'),
+                'instruments': new_snapshot['instruments'],
+                'stale': new_snapshot['stale'],
+                'etag': new_etag
                 }
-        page = jinja2.Environment(
-                loader=jinja2.FileSystemLoader(template_loc)
-                ).get_template('processes.xhtml').render(variables)
+        page = env.get_template('processes.xhtml').render(variables)
+
+        changes = get_changes(snapshot, new_snapshot)
+        snapshot, snapshot_etag = new_snapshot, new_etag
+        publish_event("update", changes)
+        record_cycle_metrics(start_time, stale_servers, time.time() - render_start_time)
 
     except:
         page = traceback.format_exc()
+        record_cycle_metrics(start_time, stale_servers, None, page)
     threading.Timer(60, prepare_page).start()
-    
+
+
+class EventStream(object):
+    """Generator of server-sent events for one client. The events are put in a bounded
+    queue by publish_event. If the client doesn't keep up and the queue is full, the pending
+    updates are dropped, and the client gets the current snapshot instead. A keepalive
+    comment is sent if there are no events for KEEPALIVE_INTERVAL seconds."""
+
+    RESYNC = object()
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            ident, data = self.queue.get(block=True, timeout=KEEPALIVE_INTERVAL)
+        except queue.Empty:
+            return ": keepalive\n\n"
+        if ident is self.RESYNC:
+            ident, data = "snapshot", json.dumps(snapshot)
+        return "event: " + ident + "\n" + "data: " + data + "\n\n"
+
+    def put(self, ident, data):
+        try:
+            self.queue.put_nowait((ident, data))
+        except queue.Full:
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            self.queue.put_nowait((self.RESYNC, None))
+
+
+def publish_event(ident, data):
+    """Send an event to all open streams. The data are only JSON encoded once."""
+
+    global active_streams
+    data_json = json.dumps(data)
+    with active_streams_lock:
+        active_streams = [stream_ref for stream_ref in active_streams if stream_ref() is not None]
+        for stream_ref in active_streams:
+            stream = stream_ref()
+            if stream is not None:
+                stream.put(ident, data_json)
+
 
 def process_type_to_instrument(server, process_type):
     for pt, inst in zip(server.SEQUENCING, server.INSTRUMENTS):
@@ -636,20 +1174,65 @@ def process_type_to_instrument(server, process_type):
 def get_main():
     global page
     global eval_url_base
-    global template_loc
 
     eval_url_base = url_for('go_eval')
     # The URL may vary from request to request, so we can't put it in the "page" string. Instead use a
     # placeholder.
     static_url = request.url + "static"
-    template_loc = os.path.join(app.root_path, app.template_folder)
 
     if not request.url.endswith("/"):
         return redirect(request.url + '/')
 
     if not page:
         prepare_page()
-    return (page.replace('STATIC_URL_PLACEHOLDER!', static_url), 200, {'Refresh': '60'})
+    # The page is updated by server-sent events, see /events
+    return page.replace('STATIC_URL_PLACEHOLDER!', static_url)
+
+
+@app.route('/snapshot.json')
+def get_snapshot():
+    """Get the data shown on the page as JSON. Supports conditional requests with
+    If-None-Match, using an ETag which only changes when the data change."""
+
+    if snapshot is None:
+        return Response("Not yet loaded", status=503, mimetype="text/plain")
+    if request.if_none_match.contains(snapshot_etag):
+        return Response(status=304, headers={'ETag': '"{}"'.format(snapshot_etag)})
+    response = Response(json.dumps(snapshot), mimetype="application/json")
+    response.set_etag(snapshot_etag)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """Timings of the last refresh cycles, per server and phase, with the number of LIMS
+    requests in each phase, and the lru_cache hit rates. The newest cycle is last."""
+
+    return Response(
+            json.dumps({'cycles': list(metrics_history), 'caches': get_cache_stats()}, indent=2),
+            mimetype="application/json"
+            )
+
+
+@app.route('/events')
+def events():
+    """Stream of changes to the page. The client first receives the full snapshot, then an
+    update event with the changed and removed rows after each refresh. Each stream holds a
+    server thread, so there are at most MAX_ACTIVE_STREAMS. Further clients get status 503,
+    and poll snapshot.json instead (see overview.js)."""
+
+    global active_streams
+    stream = EventStream()
+    with active_streams_lock:
+        active_streams = [stream_ref for stream_ref in active_streams if stream_ref() is not None]
+        if len(active_streams) >= MAX_ACTIVE_STREAMS:
+            return Response("Too many open event streams", status=503, mimetype="text/plain",
+                    headers={'Retry-After': '600'})
+        active_streams.append(weakref.ref(stream))
+    # Send initial status
+    if snapshot is not None:
+        stream.put("snapshot", json.dumps(snapshot))
+    return Response(stream, mimetype="text/event-stream", headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/go-eval')
@@ -0,0 +1,141 @@
+// Live updates for the overview page. The server pushes the changed boxes as
+// server-sent events, see /events in main.py.
+
+(function () {
+
+function parseHtml(html) {
+	var container = document.createElement('div');
+	container.innerHTML = html;
+	return container;
+}
+
+function getCell(section, column) {
+	return document.querySelector('td[data-section="' + section + '"][data-column="' + column + '"]');
+}
+
+function removeRow(rowId) {
+	var elements = document.querySelectorAll('div[data-row="' + rowId + '"]');
+	for (var i = 0; i < elements.length; i++) {
+		elements[i].parentNode.removeChild(elements[i]);
+	}
+}
+
+function updateRow(row) {
+	// Replace the box in place if it's already in the column, otherwise add it at the end.
+	var old = {};
+	var elements = document.querySelectorAll('div[data-row="' + row.id + '"]');
+	for (var i = 0; i < elements.length; i++) {
+		old[elements[i].parentNode.getAttribute('data-section') + '/' +
+			elements[i].parentNode.getAttribute('data-column')] = elements[i];
+	}
+	for (var j = 0; j < row.columns.length; j++) {
+		var key = row.section + '/' + row.columns[j];
+		var element = parseHtml(row.html);
+		element.setAttribute('data-row', row.id);
+		if (old[key]) {
+			old[key].parentNode.replaceChild(element, old[key]);
+			delete old[key];
+		}
+		else {
+			var cell = getCell(row.section, row.columns[j]);
+			if (cell) cell.appendChild(element);
+		}
+	}
+	for (var k in old) {
+		old[k].parentNode.removeChild(old[k]);
+	}
+}
+
+function updateHeader(update) {
+	document.getElementById('updated').textContent = update.updated;
+	document.body.setAttribute('data-etag', update.etag);
+	var headers = document.querySelectorAll('th[data-column]');
+	for (var i = 0; i < headers.length; i++) {
+		var stale = update.stale[parseInt(headers[i].getAttribute('data-column'))];
+		if (stale) {
+			headers[i].className = 'main stale';
+			headers[i].title = 'LIMS server not responding. Last updated: ' + stale + '.';
+		}
+		else {
+			headers[i].className = 'main';
+			headers[i].removeAttribute('title');
+		}
+	}
+}
+
+function applyUpdate(update) {
+	for (var i = 0; i < update.removed.length; i++) {
+		removeRow(update.removed[i]);
+	}
+	for (var j = 0; j < update.changed.length; j++) {
+		updateRow(update.changed[j]);
+	}
+	updateHeader(update);
+}
+
+function applySnapshot(snapshot) {
+	// Sent when connecting. Only needed if the page is older than the snapshot.
+	if (snapshot.etag === document.body.getAttribute('data-etag')) {
+		updateHeader(snapshot);
+		return;
+	}
+	var current = {};
+	for (var i = 0; i < snapshot.rows.length; i++) {
+		current[snapshot.rows[i].id] = true;
+	}
+	var removed = [];
+	var elements = document.querySelectorAll('div[data-row]');
+	for (var j = 0; j < elements.length; j++) {
+		var rowId = elements[j].getAttribute('data-row');
+		if (!current[rowId]) removed.push(rowId);
+	}
+	snapshot.removed = removed;
+	snapshot.changed = snapshot.rows;
+	applyUpdate(snapshot);
+}
+
+// Used if the server has too many open event streams (status 503)
+var POLL_INTERVAL = 60000;
+var POLLS_BEFORE_RECONNECT = 10;
+
+function poll(remaining) {
+	if (remaining === 0) {
+		connect();
+		return;
+	}
+	var request = new XMLHttpRequest();
+	request.open('GET', 'snapshot.json');
+	var etag = document.body.getAttribute('data-etag');
+	if (etag) request.setRequestHeader('If-None-Match', '"' + etag + '"');
+	request.onload = function () {
+		if (request.status === 200) applySnapshot(JSON.parse(request.responseText));
+	};
+	request.send();
+	setTimeout(function () { poll(remaining - 1); }, POLL_INTERVAL);
+}
+
+function connect() {
+	if (!window.EventSource) {
+		// No live updates, reload the page instead
+		setTimeout(function () { window.location.reload(); }, 60000);
+		return;
+	}
+	var source = new EventSource('events');
+	source.addEventListener('snapshot', function (event) {
+		applySnapshot(JSON.parse(event.data));
+	});
+	source.addEventListener('update', function (event) {
+		applyUpdate(JSON.parse(event.data));
+	});
+	source.addEventListener('error', function () {
+		// The browser reconnects by itself after network errors, but not after an error
+		// status. Then poll for a while, and try again.
+		if (source.readyState === EventSource.CLOSED) {
+			setTimeout(function () { poll(POLLS_BEFORE_RECONNECT); }, POLL_INTERVAL);
+		}
+	});
+}
+
+window.addEventListener('load', connect);
+
+})();
@@ -4,6 +4,8 @@ import os
 import sys
 
 import lib.demultiplexing
+import lib.index_collisions
+import lib.reagent_catalogue
 from genologics import config
 from genologics.lims import *
 
@@ -16,37 +18,26 @@ def get_index_sequences(lims, reagent_label_list):
     """Convert reagent label names (strings) into tuples of (index1, index2) by looking up the sequences
     in LIMS. Empty strings are used if there is no index."""
 
-    logging.info("Retrieving index sequences from LIMS API.")
-
-    # First retrieve all reagent labels, using batches to avoid URL size limit
-    reagent_types = []
-    BATCH_SIZE = 100
-    for batch_start in range(0, len(reagent_label_list), BATCH_SIZE):
-        reagent_types += lims.get_reagent_types(
-            name=[
-                name
-                for name in reagent_label_list[batch_start : (batch_start + BATCH_SIZE)]
-                if name
-            ]
-        )
-
-    # This will fetch all reagent types from API one by one, by querying for the "name" property
-    reagent_type_map = {rt.name: rt for rt in reagent_types}
+    # The sequences are looked up in the local reagent catalogue, which is only refreshed from
+    # LIMS if a reagent label is not found.
+    logging.info("Looking up index sequences in the reagent catalogue.")
+    reagent_catalogue = lib.reagent_catalogue.get_reagent_catalogue(lims)
 
     result_index_list = []
     for reagent_label in reagent_label_list:
         if not reagent_label:
             result_index_list.append(("", ""))
         else:
-            if reagent_label in reagent_type_map:
-                seq_parts = reagent_type_map[reagent_label].sequence.split("-")
+            reagent_type = reagent_catalogue.get(reagent_label)
+            if reagent_type:
+                seq_parts = reagent_type.sequence.split("-")
                 if len(seq_parts) == 1:  # Single index
                     result_index_list.append((seq_parts[0], ""))
                 elif len(seq_parts) == 2:  # Dual index
                     result_index_list.append(tuple(seq_parts))
                 else:
                     raise ValueError(
-                        f"Reagent type {reagent_label} has malformed sequence in LIMS: {reagent_type_map[reagent_label].sequence}."
+                        f"Reagent type {reagent_label} has malformed sequence in LIMS: {reagent_type.sequence}."
                     )
             else:
                 raise ValueError(
@@ -56,14 +47,6 @@ def get_index_sequences(lims, reagent_label_list):
     return result_index_list
 
 
-def hamming_distance(seq1, seq2):
-    """Hamming distance between two strings.
-    
-    If the length is different, only the shortest length with be used for distances."""
-
-    return sum(c1 != c2 for c1, c2 in zip(seq1, seq2))
-
-
 def check_indexes_main(process, check_index_1, check_index_2):
 
     logging.info(f"Checking indexes config: index1: {check_index_1}, index2: {check_index_2}")
@@ -78,12 +61,14 @@ def check_indexes_main(process, check_index_1, check_index_2):
 
     failing_pools = {}
 
+    # Get the demux endpoint for all pools and process the XML entities, fetching the samples in batch
+    # Getting a dict of {pool_artifact_id: [(sample, artifact, reagent_label_name), ...]}
+    pool_demux_lists = lib.demultiplexing.get_demux_artifacts(lims, pool_artifacts)
+
     for pool_artifact in sorted( pool_artifacts, key=lambda artifact: artifact.location[1][0]):
         logging.info(f"Processing pool {pool_artifact.name}.")
 
-        # Get the demux endpoint for this pool and process the XML entities
-        # Getting a list of [(sample, artifact, reagent_label_name), ...]
-        demux_list = lib.demultiplexing.get_demux_artifact(lims, pool_artifact)
+        demux_list = pool_demux_lists[pool_artifact.id]
 
         # Convert reagent label name into a tuple of (index1, index2) sequences
         index_pairs = get_index_sequences(
@@ -93,24 +78,25 @@ def check_indexes_main(process, check_index_1, check_index_2):
         # (name, (index1, index2))
         sample_index_tuples = list(zip(sample_names, index_pairs))
         
-        # Compute all against all distances
-        for i, (name, indexes) in enumerate(sample_index_tuples):
-            for other_name, other_indexes in sample_index_tuples[i + 1 :]:
-                per_index_mismatches = []
-                for index_read in check_index_reads:
-                    index_seq = indexes[index_read - 1]
-                    other_index_seq = other_indexes[index_read - 1]
-                    per_index_mismatches.append((index_read, index_seq, other_index_seq, hamming_distance(index_seq, other_index_seq)))
-                if all(mm < MINIMUM_MISMATCH_THRESHOLD for _, _, _, mm in per_index_mismatches):
-                    logging.error(f"Pool {pool_artifact.name}: Insufficient mismatches for sample '{name}' and '{other_name}' "
-                                    f"(threshold = {MINIMUM_MISMATCH_THRESHOLD}).")
-                    for index_read, index_seq, other_index_seq, mm in per_index_mismatches: 
-                        status = "FAIL" if mm < MINIMUM_MISMATCH_THRESHOLD else "OK"
-                        logging.error(f"Index read {index_read}: sample '{name}': '{index_seq}', "
-                                        f"sample '{other_name}': '{other_index_seq}', "
-                                        f"mismatches: {mm}, "
-                                        f"status: {status}")
-                    failing_pools[pool_artifact.id] = pool_artifact.name
+        # Compute all against all distances. Samples collide if all the checked index reads
+        # have insufficient mismatches.
+        collisions = lib.index_collisions.find_collisions(
+            index_pairs, MINIMUM_MISMATCH_THRESHOLD, reads=check_index_reads
+        )
+        for i, j, per_index_mismatches in collisions:
+            name, indexes = sample_index_tuples[i]
+            other_name, other_indexes = sample_index_tuples[j]
+            logging.error(f"Pool {pool_artifact.name}: Insufficient mismatches for sample '{name}' and '{other_name}' "
+                            f"(threshold = {MINIMUM_MISMATCH_THRESHOLD}).")
+            for index_read, mm in zip(check_index_reads, per_index_mismatches):
+                index_seq = indexes[index_read - 1]
+                other_index_seq = other_indexes[index_read - 1]
+                status = "FAIL" if mm < MINIMUM_MISMATCH_THRESHOLD else "OK"
+                logging.error(f"Index read {index_read}: sample '{name}': '{index_seq}', "
+                                f"sample '{other_name}': '{other_index_seq}', "
+                                f"mismatches: {mm}, "
+                                f"status: {status}")
+            failing_pools[pool_artifact.id] = pool_artifact.name
 
     if failing_pools:
         message = "Index compatibility issues in pool(s): '" + "', '".join(str(l) for l in failing_pools.values()) + "' - see log."
@@ -10,6 +10,8 @@ import uuid
 import jinja2
 
 import lib.demultiplexing
+import lib.index_collisions
+import lib.reagent_catalogue
 from genologics import config
 from genologics.lims import *
 
@@ -44,44 +46,26 @@ def get_index_sequences(lims, reagent_label_list):
     """Convert reagent label names (strings) into tuples of (index1, index2) by looking up the sequences
     in LIMS. Empty strings are used if there is no index."""
 
-    # This can be done the fast way or the right way. The names should all contain
-    # the sequences in parenthesis as part of the reagent label names. We could extract
-    # them, but instead we do it the slow way and fetch all the reagent label entities
-    # and get their sequence attribute. First we do a search to convert the names into IDs
-    # (or rather, ReagentType objects), then we fetch the entities one by one. The entities
-    # will be cached between lanes, but the name search will be repeated.
-
-    logging.info("Retrieving index sequences from LIMS API.")
-
-    # First retrieve all reagent labels, using batches to avoid URL size limit
-    reagent_types = []
-    BATCH_SIZE = 100
-    for batch_start in range(0, len(reagent_label_list), BATCH_SIZE):
-        reagent_types += lims.get_reagent_types(
-            name=[
-                name
-                for name in reagent_label_list[batch_start : (batch_start + BATCH_SIZE)]
-                if name
-            ]
-        )
-
-    # This will fetch all reagent types from API one by one, by querying for the "name" property
-    reagent_type_map = {rt.name: rt for rt in reagent_types}
+    # The sequences are looked up in the local reagent catalogue, which is only refreshed from
+    # LIMS if a reagent label is not found.
+    logging.info("Looking up index sequences in the reagent catalogue.")
+    reagent_catalogue = lib.reagent_catalogue.get_reagent_catalogue(lims)
 
     result_index_list = []
     for reagent_label in reagent_label_list:
         if not reagent_label:
             result_index_list.append(("", ""))
         else:
-            if reagent_label in reagent_type_map:
-                seq_parts = reagent_type_map[reagent_label].sequence.split("-")
+            reagent_type = reagent_catalogue.get(reagent_label)
+            if reagent_type:
+                seq_parts = reagent_type.sequence.split("-")
                 if len(seq_parts) == 1:  # Single index
                     result_index_list.append((seq_parts[0], ""))
                 elif len(seq_parts) == 2:  # Dual index
                     result_index_list.append(tuple(seq_parts))
                 else:
                     raise ValueError(
-                        f"Reagent type {reagent_label} has malformed sequence in LIMS: {reagent_type_map[reagent_label].sequence}."
+                        f"Reagent type {reagent_label} has malformed sequence in LIMS: {reagent_type.sequence}."
                     )
             else:
                 raise ValueError(
@@ -91,45 +75,28 @@ def get_index_sequences(lims, reagent_label_list):
     return result_index_list
 
 
-def hamming_distance(seq1, seq2):
-    """Hamming distance between two strings of equal length.
-
-    This is a helper method used in check_index_compatibility."""
-
-    return sum(c1 != c2 for c1, c2 in zip(seq1, seq2))
-
-
 def check_index_compatibility(index_pair_list, maximum_allowed_mismatches):
     """Check that indexes are sufficiently different from each other, so that reads can be uniquely
     attributed to a single sample, based on the configured allowed mismatches.
     """
 
     difference_threshold = 2 * maximum_allowed_mismatches
-    found_any_failing = False
-    # Compute all against all distances
-    for i, (index1, index2) in enumerate(index_pair_list):
-        for index1_other, index2_other in index_pair_list[i + 1 :]:
-            index1_mismatches = hamming_distance(index1, index1_other)
-            index2_mismatches = hamming_distance(index2, index2_other)
-
-            # The samples can be distinguished if the mismatch count in either index is
-            # greater than the allowed mismatches plus one.
-            index1_ok = index1_mismatches > difference_threshold
-            index2_ok = index2_mismatches > difference_threshold
-            if (not index1_ok) and (not index2_ok):
-                index_display = "-".join([i for i in [index1, index2] if i])
-                index_other_display = "-".join([i for i in [index1, index2] if i])
-                logging.warning(
-                    f"Index {index_display} is too similar to {index_other_display}. "
-                    f"Index1 mismatches: {index1_mismatches}, index2 mismatches: {index2_mismatches}."
-                )
-                logging.warning(
-                    f"With {maximum_allowed_mismatches} allowed mismatches, the difference shoud be "
-                    f"greater than {difference_threshold} differences."
-                )
-                found_any_failing = True
+    # The samples can be distinguished if the mismatch count in either index is
+    # greater than the allowed mismatches plus one.
+    collisions = lib.index_collisions.find_collisions(index_pair_list, difference_threshold + 1)
+    for i, j, (index1_mismatches, index2_mismatches) in collisions:
+        index_display = "-".join([seq for seq in index_pair_list[i] if seq])
+        index_other_display = "-".join([seq for seq in index_pair_list[j] if seq])
+        logging.warning(
+            f"Index {index_display} is too similar to {index_other_display}. "
+            f"Index1 mismatches: {index1_mismatches}, index2 mismatches: {index2_mismatches}."
+        )
+        logging.warning(
+            f"With {maximum_allowed_mismatches} allowed mismatches, the difference shoud be "
+            f"greater than {difference_threshold} differences."
+        )
 
-    return not found_any_failing
+    return not collisions
 
 
 def upload_samplesheet(lims, output_samplesheet_artifact, file_name, samplesheet_data):
@@ -341,6 +308,11 @@ def generate_sample_sheet_start_bclconvert(
     # ancestor artifact returned by the demux endpoint, reprensenting a single unique reagent_label.
     sample_uuids_map = {}
 
+    # Get the demux endpoint for all lanes and process the XML entities. The demultiplexed
+    # artifacts, samples and projects are fetched in batch.
+    # Getting a dict of {lane_artifact_id: [(sample, artifact, reagent_label_name), ...]}
+    lane_demux_lists = lib.demultiplexing.get_demux_artifacts(lims, lane_artifacts)
+
     for lane_artifact in sorted(
         lane_artifacts, key=lambda artifact: artifact.location[1][0]
     ):
@@ -352,9 +324,7 @@ def generate_sample_sheet_start_bclconvert(
             f"Processing lane {lane_id}, artifact {lane_artifact.name}. Barcode mismatches = {barcode_mismatches}."
         )
 
-        # Get the demux endpoint for this lane and process the XML entities
-        # Getting a list of [(sample, artifact, reagent_label_name), ...]
-        demux_list = lib.demultiplexing.get_demux_artifact(lims, lane_artifact)
+        demux_list = lane_demux_lists[lane_artifact.id]
 
         # Convert reagent label name into a tuple of (index1, index2) sequences
         index_pairs = get_index_sequences(
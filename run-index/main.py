@@ -0,0 +1,70 @@
+# Local HTTP/JSON API for the run folder index, see lib/run_index.py.
+#
+# The service scans the run storages in a background thread, and the other scripts on this
+# server read the same index database. The API is for consumers that can't use the library.
+
+import logging
+import threading
+import time
+
+from flask import Flask, jsonify, request
+
+from lib import run_index
+
+# Interval between scans of the run storages (seconds)
+SCAN_INTERVAL = 30
+# Read all run folders at this interval, in case a change was missed (seconds)
+FULL_SCAN_INTERVAL = 3600
+
+app = Flask(__name__)
+index = None # Set by start()
+
+
+def scanner():
+    """Scanner background thread"""
+
+    last_full_scan = 0
+    while True:
+        full = time.time() - last_full_scan > FULL_SCAN_INTERVAL
+        try:
+            index.scan(full=full)
+            if full:
+                last_full_scan = time.time()
+        except Exception:
+            logging.exception("Error while scanning the run storages")
+        time.sleep(SCAN_INTERVAL)
+
+
+@app.route('/runs')
+def get_runs():
+    """List runs. Optional query parameters: storage (may be repeated) and instrument."""
+
+    storages = request.args.getlist('storage') or None
+    instrument = request.args.get('instrument')
+    runs = [
+            entry._asdict()
+            for entry in index.get_runs(storages, max_age=float('inf'))
+            if instrument is None or entry.instrument == instrument
+            ]
+    return jsonify(last_scan=index.last_scan, runs=runs)
+
+
+@app.route('/runs/<run_id>')
+def get_run(run_id):
+    entry = index.get(run_id, max_age=float('inf'))
+    if entry is None:
+        return jsonify(error="Run not found"), 404
+    return jsonify(entry._asdict())
+
+
+def start():
+    global index
+    logging.basicConfig(level=logging.INFO)
+    index = run_index.get_run_index()
+    threading.Thread(target=scanner, daemon=True).start()
+
+
+if __name__ == '__main__':
+    start()
+    app.debug = True
+    app.run(host="127.0.0.1", port=5001, use_reloader=False)
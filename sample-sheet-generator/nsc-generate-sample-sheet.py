@@ -14,35 +14,12 @@ import datetime
 from genologics.lims import *
 from genologics import config
 from argparse import ArgumentParser
+import lib.reagent_catalogue
 
 lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
 
-reagent_type_uri = {}
-reagent_type_seq = {}
-
-def get_all_reagent_types():
-    """Load all reagent types with name only, from the API resource.
-    (this is a lot faster than getting the full representations one by
-    one)."""
-    # Using a loop similar to Lims._get_instances()
-    reagent_types = {}
-    root = lims.get(lims.get_uri("reagenttypes"))
-    while root:
-        for node in root.findall("reagent-type"):
-            # add a reagent type to the dict by name
-            name = node.attrib['name']
-            uri = node.attrib['uri']
-            reagent_types[name] = uri
-        node = root.find('next-page')
-        root = None
-        if not node is None:
-            root = lims.get(node.attrib['uri'])
-    return reagent_types
-
 
 def main(process_id, output_file_id, include_lane, use_sampleid):
-    global reagent_type_uri
-
     process = Process(lims, id=process_id)
     i_os = [(i['uri'], o['uri']) 
                 for i, o in process.input_output_maps
@@ -54,8 +31,6 @@ def main(process_id, output_file_id, include_lane, use_sampleid):
         print("Only one output container (flowcell) may be used at a time")
         sys.exit(1)
 
-    reagent_type_uri = get_all_reagent_types()
-
     data = generate_sample_sheet(process, i_os, include_lane, use_sampleid)
 
     # Upload sample sheet with name of flow cell ID
@@ -228,16 +203,11 @@ def get_samples_and_indexes(artifact):
         return [(artifact.samples[0], artifact, None)]
     if len(artifact.reagent_labels) == 1:
         index_name = next(iter(artifact.reagent_labels))
-        try:
-            index_seq = reagent_type_seq[index_name]
-        except KeyError:
-            try:
-                reagent_obj = ReagentType(lims, uri=reagent_type_uri[index_name])
-                index_seq = reagent_obj.sequence
-                reagent_type_seq[index_name] = index_seq
-            except KeyError as e:
-                print("Index reagent name {0} is not available in the system.".format(e))
-                sys.exit(1)
+        reagent_type = lib.reagent_catalogue.get_reagent_catalogue(lims).get(index_name)
+        if reagent_type is None:
+            print("Index reagent name {0} is not available in the system.".format(index_name))
+            sys.exit(1)
+        index_seq = reagent_type.sequence
         return [(artifact.samples[0], artifact, index_seq)]
     else:
         parent = artifact.parent_process
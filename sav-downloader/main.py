@@ -9,11 +9,12 @@ import re
 import sys
 import os
 import glob
+from lib import run_index
 
 app = Flask(__name__)
 
+# The current runs are read from the run index
 CURRENT_RUN_DIRS = ["/data/runScratch.boston", "/data/runScratch.boston/NovaSeqX", "/boston/diag/runs", "/boston/diag/runs/veriseq"]
-CURRENT_RUN_GLOBS = ["{0}/[0-9]*_*_*/".format(crd) for crd in CURRENT_RUN_DIRS]
 ARCHIVE_RUN_DIRS = ["/data/runScratch.boston/processed"]
 ARCHIVE_RUN_GLOBS = ["{0}/[0-9]*_*_*/".format(ard) for ard in ARCHIVE_RUN_DIRS]
 
@@ -26,12 +27,12 @@ def get_main():
 @app.route('/runs/<collection>')
 def get_runs(collection):
     if collection == "current":
-        run_paths = sum((glob.glob(x) for x in CURRENT_RUN_GLOBS), [])
+        run_ids = [run.run_id for run in run_index.get_run_index().get_runs(CURRENT_RUN_DIRS)]
     elif collection == "archive":
         run_paths = sum((glob.glob(x) for x in ARCHIVE_RUN_GLOBS), [])
+        run_ids = [os.path.basename(r.rstrip("/")) for r in run_paths]
     else:
         return "Error: Invalid collection", 400
-    run_ids = [os.path.basename(r.rstrip("/")) for r in run_paths]
     return jsonify(run_ids=sorted(run_ids, reverse=True))
 
 
@@ -15,9 +15,10 @@ import json
 import yaml
 import math
 import collections
+import functools
 from genologics.lims import *
 from genologics import config
-from lib import demultiplexing
+from lib import demultiplexing, demux_archive, run_index, run_watcher
 
 lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
 
@@ -31,6 +32,10 @@ RUN_FOLDER_MATCH = r"\d{8}_LH[0-9\-_]+"
 
 IMPORT_FILE_NAME = "ClarityLIMSImport_NSC.yaml"
 
+# In daemon mode, the analyses are checked at this interval (seconds), and immediately when
+# an analysis directory or its CopyComplete.txt is created
+DAEMON_INTERVAL = 300
+
 # Use this to cache demultiplexings of lanes. They are used in two functions.
 demux_cache = {}
 
@@ -74,6 +79,7 @@ def get_lane_input(lane, inputs):
     raise ValueError(f"No input found for lane {lane}.")
 
 
+@functools.lru_cache()
 def get_stepconf_and_workflow(workflow_name, process_type_name):
     """Based on the workflow name, look up the protocol step ID, which is the
     same as the queue ID.
@@ -106,10 +112,30 @@ dummy_outputs_for_unindexed_lanes = {}
 
 def update_lims_output_info(process, demultiplex_stats, quality_metrics, detailed_summary, num_read_phases, s_numbers):
     global dummy_outputs_for_unindexed_lanes
-    lane_total_read_counts = {
-        lane: demultiplex_stats[demultiplex_stats['Lane'] == lane]['# Reads'].sum().item()
-        for lane in demultiplex_stats['Lane'].unique()
-    }
+    lane_total_read_counts = demultiplex_stats.groupby('Lane')['# Reads'].sum().to_dict()
+
+    # Aggregate the metrics by (Lane, SampleID) once, so each artifact is a single lookup.
+    # In rare cases there may be more than one demultiplexed artifact with the same
+    # sample ID. We aggregate the stats for all of them.
+    sample_demux_stats_all = demultiplex_stats.groupby(['Lane', 'SampleID'])[
+                    ['# Reads', '# Perfect Index Reads', '# One Mismatch Index Reads']
+                    ].sum().to_dict('index')
+    # There is always a row in quality_metrics for each data read, identified by
+    # ReadNumber. The aggregates include all reads. If fastq output is disabled,
+    # there will be no quality_metrics file.
+    if quality_metrics is not None:
+        sample_quality_metrics_all = quality_metrics.groupby(['Lane', 'SampleID']).agg(
+                    yield_total=('Yield', 'sum'),
+                    yield_q30=('YieldQ30', 'sum'),
+                    mean_q_score=('Mean Quality Score (PF)', 'mean'),
+                    read_passes=('ReadNumber', 'nunique'),
+                    ).to_dict('index')
+    # Workflow name and ORA compression status for each sample ID
+    sample_workflows = collections.defaultdict(list)
+    if detailed_summary is not None:
+        for workflow in detailed_summary['workflows']:
+            for sample in workflow['samples']:
+                sample_workflows[sample['sample_id']].append((workflow['workflow_name'], sample['ora_compression']))
 
     # Update stats for each input-output pair, representing a unique indexed sample
     # on a lane
@@ -141,21 +167,10 @@ def update_lims_output_info(process, demultiplex_stats, quality_metrics, detaile
                                  "a 'SampleSheet Sample_ID' UDF. This will break things downstream, aborting.")
 
         # Update the output artifact with the demultiplexing stats
-        sample_demux_stats = demultiplex_stats[
-                                        (demultiplex_stats['Lane'] == lane_id) & 
-                                        (demultiplex_stats['SampleID'] == samplesheet_sampleid)
-                                        ]
-        # In rare cases there may be more than one demultiplexed artifact with the same
-        # sample ID. We aggregate the stats for all of them.
-
-        # There is always a row in quality_metrics for each data read, identified by
-        # ReadNumber. The first selection below includes both reads. If fastq output is disabled,
-        # there will be no quality_metrics file.
+        sample_demux_stats = sample_demux_stats_all.get((lane_id, samplesheet_sampleid), {})
         if quality_metrics is not None:
-            sample_quality_metrics = quality_metrics[
-                                            (quality_metrics['Lane'] == lane_id) & 
-                                            (quality_metrics['SampleID'] == samplesheet_sampleid)
-                                            ]
+            sample_quality_metrics = sample_quality_metrics_all.get((lane_id, samplesheet_sampleid),
+                    {'yield_total': 0, 'yield_q30': 0, 'mean_q_score': math.nan, 'read_passes': 0})
 
         if samplesheet_sampleid not in s_numbers:
             # Sample was excluded from actual procesing
@@ -163,7 +178,7 @@ def update_lims_output_info(process, demultiplex_stats, quality_metrics, detaile
             continue
         output_artifact.udf['Sample sheet position'] = s_numbers[samplesheet_sampleid]
 
-        read_count = sample_demux_stats['# Reads'].sum().item()
+        read_count = int(sample_demux_stats.get('# Reads', 0))
         if read_count > 0:
             logging.info(f"Found nonzero read count for {samplesheet_sampleid}, quality metrics: {quality_metrics is not None}")
             output_artifact.udf['# Reads'] = read_count * num_read_phases
@@ -171,15 +186,15 @@ def update_lims_output_info(process, demultiplex_stats, quality_metrics, detaile
             output_artifact.udf['% of PF Clusters Per Lane'] = \
                             read_count / lane_total_read_counts[lane_id] * 100
             output_artifact.udf['% Perfect Index Read'] = \
-                            sample_demux_stats['# Perfect Index Reads'].item() / read_count * 100
+                            int(sample_demux_stats['# Perfect Index Reads']) / read_count * 100
             output_artifact.udf['% One Mismatch Reads (Index)'] = \
-                            sample_demux_stats['# One Mismatch Index Reads'].item() / read_count * 100
+                            int(sample_demux_stats['# One Mismatch Index Reads']) / read_count * 100
             if quality_metrics is not None:
-                output_artifact.udf['Yield PF (Gb)'] = sample_quality_metrics['Yield'].sum().item() / 1e9        
+                output_artifact.udf['Yield PF (Gb)'] = int(sample_quality_metrics['yield_total']) / 1e9
                 output_artifact.udf['% Bases >=Q30'] = \
-                                sample_quality_metrics['YieldQ30'].sum().item() * 100 / max(1, sample_quality_metrics['Yield'].sum().item())
+                                int(sample_quality_metrics['yield_q30']) * 100 / max(1, int(sample_quality_metrics['yield_total']))
                 # empirically, the following value can be NaN if there are no reads. We can't put NaN into LIMS
-                mean_q_score = sample_quality_metrics['Mean Quality Score (PF)'].mean()
+                mean_q_score = float(sample_quality_metrics['mean_q_score'])
                 if not math.isnan(mean_q_score):
                     output_artifact.udf['Ave Q Score'] = mean_q_score
         else:
@@ -195,25 +210,16 @@ def update_lims_output_info(process, demultiplex_stats, quality_metrics, detaile
 
         # Add number of read 1, read 2 etc. (single read / paired end / weird 10x stuff)
         if quality_metrics is not None:
-            output_artifact.udf['Number of data read passes'] = sample_quality_metrics['ReadNumber'].nunique()
+            output_artifact.udf['Number of data read passes'] = int(sample_quality_metrics['read_passes'])
 
         if detailed_summary is not None:
             # Get workflow info for this sample
             # Save the pipeline type and compression type used for this sample
-            workflow_all_samples = [
-                            (workflow, sample)
-                            for workflow in detailed_summary['workflows']
-                            for sample in workflow['samples']
-                            ]
-            workflow_info = [
-                            (i, workflow['workflow_name'], sample['ora_compression'])
-                            for i, (workflow, sample) in enumerate(workflow_all_samples)
-                            if sample['sample_id'] == samplesheet_sampleid
-                            ]
+            workflow_info = sample_workflows.get(samplesheet_sampleid, [])
             if len(workflow_info) == 1:
                 logging.info(f"Workflow info found for {samplesheet_sampleid}: {workflow_info}.")
-                output_artifact.udf['Onboard analysis type'] = workflow_info[0][1]
-                output_artifact.udf['ORA compression'] = workflow_info[0][2] == "completed"
+                output_artifact.udf['Onboard analysis type'] = workflow_info[0][0]
+                output_artifact.udf['ORA compression'] = workflow_info[0][1] == "completed"
             else:
                 logging.info(f"Have detailed_summary but didn't find workflow info for {samplesheet_sampleid}.")
         else:
@@ -225,6 +231,25 @@ def update_lims_output_info(process, demultiplex_stats, quality_metrics, detaile
     lims.put_batch([o for o in updated_artifacts if isinstance(o, Artifact)])
 
 
+def get_archive_lims_ids(process):
+    """Get the LIMS IDs of the demultiplexed outputs, by lane and SampleSheet Sample_ID, for the
+    metrics archive. The artifacts and samples are already in the cache after the update."""
+
+    rows = []
+    for i, o in process.input_output_maps:
+        if o is None or o['output-generation-type'] != 'PerReagentLabel': continue
+        output_artifact = o['uri']
+        sample = output_artifact.samples[0]
+        rows.append((
+            well_id_to_lane(i['uri'].location[1]),
+            output_artifact.udf.get('SampleSheet Sample_ID'),
+            output_artifact.id,
+            sample.id,
+            sample.project.name if sample.project else None
+            ))
+    return pd.DataFrame(rows, columns=['Lane', 'SampleID', 'artifact_id', 'lims_sample_id', 'project'])
+
+
 def update_lims_lane_metrics(process, demultiplex_stats):
     """Update lane-level metrics, on the input artifacts of the process.
     
@@ -488,6 +513,16 @@ def process_analysis(run_dir, analysis_dir):
     if not process: # No existing process
         raise RuntimeError(f"Didn't find any BCL Convert process for Analysis {analysis_id} in run {run_id}")
 
+    # Fetch the per-index outputs and the demultiplexing of all lanes up front, using batch requests,
+    # instead of fetching each artifact, sample and project when it's first used.
+    logging.info(f"Fetching output artifacts and demultiplexing of the lanes in batch.")
+    indexed_outputs = demultiplexing.unique_entities(
+        o['uri'] for i, o in process.input_output_maps
+        if o is not None and o['output-generation-type'] == 'PerReagentLabel'
+    )
+    if indexed_outputs:
+        lims.get_batch(indexed_outputs)
+    demux_cache.update(demultiplexing.get_demux_artifacts(lims, process.all_inputs(unique=True)))
 
     # Import demultiplexing quality metrics. They will be in the App configured for the specific sample.
     # The *fastq component is designed to also match "ora_fastq".
@@ -552,34 +587,40 @@ def process_analysis(run_dir, analysis_dir):
             'samples': sample_id_list
             }, ofile)
 
+    logging.info(f"Adding the metrics to the demultiplexing archive.")
+    try:
+        records = demux_archive.build_records(run_id, analysis_id, process.id, demultiplex_stats,
+                            quality_metrics, detailed_summary, get_archive_lims_ids(process))
+    except Exception as e: # The archive is only used for reports, the import is complete
+        logging.warning(f"Unable to prepare the records for the demultiplexing archive: {e}")
+    else:
+        demux_archive.append(records)
+
 def find_and_process_runs():
-    run_dirs = [r
-            for directory in RUN_STORAGES
-            for r in glob.glob(os.path.join(directory, "*_*_*"))
-            if re.match(RUN_FOLDER_MATCH, os.path.basename(r))
+    runs = [run
+            for run in run_index.get_run_index().get_runs(RUN_STORAGES)
+            if re.match(RUN_FOLDER_MATCH, run.run_id)
             ]
 
-    logging.info(f"Found {len(run_dirs)} run directories")
+    logging.info(f"Found {len(runs)} run directories")
 
-    for run_dir in run_dirs:
-        run_id = os.path.basename(run_dir)
+    for run in runs:
+        run_dir = run.path
+        run_id = run.run_id
         logging.info(f"Processing analyses of run {run_id}")
-        analysis_dirs = [
-                    adir for adir in glob.glob(os.path.join(run_dir, "Analysis", "*"))
-                    if os.path.isdir(adir)
-                ]
         # There may be multiple analysis directories if the processing has been requeued.
         # The analyses may be handling different lanes, so we should import all, not just
         # the newest.
-        for analysis_dir in analysis_dirs:
-            analysis_id = os.path.basename(analysis_dir)
+        for analysis in run.analyses:
+            analysis_dir = analysis['path']
+            analysis_id = analysis['id']
             logging.info(f"Processing analysis {analysis_id}")
 
             limsfile_path = os.path.join(analysis_dir, IMPORT_FILE_NAME)
             if os.path.exists(limsfile_path):
                 logging.info(f"Skipping analysis {analysis_id} because {IMPORT_FILE_NAME} exists.")
                 continue
-            if not os.path.exists(os.path.join(analysis_dir, "CopyComplete.txt")):
+            if not analysis['copy_complete']:
                 logging.info(f"Analysis {analysis_id} does not have CopyComplete.txt. Skipping.")
                 continue
 
@@ -591,8 +632,22 @@ def find_and_process_runs():
             process_analysis(run_dir, analysis_dir)
 
 
-def main():
-    configure_logging()
+def get_watch_paths():
+    """Directories to watch in daemon mode: the run storages, the run folders and their
+    Analysis directories (new analyses), and the analyses that are not imported yet."""
+
+    paths = dict((storage, None) for storage in RUN_STORAGES)
+    for run in run_index.get_run_index().get_runs(RUN_STORAGES):
+        if re.match(RUN_FOLDER_MATCH, run.run_id):
+            paths[run.path] = {"Analysis"}
+            paths[os.path.join(run.path, "Analysis")] = None
+            for analysis in run.analyses:
+                if not os.path.exists(os.path.join(analysis['path'], IMPORT_FILE_NAME)):
+                    paths[analysis['path']] = {"CopyComplete.txt"}
+    return paths
+
+
+def run_once():
     logging.info(f"Executing NovaSeq X demultiplexing monitoring at {datetime.datetime.now()}")
 
     try:
@@ -603,6 +658,34 @@ def main():
     logging.info(f"Completed NovaSeq X demultiplexing monitoring at {datetime.datetime.now()}")
 
 
+def run_daemon():
+    """Check the analyses every DAEMON_INTERVAL seconds, or when the watcher reports a new
+    analysis or CopyComplete.txt. The LIMS connection is reused."""
+
+    watcher = run_watcher.RunFolderWatcher()
+    while True:
+        # Fetch the entities again on each pass, like a new invocation from cron
+        lims.cache.clear()
+        demux_cache.clear()
+        dummy_outputs_for_unindexed_lanes.clear()
+        run_once()
+        watcher.update(get_watch_paths())
+        if watcher.wait(DAEMON_INTERVAL):
+            logging.info("Changes in the run folders, updating the run index.")
+            run_index.get_run_index().scan()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import NovaSeq X demultiplexing results into LIMS.")
+    parser.add_argument("--daemon", action="store_true", help="Run continuously, instead of a single pass.")
+    args = parser.parse_args()
+    configure_logging()
+    if args.daemon:
+        run_daemon()
+    else:
+        run_once()
+
+
 if __name__ == '__main__':
     main()
 
@@ -2,22 +2,31 @@
 
 # Run information update script for NovaSeq X.
 
-# Compared to update-runs.py, it uses a simplistic approach of only relying on LIMS
-# to track the run status, no database file used for performance.
+# Compared to update-runs.py, it uses a simplistic approach of relying on LIMS to track
+# the run status. A local ledger only records which process belongs to each run, and which
+# runs are completed, so that the runs don't have to be looked up in LIMS on every pass.
 
-import glob
 import os
 import sys
 import re
 import yaml
 import math
 import logging
+import collections
+import sqlite3
+import threading
+import fcntl
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import TimedRotatingFileHandler
 from dateutil import parser, tz
 import datetime
+import itertools
+import functools
+import argparse
 import requests
 from xml.etree.ElementTree import ElementTree
-from interop import py_interop_run_metrics, py_interop_run, py_interop_summary
+from lib import run_cycles, run_index, interop_summary, run_watcher
 from genologics.lims import *
 from genologics import config
 
@@ -50,6 +59,111 @@ REAGENT_TYPES = {
     'Lyo':      'NovaSeq X Lyophilization Cartridge',
 }
 
+# Local ledger of the runs that have been matched to a process in LIMS
+LEDGER_FILE = "/var/db/lims/novaseq-x-run-monitoring.db"
+# Runs are processed in parallel by this number of threads
+MAX_WORKERS = 4
+# Lock files for the runs, so overlapping invocations don't process the same run. The
+# directory must be writable by the user running the script, like the ledger.
+LOCK_DIR = "/var/db/lims/novaseq-x-run-monitoring-locks"
+# Lane QC is updated during the run, at the end of each read and at this interval (cycles)
+LIVE_QC_CYCLE_INTERVAL = 25
+# In daemon mode, the runs are processed at this interval (seconds), and immediately when one
+# of these files is created in the folder of an active run
+DAEMON_INTERVAL = 60
+RUN_EVENT_FILES = {"RunParameters.xml", "CopyComplete.txt"}
+
+# qc_cycle is the cycle of the last lane QC update during the run
+LedgerEntry = collections.namedtuple("LedgerEntry", ["run_id", "process_id", "container_id", "current_cycle", "completed", "qc_cycle"])
+
+
+class RunLedger(object):
+    """Run ID => LedgerEntry, for the runs that have a process in LIMS.
+
+    Completed runs are skipped without any LIMS requests, and the process of an active run
+    is fetched directly by ID. The entries of runs that are removed from the storage are
+    deleted. If the database can't be opened, the ledger is kept in memory only, and the runs
+    are looked up in LIMS as before.
+    """
+
+    def __init__(self, path=LEDGER_FILE):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.db = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            with self.db:
+                self.db.execute("""CREATE TABLE IF NOT EXISTS run (
+                        run_id TEXT PRIMARY KEY,
+                        process_id TEXT NOT NULL,
+                        container_id TEXT NOT NULL,
+                        current_cycle INTEGER NOT NULL,
+                        completed INTEGER NOT NULL,
+                        qc_cycle INTEGER NOT NULL DEFAULT 0
+                        )""")
+                columns = [row[1] for row in self.db.execute("PRAGMA table_info(run)")]
+                if "qc_cycle" not in columns: # Ledger created by an earlier version
+                    self.db.execute("ALTER TABLE run ADD COLUMN qc_cycle INTEGER NOT NULL DEFAULT 0")
+            for row in self.db.execute("SELECT run_id, process_id, container_id, current_cycle, completed, qc_cycle FROM run"):
+                self.entries[row[0]] = LedgerEntry(row[0], row[1], row[2], row[3], bool(row[4]), row[5])
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f"Unable to open run ledger {path}, continuing without it: {e}")
+            self.db = None
+
+    def get(self, run_id, reload=False):
+        """Get the entry for a run. If reload is True, it's read from the database, in case
+        it's been updated by another invocation."""
+
+        with self.lock:
+            if reload and self.db:
+                try:
+                    row = self.db.execute("SELECT run_id, process_id, container_id, current_cycle, completed, qc_cycle "
+                            "FROM run WHERE run_id = ?", (run_id,)).fetchone()
+                    if row:
+                        self.entries[run_id] = LedgerEntry(row[0], row[1], row[2], row[3], bool(row[4]), row[5])
+                    else:
+                        self.entries.pop(run_id, None)
+                except sqlite3.Error as e:
+                    logging.warning(f"Unable to read the run ledger entry for {run_id}: {e}")
+            return self.entries.get(run_id)
+
+    def is_completed(self, run_id):
+        entry = self.get(run_id)
+        return entry is not None and entry.completed
+
+    def put(self, entry):
+        with self.lock:
+            if self.entries.get(entry.run_id) == entry:
+                return
+            self.entries[entry.run_id] = entry
+            if self.db:
+                try:
+                    with self.db:
+                        self.db.execute("INSERT OR REPLACE INTO run (run_id, process_id, container_id, current_cycle, completed, qc_cycle) "
+                                "VALUES (?, ?, ?, ?, ?, ?)", (entry.run_id, entry.process_id, entry.container_id,
+                                entry.current_cycle, int(entry.completed), entry.qc_cycle))
+                except sqlite3.Error as e:
+                    logging.warning(f"Unable to save the run ledger entry for {entry.run_id}: {e}")
+
+    def delete(self, run_id):
+        with self.lock:
+            self.entries.pop(run_id, None)
+            if self.db:
+                try:
+                    with self.db:
+                        self.db.execute("DELETE FROM run WHERE run_id = ?", (run_id,))
+                except sqlite3.Error as e:
+                    logging.warning(f"Unable to delete the run ledger entry for {run_id}: {e}")
+
+    def prune(self, run_ids):
+        """Delete the entries of runs that are not in run_ids."""
+
+        for run_id in set(self.entries) - set(run_ids):
+            logging.info(f"Run {run_id} is no longer on the run storage, removing it from the ledger.")
+            self.delete(run_id)
+
+
 def configure_logging():
     log_level = "INFO"
 
@@ -69,38 +183,96 @@ def configure_logging():
     logging.basicConfig(level=log_level, handlers=[file_handler, console_handler])
 
 
-def get_library_tube_strip_id(run_parameters_xml):
-    """Get the library tube strip ID from the RunParameters.xml file,
-    used for matching the container in LIMS. The argument should contain
-    an ElementTree object with the parsed XML.
-    
-    Returns the library tube strip ID, or None if not found."""
-
-    consumable_infos = run_parameters_xml.findall("ConsumableInfo/ConsumableInfo")
-    for consumable_info in consumable_infos:
-        try:
-            if consumable_info.find("Type").text == "SampleTube":
-                return consumable_info.find("SerialNumber").text
-        except AttributeError:
-            pass
-    return None
+def load_run_parameters(run_dir, run_id):
+    """Load the RunParameters.xml file, and check that the Run ID in the file matches the
+    run folder name.
 
+    Returns an ElementTree object with the parsed XML, or None if the file can't be used."""
 
-def get_stepconf_and_queue():
-    """Based on the workflow name, look up the protocol step ID, which is the
-    same as the queue ID.
-    
-    Returns the Step configuration object and the Queue object."""
+    try:
+        rp_tree = ElementTree()
+        rp_tree.parse(os.path.join(run_dir, "RunParameters.xml"))
+    except IOError:
+        logging.info(f"Run {run_id} does not have a RunParameters.xml file, skipping.")
+        return None
+    rp_run_id = rp_tree.find("RunId").text
+    if rp_run_id != run_id:
+        logging.error(f"Run ID in RunParameters.xml {rp_run_id} does not match the run "
+                      f"folder name {run_id}.")
+        return None
+    return rp_tree
+
+
+@functools.lru_cache()
+def get_stepconf():
+    """Based on the workflow name, look up the protocol step configuration. It doesn't
+    change, so it's only looked up once in daemon mode."""
 
     workflows = lims.get_workflows(name=WORKFLOW_NAME)
     assert len(workflows) == 1, f"Expected exactly one workflow with name {WORKFLOW_NAME}, got {len(workflows)}"
     for stepconf in workflows[0].protocols[0].steps:
         if stepconf.name == PROCESS_TYPE_NAME:
-            return stepconf, stepconf.queue()
+            return stepconf
     else:
         raise RuntimeError(f"Cannot find the queue for workflow '{WORKFLOW_NAME}', process type '{PROCESS_TYPE_NAME}'.")
 
 
+def get_stepconf_and_queue():
+    """Look up the protocol step and its queue. The step ID is the same as the queue ID.
+    
+    Returns the Step configuration object and the Queue object."""
+
+    stepconf = get_stepconf()
+    return stepconf, stepconf.queue()
+
+
+class QueueCache(object):
+    """The step configuration and the artifacts in the queue, fetched when first needed by
+    one of the worker threads, and then shared by the others."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = None
+
+    def get(self):
+        """Returns the Step configuration object and the set of artifacts in the queue."""
+
+        with self.lock:
+            if self.value is None:
+                stepconf, queue = get_stepconf_and_queue()
+                self.value = (stepconf, set(queue.artifacts))
+            return self.value
+
+
+def check_lock_dir():
+    """Create the lock directory, or raise an error with a clear message if it can't be used.
+    Called once at startup, instead of failing for each run."""
+
+    try:
+        os.makedirs(LOCK_DIR, exist_ok=True)
+    except OSError as e:
+        raise RuntimeError(f"Unable to create the run lock directory {LOCK_DIR}: {e}") from e
+    if not os.access(LOCK_DIR, os.W_OK):
+        raise RuntimeError(f"The run lock directory {LOCK_DIR} is not writable.")
+
+
+@contextlib.contextmanager
+def run_lock(run_id):
+    """Take an exclusive lock for the run, shared between processes. Yields True if the lock
+    is acquired, or False if another process holds it."""
+
+    with open(os.path.join(LOCK_DIR, run_id + ".lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 def get_cycle(total_cycles, run_dir, lower_bound_cycle):
     """Get total cycles and current cycle based on files written in the run folder.
     lower_bound_cycle represents our knowledge of what cycles have already been completed.
@@ -110,14 +282,7 @@ def get_cycle(total_cycles, run_dir, lower_bound_cycle):
     Returns (current cycle, total cycles).
     """
     
-    lower_bound_cycle = max(0, lower_bound_cycle)
-    for cycle in range(lower_bound_cycle, total_cycles):
-        test_path = os.path.join(run_dir, "Data", "Intensities", "BaseCalls", "L001","C{0}.1".format(cycle+1))
-        if not os.path.exists(test_path):
-            return cycle
-
-    # All cycles are complete
-    return total_cycles
+    return run_cycles.get_cycle(run_dir, total_cycles, lower_bound_cycle)
 
 
 # Helper functions
@@ -206,7 +371,12 @@ def set_initial_fields(process, run_parameters, run_id):
 #        logging.warning(f"Can't get the start time from RunInfo.xml.")
 
 
-def set_lane_qc(process, run_dir):
+def set_lane_qc(process, run_dir, live=False):
+    """Set the lane metrics from the InterOp summary on the lane artifacts. If live is True,
+    the run is in progress, and the QC flags are not set.
+
+    Returns True if the artifacts were updated."""
+
     # Get the input-output mappings to find the output artifact for each lane
     lane_artifacts = [] # List of (lane, artifact)
     for i, o in process.input_output_maps:
@@ -219,46 +389,53 @@ def set_lane_qc(process, run_dir):
                 continue
             lane_artifacts.append((lane_number, o['uri']))
 
-    valid_to_load = py_interop_run.uchar_vector(py_interop_run.MetricCount, 0)
-    py_interop_run_metrics.list_summary_metrics_to_load(valid_to_load)
-    valid_to_load[py_interop_run.ExtendedTile] = 1
-    run_metrics = py_interop_run_metrics.run_metrics()
-    run_metrics.read(run_dir, valid_to_load)
-    summary = py_interop_summary.run_summary()
-    py_interop_summary.summarize_run_metrics(run_metrics, summary)
+    summary = interop_summary.get_run_summary(run_dir)
 
-    read_count = summary.size()
-    lane_count = summary.lane_count()
+    read_count = len(summary.reads)
+    lane_count = summary.lane_count
 
     if lane_count != len(lane_artifacts):
         logging.error(f"Error: Number of lanes in InterOp data: {lane_count}, does not match the number "
             f"of lanes in LIMS: {len(lane_artifacts)}.")
-        return
+        return False
 
+    lims.get_batch([a for _, a in lane_artifacts])
     for (lane_number, artifact) in lane_artifacts:
-        artifact.qc_flag = "PASSED"
+        if not live:
+            artifact.qc_flag = "PASSED"
         lane_index = lane_number - 1
         nonindex_read_count = 0
         for read in range(read_count):
-            read_data = summary.at(read)
-            if not read_data.read().is_index():
+            if not summary.reads[read]['is_index']:
                 read_label = str(nonindex_read_count + 1)
-                lane_summary = read_data.at(lane_index)
-                if math.isnan(lane_summary.yield_g()):
+                lane_summary = summary.lane(read, lane_index)
+                if math.isnan(lane_summary['yield_g']):
                     continue # Skip if the run failed and didn't start the read
-                artifact.udf['Yield PF (Gb) R{}'.format(read_label)] = lane_summary.yield_g()
-                artifact.udf['% Bases >=Q30 R{}'.format(read_label)] = lane_summary.percent_gt_q30()
-                artifact.udf['Cluster Density (K/mm^2) R{}'.format(read_label)] = lane_summary.density().mean()
-                artifact.udf['Reads PF (M) R{}'.format(read_label)] = lane_summary.reads_pf() / 1.0e6
-                artifact.udf['%PF R{}'.format(read_label)] = lane_summary.percent_pf().mean()
-                artifact.udf['Intensity Cycle 1 R{}'.format(read_label)] = lane_summary.first_cycle_intensity().mean()
-                set_if_not_nan(artifact, f'% Error Rate R{read_label}', lane_summary.error_rate().mean())
-                set_if_not_nan(artifact, f'% Phasing R{read_label}', lane_summary.phasing().mean())
-                set_if_not_nan(artifact, f'% Prephasing R{read_label}', lane_summary.prephasing().mean())
-                set_if_not_nan(artifact, f'% Aligned R{read_label}', lane_summary.percent_aligned().mean())
-                set_if_not_nan(artifact, f'% Occupied Wells', lane_summary.percent_occupied().median())
+                artifact.udf['Yield PF (Gb) R{}'.format(read_label)] = lane_summary['yield_g']
+                artifact.udf['% Bases >=Q30 R{}'.format(read_label)] = lane_summary['percent_gt_q30']
+                artifact.udf['Cluster Density (K/mm^2) R{}'.format(read_label)] = lane_summary['density']
+                artifact.udf['Reads PF (M) R{}'.format(read_label)] = lane_summary['reads_pf'] / 1.0e6
+                artifact.udf['%PF R{}'.format(read_label)] = lane_summary['percent_pf']
+                artifact.udf['Intensity Cycle 1 R{}'.format(read_label)] = lane_summary['first_cycle_intensity']
+                set_if_not_nan(artifact, f'% Error Rate R{read_label}', lane_summary['error_rate'])
+                set_if_not_nan(artifact, f'% Phasing R{read_label}', lane_summary['phasing'])
+                set_if_not_nan(artifact, f'% Prephasing R{read_label}', lane_summary['prephasing'])
+                set_if_not_nan(artifact, f'% Aligned R{read_label}', lane_summary['percent_aligned'])
+                set_if_not_nan(artifact, f'% Occupied Wells', lane_summary['percent_occupied_median'])
                 nonindex_read_count += 1
     lims.put_batch([a for _, a in lane_artifacts])
+    return True
+
+
+def is_live_qc_due(run, qc_cycle, current_cycle):
+    """Lane QC is updated during the run when a read is completed, and at least every
+    LIVE_QC_CYCLE_INTERVAL cycles."""
+
+    if current_cycle <= qc_cycle:
+        return False
+    read_ends = itertools.accumulate(read['cycles'] for read in run.reads)
+    return current_cycle - qc_cycle >= LIVE_QC_CYCLE_INTERVAL or \
+            any(qc_cycle < read_end <= current_cycle for read_end in read_ends)
 
 
 def create_reagent_lots(run_parameters, run_id):
@@ -354,137 +531,245 @@ def complete_step(step):
     logging.info("Completed " + step.id + ".")
 
 
-def main():
-    logging.info(f"Executing NovaSeq X run monitoring at {datetime.datetime.now()}")
+def process_and_update_run(run, process, step, container, ledger):
+    """Update the progress of a run that has a matching process in LIMS, and complete the
+    step when the run is finished. The ledger entry is updated with the state."""
 
-    run_dirs = [r
-            for directory in RUN_STORAGES
-            for r in glob.glob(os.path.join(directory, "*_*_*"))
-            if re.match(RUN_FOLDER_MATCH, os.path.basename(r))
-            ]
-    
-    logging.info(f"Found {len(run_dirs)} run directories")
+    run_dir = run.path
+    run_id = run.run_id
+    entry = ledger.get(run_id)
+    qc_cycle = entry.qc_cycle if entry else 0
+
+    # We now have a run folder and a matching Process in LIMS. We get the run status
+    # from the run folder.
+
+    # Determine if run has already been marked as finished, by checking the End Time
+    if not process.udf.get('Run End Time'):
+
+        # Match the cycle count to keep track of total cycles
+        logging.info(f"Getting the cycle count of {run_id} to update progress.")
+        old_cycle = process.udf['Current Cycle']
+        total_cycles = process.udf['Total Cycles']
+        current_cycle = get_cycle(total_cycles, run_dir, old_cycle)
+        completed = False
+        if current_cycle != old_cycle:
+            process.udf['Run Status'] = f"Cycle {current_cycle} of {total_cycles}"
+            process.udf['Current Cycle'] = current_cycle
+            process.put()
+
+        # Determine if the run is finished
+        copy_complete = "CopyComplete.txt" in run.markers
+        if copy_complete:
+            logging.info(f"Run {run_id} sequencing is recently completed and copied, "
+                            "updating QC metrics.")
+            set_lane_qc(process, run_dir)
+            logging.info(f"Updated lane QC information for {run_id}, now setting fields for run completion.")
+            set_final_fields(process, run_dir, run_id)
+            process.put()
+
+            # Complete the sequencing step when the run is finsihed.
+            complete_step(step)
+
+            # Set the UDF on the container, for use by the overview page
+            # Under normal operation, there should only be one library tube strip container.
+            container.udf['Recently completed'] = True
+            container.put()
+            completed = True
+
+        elif is_live_qc_due(run, qc_cycle, current_cycle):
+            # Only the InterOp summary is computed again, if the files have changed. Errors are
+            # expected while the files are written, and are retried on the next pass.
+            logging.info(f"Updating lane QC information for {run_id} during the run, at cycle {current_cycle}.")
+            try:
+                if set_lane_qc(process, run_dir, live=True):
+                    qc_cycle = current_cycle
+            except Exception:
+                logging.exception(f"Unable to update lane QC information for {run_id} during the run.")
 
-    # Cache for the step configuration object and Queue object
-    stepconf = None
-    queue = None
+    else: # Step already contains completion information
+        logging.info(f"Run {run_id} already has an 'Run End Time', nothing done.")
+        current_cycle = process.udf.get('Current Cycle', 0)
+        completed = True
 
-    for run_dir in run_dirs:
-        run_id = os.path.basename(run_dir)
-        logging.info(f"Processing run {run_id}")
+    ledger.put(LedgerEntry(run_id, process.id, container.id, current_cycle, completed, qc_cycle))
 
-        # Load the RunParameters.xml file, which contains the library tube strip ID used
-        # for matching the container in LIMS.
+
+def process_run(run, ledger, queue_cache):
+    """Match a run folder to a process in LIMS, and update the process. Runs in a worker
+    thread, while holding the lock for the run."""
+
+    run_dir = run.path
+    run_id = run.run_id
+
+    entry = ledger.get(run_id, reload=True)
+    if entry and entry.completed:
+        logging.debug(f"Run {run_id} is completed according to the ledger, skipping.")
+        return
+
+    if entry:
+        # Known run, go straight to the process
+        process = Process(lims, id=entry.process_id)
+        step = Step(lims, id=entry.process_id)
+        container = Container(lims, id=entry.container_id)
         try:
-            rp_tree = ElementTree()
-            rp_tree.parse(os.path.join(run_dir, "RunParameters.xml"))
-        except IOError:
-            logging.info(f"Run {run_id} does not have a RunParameters.xml file, skipping.")
-            continue
-        
-        library_tube_strip_id = get_library_tube_strip_id(rp_tree)
-        if library_tube_strip_id is None:
-            logging.warning(f"Run {run_id} does not have a library tube strip ID, skipping.")
-            continue
-        logging.info(f"Run {run_id} has library tube strip ID {library_tube_strip_id}.")
-
-        # Check that the Run ID in the xml file and the run folder name match
-        rp_run_id = rp_tree.find("RunId").text
-        if rp_run_id != run_id:
-            logging.error(f"Run ID in RunParameters.xml {rp_run_id} does not match the run "
-                          f"folder name {run_id}.")
-            continue
-
-        lims_containers = lims.get_containers(name=library_tube_strip_id)
-        if not lims_containers:
-            logging.info(f"Run {run_id} does not have a matching container '{library_tube_strip_id}' in "
-                            "LIMS, skipping.")
-            continue
-        
-        # Get one of the artifacts in the container
-        analyte = next(iter(lims_containers[-1].placements.values()))
-        # Look for run processes in LIMS
-        processes = lims.get_processes(inputartifactlimsid=[analyte.id], type=PROCESS_TYPE_NAME)
-
-        # Get the process, or start a new one if not available. These branches should both set
-        # the process and the step variables.
-        if processes:
-            process = processes[-1]
-            step = Step(lims, id=process.id)
-            logging.info(f"Found {len(processes)} processes for run {run_id} in LIMS. Will use "
-                            f"process {process.id}.")
-        else:
-            logging.info(f"Run {run_id} does not have a matching process in LIMS, checking queues.")
-            if queue is None:
-                stepconf, queue = get_stepconf_and_queue()
-            container_artifacts = set(lims_containers[-1].placements.values())
-            queue_artifacts = set(queue.artifacts)
-            if not queue_artifacts >= container_artifacts:
-                logging.info(f"All artifacts of {run_id} are not in the queue for {PROCESS_TYPE_NAME}. "
-                             "The run will not be processed.")
-                continue
-            logging.info(f"All artifacts of {run_id} found in queue, starting step.")
-            step = lims.create_step(stepconf, container_artifacts)
-            process = Process(lims, id=step.id)
+            process.get()
+        except requests.exceptions.HTTPError as e:
+            logging.warning(f"Unable to get process {entry.process_id} for run {run_id}, it will be "
+                            f"looked up again on the next pass: {e}")
+            ledger.delete(run_id)
+            return
+        logging.info(f"Run {run_id} has process {process.id} according to the ledger.")
+        process_and_update_run(run, process, step, container, ledger)
+        return
 
+    # The library tube strip ID from RunParameters.xml is used for matching the container
+    # in LIMS. It is read by the run index, the file is only loaded here for new runs.
+    library_tube_strip_id = run.library_tube_strip_id
+    if library_tube_strip_id is None:
+        logging.info(f"Run {run_id} does not have a library tube strip ID, skipping.")
+        return
+    logging.info(f"Run {run_id} has library tube strip ID {library_tube_strip_id}.")
+    rp_tree = None
 
-        # New run - set information
-        if process.udf.get('Run ID') is None:
-            logging.info(f"Setting initial fields for run {run_id}.")
-            set_initial_fields(process, rp_tree, run_id)
-            process.put()
+    lims_containers = lims.get_containers(name=library_tube_strip_id)
+    if not lims_containers:
+        logging.info(f"Run {run_id} does not have a matching container '{library_tube_strip_id}' in "
+                        "LIMS, skipping.")
+        return
+
+    # Get one of the artifacts in the container
+    analyte = next(iter(lims_containers[-1].placements.values()))
+    # Look for run processes in LIMS
+    processes = lims.get_processes(inputartifactlimsid=[analyte.id], type=PROCESS_TYPE_NAME)
+
+    # Get the process, or start a new one if not available. These branches should both set
+    # the process and the step variables.
+    if processes:
+        process = processes[-1]
+        step = Step(lims, id=process.id)
+        logging.info(f"Found {len(processes)} processes for run {run_id} in LIMS. Will use "
+                        f"process {process.id}.")
+    else:
+        logging.info(f"Run {run_id} does not have a matching process in LIMS, checking queues.")
+        stepconf, queue_artifacts = queue_cache.get()
+        container_artifacts = set(lims_containers[-1].placements.values())
+        if not queue_artifacts >= container_artifacts:
+            logging.info(f"All artifacts of {run_id} are not in the queue for {PROCESS_TYPE_NAME}. "
+                         "The run will not be processed.")
+            return
+        rp_tree = load_run_parameters(run_dir, run_id)
+        if rp_tree is None:
+            return
+        logging.info(f"All artifacts of {run_id} found in queue, starting step.")
+        step = lims.create_step(stepconf, container_artifacts)
+        process = Process(lims, id=step.id)
+
+    # New run - set information
+    if process.udf.get('Run ID') is None:
+        if rp_tree is None:
+            rp_tree = load_run_parameters(run_dir, run_id)
+            if rp_tree is None:
+                return
+        logging.info(f"Setting initial fields for run {run_id}.")
+        set_initial_fields(process, rp_tree, run_id)
+        process.put()
+
+        logging.info(f"Creating and setting reagent lots for run {run_id}.")
+        lots = create_reagent_lots(rp_tree, run_id)
+        logging.info(f"Created {len(lots)} lots. Setting used lots on the step.")
+        step.reagentlots.set_reagent_lots(lots)
+        step.reagentlots.put()
+
+    process_and_update_run(run, process, step, lims_containers[-1], ledger)
+
+
+def process_run_locked(run, ledger, queue_cache):
+    """Process a run if no other invocation of the script is processing it. Errors are logged,
+    and don't affect the other runs."""
+
+    try:
+        with run_lock(run.run_id) as locked:
+            if not locked:
+                logging.info(f"Run {run.run_id} is being processed by another instance, skipping.")
+                return
+            logging.info(f"Processing run {run.run_id}")
+            process_run(run, ledger, queue_cache)
+    except Exception:
+        logging.exception(f"Error while processing run {run.run_id}")
+
+
+def get_runs():
+    return [run
+            for run in run_index.get_run_index().get_runs(RUN_STORAGES)
+            if re.match(RUN_FOLDER_MATCH, run.run_id)
+            ]
 
-            logging.info(f"Creating and setting reagent lots for run {run_id}.")
-            lots = create_reagent_lots(rp_tree, run_id)
-            logging.info(f"Created {len(lots)} lots. Setting used lots on the step.")
-            step.reagentlots.set_reagent_lots(lots)
-            step.reagentlots.put()
-
-        # We now have a run folder and a matching Process in LIMS. We get the run status
-        # from the run folder.
-        
-        # Determine if run has already been marked as finished, by checking the End Time
-        if not process.udf.get('Run End Time'):
-
-            # Match the cycle count to keep track of total cycles
-            logging.info(f"Getting the cycle count to update progress.")
-            old_cycle = process.udf['Current Cycle']
-            total_cycles = process.udf['Total Cycles']
-            current_cycle = get_cycle(total_cycles, run_dir, old_cycle)
-            if current_cycle != old_cycle:
-                process.udf['Run Status'] = f"Cycle {current_cycle} of {total_cycles}"
-                process.udf['Current Cycle'] = current_cycle
-                process.put()
-            
-            # Determine if the run is finished
-            copy_complete = os.path.exists(os.path.join(run_dir, "CopyComplete.txt"))
-            if copy_complete:
-                logging.info(f"Run {run_id} sequencing is recently completed and copied, "
-                                "updating QC metrics.")
-                set_lane_qc(process, run_dir)
-                logging.info("Updated lane QC information, now setting fields for run completion.")
-                set_final_fields(process, run_dir, run_id)
-                process.put()
-
-                # Complete the sequencing step when the run is finsihed.
-                complete_step(step)
-
-                # Set the UDF on the container, for use by the overview page
-                # Under normal operation, there should only be one library tube strip container.
-                lims_containers[-1].udf['Recently completed'] = True
-                lims_containers[-1].put()
-
-
-        else: # Step already contains completion information
-            logging.info(f"Run {run_id} already has an 'Run End Time', nothing done.")
+
+def process_runs(ledger):
+    logging.info(f"Executing NovaSeq X run monitoring at {datetime.datetime.now()}")
+
+    runs = get_runs()
+    logging.info(f"Found {len(runs)} run directories")
+
+    ledger.prune(run.run_id for run in runs)
+
+    # Completed runs are filtered out here, but are checked again in the worker after
+    # locking the run, as another invocation may have updated the ledger.
+    active_runs = [run for run in runs if not ledger.is_completed(run.run_id)]
+    logging.info(f"Processing {len(active_runs)} runs that are not completed, using {MAX_WORKERS} workers.")
+    queue_cache = QueueCache()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(process_run_locked, run, ledger, queue_cache) for run in active_runs]
+    for run, future in zip(active_runs, futures):
+        if future.exception() is not None: # Not expected, process_run_locked logs the errors
+            logging.error(f"Unhandled error while processing run {run.run_id}", exc_info=future.exception())
 
     logging.info(f"NovaSeq X run monitoring completed at {datetime.datetime.now()}")
 
 
+def main():
+    check_lock_dir()
+    process_runs(RunLedger())
+
+
+def run_daemon():
+    """Process the runs every DAEMON_INTERVAL seconds, or when RUN_EVENT_FILES are created in
+    the active run folders. The LIMS connection and the step configuration are reused."""
+
+    check_lock_dir()
+    ledger = RunLedger()
+    watcher = run_watcher.RunFolderWatcher()
+    while True:
+        # Fetch the entities again on each pass, like a new invocation from cron
+        lims.cache.clear()
+        try:
+            process_runs(ledger)
+        except:
+            logging.exception("Error in run monitoring")
+        paths = dict((storage, None) for storage in RUN_STORAGES)
+        for run in get_runs():
+            if not ledger.is_completed(run.run_id):
+                paths[run.path] = RUN_EVENT_FILES
+        watcher.update(paths)
+        if watcher.wait(DAEMON_INTERVAL):
+            logging.info("Changes in the run folders, updating the run index.")
+            run_index.get_run_index().scan()
+
+
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Update LIMS with the status of NovaSeq X runs.")
+    arg_parser.add_argument("--daemon", action="store_true", help="Run continuously, instead of a single pass.")
+    args = arg_parser.parse_args()
     configure_logging()
-    try:
-        main()
-    except:
-        logging.exception("Error in run monitoring")
+    if args.daemon:
+        try:
+            run_daemon()
+        except:
+            logging.exception("Error in run monitoring")
+            raise
+    else:
+        try:
+            main()
+        except:
+            logging.exception("Error in run monitoring")
 
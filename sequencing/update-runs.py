@@ -14,6 +14,7 @@ import xml.parsers.expat
 # MatPlotLib, required for use of Pandas DataFrame
 os.environ['MPLCONFIGDIR'] = os.path.expanduser("~")
 import illuminate
+from lib import run_cycles, run_index
 from genologics.lims import *
 from genologics import config
 
@@ -93,23 +94,7 @@ def get_cycle(dataset, run_dir, lower_bound_cycle):
     Will look at lane 1 only, to reduce I/O and complexity.
     """
     total_cycles = sum(r['cycles'] for r in dataset.Metadata().read_config)
-    
-    lower_bound_cycle = max(0, lower_bound_cycle)
-    for cycle in range(lower_bound_cycle, total_cycles):
-        test_paths = [
-                os.path.join(
-                    run_dir, "Data", "Intensities", "BaseCalls", "L001",
-                    "C{0}.1".format(cycle+1)
-                ),
-                os.path.join(
-                    run_dir, "Data", "Intensities", "BaseCalls", "L001",
-                    "{0:04d}.bcl.bgzf".format(cycle+1)
-                )
-            ]
-        if not any(os.path.exists(test_path) for test_path in test_paths):
-            return cycle, total_cycles
-
-    return total_cycles, total_cycles
+    return run_cycles.get_cycle(run_dir, total_cycles, lower_bound_cycle), total_cycles
 
 
 def set_run_metadata(ds, run_dir, process):
@@ -139,13 +124,11 @@ def main():
     # Checks if any runs are missing
     missing_runs = set(completed_runs) | set(lims_runs_id_cycle.keys()) | set(new_runs)
 
-    run_dirs = [r
-            for directory in RUN_STORAGES
-            for r in glob.glob(os.path.join(directory, "*_*_*"))
-            ] 
+    runs = run_index.get_run_index().get_runs(RUN_STORAGES)
 
-    for r in run_dirs:
-        run_id = os.path.basename(r)
+    for run in runs:
+        r = run.path
+        run_id = run.run_id
 
         if not re.match(RUN_ID_MATCH, run_id):
             continue
@@ -177,7 +160,7 @@ def main():
                             lims_runs_id_cycle[run_id] = [process.id, -1] # Trigger update 
 
         if run_id not in completed_runs:
-            if os.path.exists(os.path.join(r, "RTAComplete.txt")):
+            if "RTAComplete.txt" in run.markers:
                 try:
                     # Remove if in new runs. If already found in LIMS, 
                     # will update one last time with cycle
@@ -189,8 +172,9 @@ def main():
     # Update LIMS state runs
     # Batch request for process objects not supported
     ## lims.get_batch([Process(lims, id=id) for (id, cycles) in lims_runs_id_cycle.values()])
-    for r in run_dirs:
-        run_id = os.path.basename(r)
+    for run in runs:
+        r = run.path
+        run_id = run.run_id
         if lims_runs_id_cycle.has_key(run_id):
             process_id, old_cycle = lims_runs_id_cycle[run_id]
             process = Process(lims, id=process_id)
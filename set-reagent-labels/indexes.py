@@ -7,6 +7,7 @@ import re
 from genologics.lims import *
 from genologics import config
 from collections import defaultdict
+import lib.reagent_catalogue
 
 lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
 
@@ -14,84 +15,101 @@ class ReagentError(Exception):
     pass
 
 
+class ReagentIndex(object):
+    """Search index of reagent types. The reagent types are ReagentInfo tuples,
+    with the name, sequence and category.
+
+    by_name maps the tokens of the names to the sets of reagent types. The
+    sequences and the alternative names accepted by fixup_illumina_index_versions
+    are kept in separate dicts, so they don't make name lookups ambiguous.
+    """
+
+    def __init__(self):
+        self.by_name = defaultdict(set)
+        self.by_alias = defaultdict(set)
+        self.by_sequence = defaultdict(set)
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def lookup(self, index, sequence_match=False):
+        """Get the set of reagent types matching an index. The sequences are only
+        used for sequence_match, or if there is no match by name or alias."""
+
+        if sequence_match:
+            return self.by_name.get(index, set()) | self.by_sequence.get(index, set())
+        return self.by_name.get(index) or self.by_alias.get(index) or self.by_sequence.get(index, set())
+
+
 def get_all_reagent_types():
-    """Load all reagent types with name only, from the API resource.
-    (this is a lot faster than getting the full representations one by
-    one).
+    """Build an in-memory search index of all reagent types, from the local
+    reagent catalogue (this is a lot faster than getting the full
+    representations one by one).
     
     Breaks the name into space-separated tokens, also removing brackets
-    () at the beginning and end of the tokens. Then returns a dict indexed
-    by the token, where the values are sets of reagent types matching that
-    token. {token => (reagent1, reagent2, ...)}
+    () at the beginning and end of the tokens. Then returns a ReagentIndex,
+    where the reagent types are indexed by the tokens, and also by the
+    sequence and the Illumina aliases of the tokens.
     
     Example: The name "AD005 (ACAGTG)" becomes two tokens: AD005 
     and ACAGTG.
     """ 
-    # Using a loop similar to Lims._get_instances()
-    reagent_types = defaultdict(set)
-    root = lims.get(lims.get_uri("reagenttypes"))
-    while root:
-        for node in root.findall("reagent-type"):
-
-            # add a reagent type to the search index, indexed by all words
-            name = node.attrib['name']
-            uri = node.attrib['uri']
-            for token in (
-                    tk.strip("()")
-                    for tk in name.split(" ")
-                    if tk != ""
-                    ):
-                reagent_types[token].add(uri)
-                
-        node = root.find('next-page')
-        root = None
-        if not node is None:
-            root = lims.get(node.attrib['uri'])
-
-    return reagent_types
+    reagent_index = ReagentIndex()
+    for reagent_info in lib.reagent_catalogue.get_reagent_catalogue(lims).all():
+        # add a reagent type to the search index, indexed by all words
+        tokens = set(
+                tk.strip("()")
+                for tk in reagent_info.name.split(" ")
+                if tk != ""
+                )
+        for token in tokens:
+            reagent_index.by_name[token].add(reagent_info)
+            for alias in get_illumina_index_aliases(token):
+                reagent_index.by_alias[alias].add(reagent_info)
+        if reagent_info.sequence:
+            reagent_index.by_sequence[reagent_info.sequence].add(reagent_info)
+
+    return reagent_index
+
+
+def get_matches_by_category(reagents, index, sequence_match):
+    """Get the reagent types matching an index, grouped by category.
+    Returns a dict {category => [reagent_name, ...]}."""
+
+    matches = defaultdict(list)
+    for reagent in reagents.lookup(index, sequence_match):
+        if not sequence_match or reagent.sequence == index:
+            matches[reagent.category].append(reagent.name)
+    return matches
 
 
 def get_reagents_auto_category(reagents, index_analyte, sequence_match=False, allow_multi_match=False):
-    category_indexes = {}
-    candidate_categories = set()
+    category_indexes = defaultdict(list)
+    candidate_categories = None # All categories
     ana_no_match = [] # list of analytes with no indexes at all
-    not_in_category = []
 
-    # Add all possible categories -- use categories for the first  analyte
-    ana_match_string = index_analyte[0][0]
-    for reagent_uri in reagents[ana_match_string]:
-        reagent = ReagentType(lims, uri=reagent_uri) 
-        candidate_categories.add(reagent.category)
-        category_indexes[reagent.category] = []
-
-    # 2. Process all analytes including the first one
     for index, analyte_name in index_analyte:
-        new_candidates = set()
-        ana_match_string = index
-        analyte_reagents = reagents[ana_match_string]
-        if not analyte_reagents:
+        if not reagents.lookup(index, sequence_match):
             ana_no_match.append(analyte_name)
-        for reagent_uri in reagents[ana_match_string]:
-            reagent = ReagentType(lims, uri=reagent_uri)
-            if not sequence_match or reagent.sequence == ana_match_string:
-                if reagent.category in candidate_categories:
-                    if reagent.category in new_candidates:
-                        raise ReagentError("Ambiguous match for sample" + analyte_name + ": in category" + reagent.category +\
-                                "the specified index matches multiple reagent types:" + reagent.name + "and" +\
-                                category_indexes[reagent.category][-1])
-                    else:
-                        new_candidates.add(reagent.category)
-                        category_indexes[reagent.category].append(reagent.name)
-        candidate_categories = new_candidates
+        matches = get_matches_by_category(reagents, index, sequence_match)
+        if candidate_categories is None:
+            candidate_categories = set(matches)
+        else:
+            candidate_categories &= set(matches)
+        for category in candidate_categories:
+            if len(matches[category]) > 1:
+                raise ReagentError("Ambiguous match for sample" + analyte_name + ": in category" + category +\
+                        "the specified index matches multiple reagent types:" + " and ".join(matches[category]))
+            category_indexes[category].append(matches[category][0])
 
     if ana_no_match:
         raise ReagentError("Samples with no match at all: " + ", ".join(ana_no_match))
-    elif len(candidate_categories) == 1 or (allow_multi_match and candidate_categories):
-        cat = next(iter(candidate_categories))
-        return cat, category_indexes[cat]
     elif not candidate_categories:
         raise ReagentError("No reagent category has all the given indexes")
-    elif len(candidate_categories) > 1:
+    elif len(candidate_categories) == 1 or allow_multi_match:
+        cat = next(iter(candidate_categories))
+        return cat, category_indexes[cat]
+    else:
         raise ReagentError("Multiple categories match: " + ", ".join(candidate_categories))
 
 
@@ -99,32 +117,41 @@ def get_reagents_for_category(reagents, index_analyte, category, sequence_match=
     match_reagents = []
     ana_no_match = [] # list of analytes with no indexes at all
 
-    # 2. Process all analytes including the first one
     for index, analyte_name in index_analyte:
-        ana_match_string = index
-        analyte_reagents = reagents[ana_match_string]
-        match = False
-        for reagent_uri in reagents[ana_match_string]:
-            reagent = ReagentType(lims, uri=reagent_uri)
-            if not sequence_match or reagent.sequence == ana_match_string:
-                if reagent.category == category:
-                    if match:
-                        raise ReagentError("Ambiguous match for sample" +  analyte_name + ": specified index "\
-                                "matches multiple reagent types: " + reagent.name +  " and " +\
-                                match_reagents[-1])
-                    else:
-                        match_reagents.append(reagent.name)
-                        match = True
-        if not match:
+        matches = get_matches_by_category(reagents, index, sequence_match)[category]
+        if len(matches) > 1:
+            raise ReagentError("Ambiguous match for sample" +  analyte_name + ": specified index "\
+                    "matches multiple reagent types: " + " and ".join(matches))
+        elif matches:
+            match_reagents.append(matches[0])
+        else:
             ana_no_match.append(analyte_name)
 
-
     if ana_no_match:
         raise ReagentError("No matching reagent type found for samples: " + ", ".join(ana_no_match))
     else:
         return match_reagents
 
 
+def get_illumina_index_aliases(token):
+    """Get the alternative names of a reagent type name token, as they would be
+    entered by the user and converted by fixup_illumina_index_versions. This
+    allows lookups using the Illumina names without calling fixup_illumina_index_versions.
+
+    Example: UDIv2_0001 => UDI0001V2, UDI0001v2
+    """
+    udi_match = re.match(r"UDIv2_(\d{4})$", token)
+    if udi_match:
+        return ["UDI" + udi_match.group(1) + "V2", "UDI" + udi_match.group(1) + "v2"]
+    udp_match = re.match(r"UDP(\d{4})(v3)?$", token)
+    if udp_match:
+        if udp_match.group(2): # V3
+            return ["UDP" + udp_match.group(1) + "V3"]
+        else: # The indexes without suffix are actually V2
+            return ["UDP" + udp_match.group(1) + "V2", "UDP" + udp_match.group(1) + "v2"]
+    return []
+
+
 def fixup_illumina_index_versions(index_name_list):
     """Allow the user to enter indexes like how Illumina specifies their UDIs in the
     adapter document. The are converted to the scheme used in Clarity.
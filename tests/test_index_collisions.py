@@ -0,0 +1,59 @@
+import random
+import sys
+import unittest
+sys.path.append("../lib")
+
+import index_collisions
+
+
+def hamming_distance(seq1, seq2):
+    return sum(c1 != c2 for c1, c2 in zip(seq1, seq2))
+
+
+class IndexCollisionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(13) # Set seed for repeatable test
+        self.sequences = [
+                "".join(random.choice("ACGT") for _ in range(random.choice([0, 6, 8, 10, 24])))
+                for _ in range(200)
+                ]
+
+    def test_mismatch_matrix_equals_hamming_distance(self):
+        matrix = index_collisions.mismatch_matrix(self.sequences)
+        for i, seq1 in enumerate(self.sequences):
+            for j, seq2 in enumerate(self.sequences):
+                self.assertEqual(matrix[i, j], hamming_distance(seq1, seq2))
+
+    def test_reverse_complement(self):
+        matrix = index_collisions.mismatch_matrix(["AACC", "GGTA"], reverse_complement_sequences=True)
+        # Reverse complements are GGTT and TACC
+        self.assertEqual(matrix[0, 1], 4)
+
+    def test_invalid_sequence(self):
+        with self.assertRaises(ValueError):
+            index_collisions.mismatch_matrix(["ACGT", "ACNT"])
+
+    def test_find_collisions(self):
+        index_pairs = [(seq, self.sequences[(i * 7) % len(self.sequences)]) for i, seq in enumerate(self.sequences)]
+        expected = [
+                (i, j)
+                for i in range(len(index_pairs))
+                for j in range(i + 1, len(index_pairs))
+                if hamming_distance(index_pairs[i][0], index_pairs[j][0]) < 3
+                and hamming_distance(index_pairs[i][1], index_pairs[j][1]) < 3
+                ]
+        collisions = index_collisions.find_collisions(index_pairs, 3)
+        self.assertEqual([(i, j) for i, j, _ in collisions], expected)
+        for i, j, (mismatches1, mismatches2) in collisions:
+            self.assertEqual(mismatches1, hamming_distance(index_pairs[i][0], index_pairs[j][0]))
+
+    def test_find_collisions_single_read(self):
+        index_pairs = [("ACGTACGT", "AAAAAAAA"), ("ACGTACGA", "CCCCCCCC"), ("TTTTTTTT", "AAAAAAAC")]
+        self.assertEqual(index_collisions.find_collisions(index_pairs, 3, reads=(1,)), [(0, 1, (1,))])
+        self.assertEqual(index_collisions.find_collisions(index_pairs, 3, reads=(2,)), [(0, 2, (1,))])
+        self.assertEqual(index_collisions.find_collisions(index_pairs, 3), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+sys.path.append("../lib")
+
+import run_index
+
+
+RUN_INFO = """<?xml version="1.0"?>
+<RunInfo>
+  <Run Id="{0}">
+    <Flowcell>22FLOWCELL</Flowcell>
+    <Reads>
+      <Read Number="1" NumCycles="151" IsIndexedRead="N" />
+      <Read Number="2" NumCycles="10" IsIndexedRead="Y" />
+    </Reads>
+  </Run>
+</RunInfo>
+"""
+
+RUN_PARAMETERS = """<?xml version="1.0"?>
+<RunParameters>
+  <RunId>{0}</RunId>
+  <ConsumableInfo>
+    <ConsumableInfo><Type>FlowCell</Type><SerialNumber>FC1</SerialNumber></ConsumableInfo>
+    <ConsumableInfo><Type>SampleTube</Type><SerialNumber>LC1234567-LC1</SerialNumber></ConsumableInfo>
+  </ConsumableInfo>
+</RunParameters>
+"""
+
+
+class RunIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = tempfile.mkdtemp()
+        self.index = run_index.RunIndex(path=None, storages=[self.storage])
+
+    def tearDown(self):
+        shutil.rmtree(self.storage)
+
+    def create_run(self, run_id):
+        run_dir = os.path.join(self.storage, run_id)
+        os.mkdir(run_dir)
+        with open(os.path.join(run_dir, "RunInfo.xml"), "w") as f:
+            f.write(RUN_INFO.format(run_id))
+        with open(os.path.join(run_dir, "RunParameters.xml"), "w") as f:
+            f.write(RUN_PARAMETERS.format(run_id))
+        return run_dir
+
+    def touch(self, path):
+        open(path, "w").close()
+        # Make sure the modification time of the parent directory changes
+        parent = os.path.dirname(path)
+        mtime = os.stat(parent).st_mtime + 1
+        os.utime(parent, (mtime, mtime))
+
+    def test_reads_metadata(self):
+        self.create_run("20240101_LH00001_0001_A22FLOWCELL")
+        self.assertEqual(self.index.scan(), 1)
+        entry = self.index.get("20240101_LH00001_0001_A22FLOWCELL", max_age=float('inf'))
+        self.assertEqual(entry.instrument, "LH00001")
+        self.assertEqual(entry.flowcell, "22FLOWCELL")
+        self.assertEqual([read['cycles'] for read in entry.reads], [151, 10])
+        self.assertEqual([read['is_index'] for read in entry.reads], [False, True])
+        self.assertEqual(entry.library_tube_strip_id, "LC1234567-LC1")
+        self.assertEqual(entry.markers, [])
+        self.assertEqual(entry.analyses, [])
+
+    def test_incremental_scan(self):
+        run_dir = self.create_run("20240101_LH00001_0001_A22FLOWCELL")
+        os.mkdir(os.path.join(self.storage, "NotARun"))
+        self.index.scan()
+        self.assertEqual(self.index.scan(), 0)
+
+        self.touch(os.path.join(run_dir, "CopyComplete.txt"))
+        self.assertEqual(self.index.scan(), 1)
+        entry = self.index.get_runs(max_age=float('inf'))[0]
+        self.assertEqual(entry.markers, ["CopyComplete.txt"])
+
+        os.makedirs(os.path.join(run_dir, "Analysis", "1"))
+        self.assertEqual(self.index.scan(), 1)
+        self.touch(os.path.join(run_dir, "Analysis", "1", "CopyComplete.txt"))
+        self.assertEqual(self.index.scan(), 1)
+        entry = self.index.get_runs(max_age=float('inf'))[0]
+        self.assertEqual([a['id'] for a in entry.analyses], ["1"])
+        self.assertTrue(entry.analyses[0]['copy_complete'])
+
+    def test_marker_created_during_scan(self):
+        run_dir = self.create_run("20240101_LH00001_0001_A22FLOWCELL")
+        self.index.scan()
+        self.touch(os.path.join(run_dir, "RTAComplete.txt"))
+        read_run = self.index.read_run
+        def read_run_then_copy_complete(*args):
+            result = read_run(*args)
+            self.touch(os.path.join(run_dir, "CopyComplete.txt"))
+            return result
+        self.index.read_run = read_run_then_copy_complete
+        self.assertEqual(self.index.scan(), 1)
+        self.index.read_run = read_run
+        self.assertEqual(self.index.scan(), 1)
+        entry = self.index.get_runs(max_age=float('inf'))[0]
+        self.assertEqual(entry.markers, ["RTAComplete.txt", "CopyComplete.txt"])
+
+    def test_without_database(self):
+        self.create_run("20240101_LH00001_0001_A22FLOWCELL")
+        not_a_dir = os.path.join(self.storage, "file")
+        open(not_a_dir, "w").close()
+        index = run_index.RunIndex(path=os.path.join(not_a_dir, "index.db"), storages=[self.storage])
+        self.assertTrue(index.lazy)
+        index.scan()
+        entry = index.get("20240101_LH00001_0001_A22FLOWCELL", max_age=float('inf'))
+        self.assertEqual(entry.flowcell, "22FLOWCELL")
+        self.assertEqual([read['cycles'] for read in entry.reads], [151, 10])
+        self.assertEqual(entry.library_tube_strip_id, "LC1234567-LC1")
+        self.assertEqual(entry._asdict()['flowcell'], "22FLOWCELL")
+
+    def test_removed_run(self):
+        run_dir = self.create_run("20240101_LH00001_0001_A22FLOWCELL")
+        self.index.scan()
+        shutil.rmtree(run_dir)
+        self.index.scan()
+        self.assertEqual(self.index.get_runs(max_age=float('inf')), [])
+
+    def test_persistence(self):
+        self.create_run("20240101_LH00001_0001_A22FLOWCELL")
+        db_path = os.path.join(self.storage, "index.db")
+        run_index.RunIndex(path=db_path, storages=[self.storage]).scan()
+        index = run_index.RunIndex(path=db_path, storages=[])
+        entry = index.get("20240101_LH00001_0001_A22FLOWCELL", max_age=float('inf'))
+        self.assertEqual(entry.flowcell, "22FLOWCELL")
+
+
+if __name__ == "__main__":
+    unittest.main()